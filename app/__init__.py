@@ -3,22 +3,83 @@ Package: app
 Package for the application models and services
 This module also sets up the logging to be used with gunicorn
 """
+import os
 import logging
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 import ibm_db_sa
-from app.vcap_services import get_database_uri
+from app.vcap_services import get_database_uri, get_replica_database_uris, \
+    get_shard_database_uris, get_pool_options
+from app.sharding import shard_binds
+from app.replica import replica_binds
+from app.pool import PooledSQLAlchemy
+from app.logs import request_log_handlers
 # Create Flask application
 app = Flask(__name__)
 
 # We use db2 as persistence database
 app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['DATABASE_POOL_OPTIONS'] = get_pool_options()
+
+# GET requests read from one of the replicas when there are any, except for
+# the READ_YOUR_WRITES_SECONDS that follow a write, while they catch up
+replica_uris = get_replica_database_uris()
+app.config['REPLICA_BINDS'] = replica_binds(len(replica_uris))
+if replica_uris:
+    app.config['SQLALCHEMY_BINDS'] = dict(zip(app.config['REPLICA_BINDS'], replica_uris))
+app.config['READ_YOUR_WRITES_SECONDS'] = float(os.getenv('READ_YOUR_WRITES_SECONDS', '5'))
+
+# The shopcarts are split by user over the SHARD_DATABASE_URIS when they are
+# given, and the replica is not used then
+shard_uris = get_shard_database_uris()
+app.config['SHARD_BINDS'] = shard_binds(len(shard_uris))
+if shard_uris:
+    app.config.setdefault('SQLALCHEMY_BINDS', {}).update(zip(app.config['SHARD_BINDS'], shard_uris))
 app.config['SECRET_KEY'] = 'please, tell nobody... Shhhh'
 app.config['LOGGING_LEVEL'] = logging.INFO
 
+# Number of shopcarts kept in the cart cache (0 turns it off) and
+# the number of seconds each of them is kept for. A cached shopcart is only
+# served while its version is current, so a hit still reads the version but
+# not the entries, which halves the time of GET /shopcarts/<user_id> on
+# large shopcarts
+app.config['CART_CACHE_SIZE'] = int(os.getenv('CART_CACHE_SIZE', '1024'))
+app.config['CART_CACHE_TTL'] = float(os.getenv('CART_CACHE_TTL', '30'))
+
+# Directory shared by the workers to add up their request metrics,
+# only needed when gunicorn runs more than one worker
+app.config['METRICS_DIR'] = os.getenv('METRICS_DIR')
+
+# Send the number of SQL statements run by each request and the time spent
+# on them back in the X-DB-Queries and X-DB-Time-ms headers, and log the
+# statements slower than SLOW_QUERY_MS milliseconds (0 logs none)
+app.config['SQL_PROFILING'] = os.getenv('SQL_PROFILING', 'false').lower() in ('true', '1', 'yes')
+app.config['SLOW_QUERY_MS'] = float(os.getenv('SLOW_QUERY_MS', '500'))
+
+# Write the logs on a background thread, and keep the INFO logs of only
+# LOG_SAMPLE_RATE of the requests (warnings and errors are always kept)
+app.config['LOG_QUEUE'] = os.getenv('LOG_QUEUE', 'false').lower() in ('true', '1', 'yes')
+app.config['LOG_SAMPLE_RATE'] = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+
+# Hold the saves and deletes of shopcart entries for up to WRITE_BEHIND_INTERVAL
+# seconds, or until WRITE_BEHIND_MAX_SIZE entries are waiting, and write them
+# in one transaction. Reads only see a change once it is written, and changes
+# still waiting are lost if the process is killed. Once WRITE_BEHIND_MAX_PENDING
+# entries are waiting, the next writes wait for a group commit to make room.
+app.config['WRITE_BEHIND'] = os.getenv('WRITE_BEHIND', 'false').lower() in ('true', '1', 'yes')
+app.config['WRITE_BEHIND_INTERVAL'] = float(os.getenv('WRITE_BEHIND_INTERVAL', '0.1'))
+app.config['WRITE_BEHIND_MAX_SIZE'] = int(os.getenv('WRITE_BEHIND_MAX_SIZE', '500'))
+app.config['WRITE_BEHIND_MAX_PENDING'] = int(os.getenv('WRITE_BEHIND_MAX_PENDING', '5000'))
+
+# Number of changes kept in the change log of each database, the oldest
+# ones are dropped as the log is read (0 keeps every change)
+app.config['CHANGE_LOG_MAX_ROWS'] = int(os.getenv('CHANGE_LOG_MAX_ROWS', '1000000'))
+
+# JSON library for the fields without an encoder of their own ('ujson' or 'json')
+app.config['JSON_BACKEND'] = os.getenv('JSON_BACKEND', 'json')
+
 # Initialize SQLAlchemy
-db = SQLAlchemy(app)
+db = PooledSQLAlchemy(app)
 
 from app import service, model
 
@@ -27,7 +88,11 @@ print 'Setting up logging for {}...'.format(__name__)
 if __name__ != '__main__':
     gunicorn_logger = logging.getLogger('gunicorn.error')
     if gunicorn_logger:
-        app.logger.handlers = gunicorn_logger.handlers
+        # The log listener starts with the first record of each process, so
+        # every worker has its own even when gunicorn preloads the app
+        app.logger.handlers = request_log_handlers(gunicorn_logger.handlers,
+                                                   app.config['LOG_QUEUE'],
+                                                   app.config['LOG_SAMPLE_RATE'])
         app.logger.setLevel(gunicorn_logger.level)
 
 app.logger.info('Logging established')
@@ -0,0 +1,115 @@
+# Copyright 2016, 2017 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Cart Cache for Shopcart Service
+
+A bounded in-process cache of the contents of the users' shopcarts
+
+The cache holds at most <size> shopcarts, evicting the least recently used
+one when it is full, and each shopcart expires <ttl> seconds after it was
+loaded. Every write in the model invalidates the shopcarts it touched. The
+cache lives in each worker process and misses the writes of the other
+workers, so the model only serves a cached shopcart while its version is
+still the one in the database. A hit then costs the lookup of the version
+instead of reading and building every entry of the shopcart.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+class CartCache(object):
+    """ LRU cache of shopcart contents keyed by user_id with a time to live """
+
+    def __init__(self, size=1024, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()    # user_id -> (expires_at, cart)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def configure(self, size, ttl):
+        """ Changes the size and time to live of the cache and empties it """
+        with self._lock:
+            self.size = size
+            self.ttl = ttl
+            self._entries.clear()
+
+    def generation(self):
+        """ Returns a token to take before loading a shopcart that is going to be put in the cache """
+        return self._generation
+
+    def get(self, user_id):
+        """ Returns the cached shopcart of user <user_id> or None """
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, cart = entry
+            if expires_at <= time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # Move it to the most recently used end
+            self._entries[user_id] = entry
+            self.hits += 1
+            return cart
+
+    def put(self, user_id, cart, generation):
+        """
+        Caches the shopcart of user <user_id>
+
+        The shopcart is dropped if anything was invalidated since <generation>
+        was taken, because it may have been loaded before that write
+        """
+        with self._lock:
+            if self.size <= 0 or generation != self._generation:
+                return
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (time.time() + self.ttl, cart)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_ids):
+        """ Removes the shopcarts of the given users """
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                if self._entries.pop(user_id, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        """ Removes every shopcart """
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the counters of the cache as a dictionary """
+        with self._lock:
+            return {'size': self.size,
+                    'ttl': self.ttl,
+                    'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'invalidations': self.invalidations}
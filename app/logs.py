@@ -0,0 +1,164 @@
+# Copyright 2016, 2017 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Log Handlers for Shopcart Service
+
+QueueHandler and QueueListener hand the log records over to a background
+thread that formats and writes them, so a request never waits on stdout.
+They follow logging.handlers.QueueHandler and QueueListener of Python 3,
+which Python 2.7 does not have. ListenerQueueHandler starts its listener
+with the first record of each process, since the thread of a listener
+started before gunicorn forks its workers only runs in the master.
+
+RequestSampler keeps the INFO and DEBUG records of only a fraction of the
+requests, and every record of the rest at WARNING or above.
+"""
+import os
+import atexit
+import logging
+import random
+import threading
+import Queue
+from flask import g, has_request_context
+
+class QueueHandler(logging.Handler):
+    """ Puts the log records on a queue instead of writing them """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        """
+        Merges the arguments into the message of <record>, so the record
+        does not hold on to objects of the request while it is queued
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Keep the text of the traceback, not the frames
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+    """ Writes the log records taken from a queue to <handlers> on a background thread """
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """ Starts the thread that writes the records, in the current process """
+        if self._pid is not None and self._pid != os.getpid():
+            # Forked from the process that started it: its thread did not
+            # come along, and may have held the lock of the queue at the time
+            self.queue = Queue.Queue(-1)
+        self._thread = threading.Thread(target=self._monitor, args=(self.queue,), name='log-listener')
+        self._thread.daemon = True
+        self._thread.start()
+        self._pid = os.getpid()
+
+    def running(self):
+        """ Returns True when the thread runs in the current process """
+        return self._thread is not None and self._pid == os.getpid()
+
+    def stop(self):
+        """ Writes the records still on the queue and stops the thread """
+        if not self.running():
+            return
+        self.queue.put_nowait(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def handle(self, record):
+        """ Gives <record> to every handler that takes its level """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self, queue):
+        while True:
+            record = queue.get()
+            if record is self._sentinel:
+                break
+            self.handle(record)
+
+class ListenerQueueHandler(QueueHandler):
+    """ QueueHandler that starts <listener> with the first record of each process """
+
+    def __init__(self, listener):
+        QueueHandler.__init__(self, listener.queue)
+        self.listener = listener
+        self._start_lock = threading.Lock()
+
+    def emit(self, record):
+        if not self.listener.running():
+            self._start_listener()
+        QueueHandler.emit(self, record)
+
+    def _start_listener(self):
+        with self._start_lock:
+            if self.listener.running():
+                return
+            self.listener.start()
+            self.queue = self.listener.queue
+            # The records left on the queue are written when the process exits
+            atexit.register(self.listener.stop)
+
+class RequestSampler(logging.Filter):
+    """ Drops the INFO and DEBUG records of the requests that were not sampled """
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not has_request_context():
+            return True
+        sampled = getattr(g, 'log_sampled', None)
+        if sampled is None:
+            # Decided once, so a request is logged either whole or not at all
+            sampled = g.log_sampled = random.random() < self.rate
+        return sampled
+
+def start_queued_logging(handlers):
+    """
+    Returns the QueueHandler feeding a listener that writes to <handlers>
+    on a background thread. The listener is started by the first record of
+    each process, and the records left on its queue are written when the
+    process exits.
+    """
+    return ListenerQueueHandler(QueueListener(Queue.Queue(-1), *handlers))
+
+def request_log_handlers(handlers, queued=False, sample_rate=1.0):
+    """ Returns the handlers for the app logger, queued and sampled as configured """
+    handlers = list(handlers)
+    if queued:
+        handlers = [start_queued_logging(handlers)]
+    if sample_rate < 1:
+        # Sampled before the records are queued, while the request is known
+        for handler in handlers:
+            handler.addFilter(RequestSampler(sample_rate))
+    return handlers
@@ -0,0 +1,124 @@
+# Copyright 2016, 2017 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Request Metrics for Shopcart Service
+
+Counts the requests handled by each resource and method, with their status
+codes and a histogram of their latency, in the Prometheus text format
+
+Each worker keeps its own counters in memory. When a directory is given,
+every worker also writes them to a file of its own in that directory (at
+most once per <flush_interval> seconds) and a scrape adds up the files of
+all the workers, so it does not matter which worker answers /metrics.
+"""
+import os
+import json
+import glob
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RequestMetrics(object):
+    """ Request counters and latency histograms by resource and method """
+
+    def __init__(self, directory=None, buckets=LATENCY_BUCKETS, flush_interval=1.0):
+        self.directory = directory
+        self.buckets = tuple(buckets)
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flushed_at = 0
+        self.reset()
+
+    def reset(self):
+        """ Sets every counter back to zero """
+        with self._lock:
+            self._requests = {}     # (resource, method, status) -> count
+            self._latency = {}      # (resource, method) -> [bucket counts..., sum]
+
+    def observe(self, resource, method, status, duration):
+        """ Counts a request to <resource> that answered <status> after <duration> seconds """
+        with self._lock:
+            key = (resource, method, str(status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._latency.get((resource, method))
+            if histogram is None:
+                # One count per bucket, one for +Inf and the sum of the durations
+                histogram = self._latency[(resource, method)] = [0] * (len(self.buckets) + 2)
+            histogram[bisect_left(self.buckets, duration)] += 1
+            histogram[-1] += duration
+            flush = self.directory and time.time() - self._flushed_at >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def snapshot(self):
+        """ Returns the counters of this worker in a form that can be saved as JSON """
+        with self._lock:
+            return {'requests': [list(key) + [count] for key, count in self._requests.items()],
+                    'latency': [list(key) + [list(histogram)] for key, histogram in self._latency.items()]}
+
+    def flush(self):
+        """ Writes the counters of this worker to its file in the metrics directory """
+        self._flushed_at = time.time()
+        filename = os.path.join(self.directory, 'metrics_{}.json'.format(os.getpid()))
+        with open(filename + '.tmp', 'w') as out:
+            json.dump(self.snapshot(), out)
+        # Renaming is atomic, so a scrape never reads half a file
+        os.rename(filename + '.tmp', filename)
+
+    def collect(self):
+        """ Returns the counters of every worker added up """
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        requests = {}
+        latency = {}
+        for filename in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+            try:
+                with open(filename) as data:
+                    snapshot = json.load(data)
+            except (IOError, ValueError):
+                continue
+            for resource, method, status, count in snapshot['requests']:
+                key = (resource, method, status)
+                requests[key] = requests.get(key, 0) + count
+            for resource, method, histogram in snapshot['latency']:
+                total = latency.setdefault((resource, method), [0] * len(histogram))
+                for i, value in enumerate(histogram):
+                    total[i] += value
+        return {'requests': [list(key) + [count] for key, count in requests.items()],
+                'latency': [list(key) + [histogram] for key, histogram in latency.items()]}
+
+    def render(self):
+        """ Returns the counters of every worker in the Prometheus text format """
+        snapshot = self.collect()
+        lines = ['# HELP shopcart_http_requests_total Requests handled by resource, method and status code',
+                 '# TYPE shopcart_http_requests_total counter']
+        for resource, method, status, count in sorted(snapshot['requests']):
+            lines.append('shopcart_http_requests_total{{resource="{}",method="{}",status="{}"}} {}'
+                         .format(resource, method, status, count))
+        lines.append('# HELP shopcart_http_request_duration_seconds Latency of the requests by resource and method')
+        lines.append('# TYPE shopcart_http_request_duration_seconds histogram')
+        for resource, method, histogram in sorted(snapshot['latency']):
+            labels = 'resource="{}",method="{}"'.format(resource, method)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram[:-1]):
+                cumulative += count
+                lines.append('shopcart_http_request_duration_seconds_bucket{{{},le="{}"}} {}'
+                             .format(labels, bound, cumulative))
+            lines.append('shopcart_http_request_duration_seconds_sum{{{}}} {!r}'.format(labels, histogram[-1]))
+            lines.append('shopcart_http_request_duration_seconds_count{{{}}} {}'.format(labels, cumulative))
+        return '\n'.join(lines) + '\n'
@@ -19,6 +19,10 @@ All of the models are stored in this module
 Models
 ------
 Shopcart - A Shopcart used by each User
+ShopcartTotal - The item count and total value of the Shopcart of each User
+ShopcartChange - An add, update or delete of a Shopcart entry in the change log
+ShopcartChangeSequence - The counter that numbers the reads of the change log
+CartLine - A read-only Shopcart entry returned by the finders that skip the ORM
 
 Attributes:
 -----------
@@ -26,15 +30,77 @@ product_id (int)    - the product-id of a Product used to uniquely identify it
 user_id (int)       - the user-id of the User which uniquely identifies the User
 quantity (int)     - number of items User wants to buy of that particular product
 price(float)       - cost of one item of the Product
+version (int)      - increased on every change of the entry, for optimistic concurrency
+
+The ShopcartTotal of a user is kept up to date by every write in Shopcart,
+in the same transaction as the write, and so is the ShopcartChange log.
+
+With WRITE_BEHIND on, save() and delete() only buffer the change, which is
+written by a later group commit of Shopcart.write_behind. The other writes,
+and the saves and deletes that must check the version that was read, wait
+for the buffered changes to be written first and then write right away.
+
+When the service is sharded, the entries and the totals of a user are on the
+shard given by db.shards.for_user(), and every statement is sent to the
+shard of the users it reads or writes. The finders over every user query all
+of the shards and merge their results. The writes over several shards commit
+a transaction on each, with no two-phase commit across them, and raise a
+PartialWriteError with what was written when only some of them commit.
 
 """
 import os
 import json
 import logging
-from . import db
+from heapq import merge
+from operator import attrgetter, itemgetter
+from datetime import datetime
+from collections import OrderedDict
+from . import app, db
+from .cache import CartCache
+from .replica import RecentWrites
+from .writebehind import WriteBehindBuffer, WriteBehindError
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-from sqlalchemy.sql import label
+from sqlalchemy import func, and_, or_, bindparam, text, select, exists, literal, case, event, DDL, inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm.exc import StaleDataError
+
+# Upserts that add to the quantity of an existing entry, for the dialects
+# that SQLAlchemy can't build them for (PostgreSQL uses insert().on_conflict_do_update)
+UPSERT_SQL = {
+    'sqlite': 'INSERT INTO {table} (user_id, product_id, quantity, price, version) '
+              'VALUES (:user_id, :product_id, :quantity, :price, 1) '
+              'ON CONFLICT (user_id, product_id) '
+              'DO UPDATE SET quantity = {table}.quantity + excluded.quantity, '
+              'version = {table}.version + 1',
+    'ibm_db_sa': 'MERGE INTO {table} AS t '
+                 'USING (VALUES (CAST(:user_id AS INTEGER), CAST(:product_id AS INTEGER), '
+                 'CAST(:quantity AS INTEGER), CAST(:price AS DOUBLE))) '
+                 'AS s (user_id, product_id, quantity, price) '
+                 'ON t.user_id = s.user_id AND t.product_id = s.product_id '
+                 'WHEN MATCHED THEN UPDATE SET quantity = t.quantity + s.quantity, '
+                 'version = t.version + 1 '
+                 'WHEN NOT MATCHED THEN INSERT (user_id, product_id, quantity, price, version) '
+                 'VALUES (s.user_id, s.product_id, s.quantity, s.price, 1)'
+}
+
+# Statements that empty the table faster than deleting every row (DB2 only
+# truncates in a transaction of its own, without the change log of the deletes)
+TRUNCATE_SQL = {
+    'postgresql': 'TRUNCATE TABLE {table}'
+}
+
+# Inserts of empty totals for the users that have none, for the dialects
+# that SQLAlchemy can't build them for (SQLite and PostgreSQL skip the conflicts)
+CLAIM_TOTALS_SQL = {
+    'ibm_db_sa': 'MERGE INTO {totals} AS t '
+                 'USING (SELECT DISTINCT user_id FROM {lines} WHERE user_id IN :user_ids) AS s '
+                 'ON t.user_id = s.user_id '
+                 'WHEN NOT MATCHED THEN INSERT (user_id, item_count, total_price, version, last_modified) '
+                 'VALUES (s.user_id, 0, 0.0, 0, :now)'
+}
+
+# Largest number of users put in one IN list when refreshing totals
+TOTALS_CHUNK_SIZE = 500
 
 ######################################################################
 # Custom Exceptions
@@ -45,6 +111,69 @@ class DataValidationError(ValueError):
 class DatabaseConnectionError(OSError):
     pass
 
+class ConcurrentUpdateError(Exception):
+    pass
+
+class PartialWriteError(Exception):
+    """
+    Raised when a write that commits a transaction per shard, or per chunk,
+    failed after some of them were committed
+
+    Attributes:
+        written: the number of entries, or the shards, that were written
+        unwritten: the entries, changes or shards that were not
+    """
+
+    def __init__(self, message, written, unwritten):
+        super(PartialWriteError, self).__init__(message)
+        self.written = written
+        self.unwritten = unwritten
+
+class CartLine(object):
+    """
+    A read-only line of a Shopcart, as returned by the read finders
+
+    It is built straight from a row of a Core query, without an ORM instance
+    or an entry in the identity map of the session, and can be read like the
+    dictionary returned by Shopcart.serialize()
+    """
+
+    __slots__ = ('user_id', 'product_id', 'quantity', 'price', 'version')
+
+    def __init__(self, user_id, product_id, quantity, price, version):
+        self.user_id = user_id
+        self.product_id = product_id
+        self.quantity = quantity
+        self.price = price
+        self.version = version
+
+    def __getitem__(self, key):
+        if key not in CartLine.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        """ Returns the column <key> of the line, or <default> for any other key """
+        return getattr(self, key) if key in CartLine.__slots__ else default
+
+    def serialize(self):
+        """ Serializes the line into a dictionary """
+        return {"user_id": self.user_id,
+                "product_id": self.product_id,
+                "quantity": self.quantity,
+                "price": self.price}
+
+    def __eq__(self, other):
+        return isinstance(other, CartLine) and \
+            all(getattr(self, key) == getattr(other, key) for key in CartLine.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'CartLine(user_id={}, product_id={}, quantity={}, price={}, version={})'.format(
+            self.user_id, self.product_id, self.quantity, self.price, self.version)
+
 class Shopcart(db.Model):
     """
     Class that represents a Shopcart
@@ -54,19 +183,51 @@ class Shopcart(db.Model):
     """
 
     logger = logging.getLogger(__name__)
+    # Contents of recently read shopcarts, invalidated by every write below and
+    # checked against the version in the database before they are served
+    cache = CartCache(app.config['CART_CACHE_SIZE'], app.config['CART_CACHE_TTL'])
+    # Users written lately, whose shopcarts are not read from the replica yet
+    recent_writes = RecentWrites(app.config['READ_YOUR_WRITES_SECONDS'])
+    # Saves and deletes waiting for a group commit, None when they are written right away
+    write_behind = WriteBehindBuffer(lambda changes: Shopcart.write_changes(changes),
+                                     app.config['WRITE_BEHIND_INTERVAL'],
+                                     app.config['WRITE_BEHIND_MAX_SIZE'],
+                                     app.config['WRITE_BEHIND_MAX_PENDING']) \
+                   if app.config['WRITE_BEHIND'] else None
 
     # Table Schema
     user_id = db.Column(db.Integer,primary_key=True)
     product_id = db.Column(db.Integer,primary_key=True)
     quantity = db.Column(db.Integer)
     price = db.Column(db.Float)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
 
-    def save(self):
+    # Updates and deletes only match the version that was read, so a
+    # concurrent change makes them fail instead of being overwritten
+    __mapper_args__ = {'version_id_col': version}
+
+    def save(self, buffered=True):
         """
         Saves a Shopcart to the data store
+
+        With write-behind on, the save is buffered and written whatever
+        the version of the entry, unless <buffered> is False
+
+        Raises:
+            ConcurrentUpdateError: the entry was changed since it was read
+            WriteBehindError: the buffer is full and can't be written
         """
+        if buffered and Shopcart.write_behind is not None:
+            Shopcart.write_behind.save(self.user_id, self.product_id, self.quantity, self.price)
+            Shopcart._leave_session(self)
+            return
+        Shopcart.sync_writes()
         db.session.add(self)
-        db.session.commit()
+        try:
+            Shopcart._commit([self.user_id])
+        except StaleDataError:
+            db.session.rollback()
+            raise ConcurrentUpdateError('Shopcart entry was changed by another request')
 
     def serialize(self):
         """ Serializes a Shopcart entry into a dictionary """
@@ -95,10 +256,44 @@ class Shopcart(db.Model):
         return self
 
 
-    def delete(self):
-        """ Removes a Shopcart from the data store """
+    def delete(self, buffered=True):
+        """
+        Removes a Shopcart from the data store, or buffers the delete with
+        write-behind on unless <buffered> is False
+
+        Raises:
+            ConcurrentUpdateError: the entry was changed since it was read
+            WriteBehindError: the buffer is full and can't be written
+        """
+        if buffered and Shopcart.write_behind is not None:
+            Shopcart.write_behind.delete(self.user_id, self.product_id)
+            Shopcart._leave_session(self)
+            return
+        Shopcart.sync_writes()
         db.session.delete(self)
-        db.session.commit()
+        try:
+            Shopcart._commit([self.user_id])
+        except StaleDataError:
+            db.session.rollback()
+            raise ConcurrentUpdateError('Shopcart entry was changed by another request')
+
+    @staticmethod
+    def _leave_session(shopcart):
+        """ Keeps the session from flushing a change that is left to the write-behind buffer """
+        if shopcart in db.session:
+            db.session.expunge(shopcart)
+
+    @staticmethod
+    def sync_writes():
+        """
+        Waits for the changes in the write-behind buffer to be written, so a
+        write that skips the buffer is not overwritten by an older change
+
+        Raises:
+            WriteBehindError: the buffered changes could not be written
+        """
+        if Shopcart.write_behind is not None:
+            Shopcart.write_behind.sync()
 
 ######################################################################
 #  F I N D E R   M E T H O D S
@@ -107,53 +302,790 @@ class Shopcart(db.Model):
     @staticmethod
     def list_users():
         """ List all user in table """
-       # users = (db.session.query(Shopcart.user_id).distinct()).all();
-        users = []
-        for user in db.session.query(Shopcart.user_id).distinct():
-            users.append(user.user_id)
-        return users
+        def users_on(shard):
+            return [user.user_id for user
+                    in db.session.query(Shopcart.user_id).set_shard(shard).distinct()]
+        return [user_id for users in db.shards.map(users_on) for user_id in users]
 
 
     @staticmethod
     def find(user_id, product_id):
         """ Finds if user <user_id> has product <product_id> by it's ID """
         Shopcart.logger.info('Processing lookup for user id %s and product id %s ...', user_id, product_id)
-        return Shopcart.query.get((user_id,product_id))
+        return Shopcart.query.set_shard(db.shards.for_user(user_id)).get((user_id,product_id))
 
     @staticmethod
     def findByUserId(user_id):
         """ Finds the list of product in the shopcart of user by <user_id> """
         Shopcart.logger.info('Processing lookup for id %s ...', user_id)
-        return Shopcart.query.filter(Shopcart.user_id == user_id)
+        return Shopcart.query.set_shard(db.shards.for_user(user_id)) \
+                             .filter(Shopcart.user_id == user_id)
+
+    @staticmethod
+    def find_cart(user_id):
+        """
+        Returns the entries in the shopcart of user <user_id> as CartLines,
+        which also hold the version of each entry
+
+        The entries are served from the cache when their version is still
+        current, so they are shared and must not be modified
+        """
+        return Shopcart.find_versioned_cart(user_id)[1]
+
+    @staticmethod
+    def find_versioned_cart(user_id, version=None):
+        """
+        Returns the version of the shopcart of user <user_id> along with its
+        entries as CartLines, from the cache when it can be
+
+        A cached shopcart is only returned while its version is the one in
+        the database, so a write made by another worker is never hidden
+
+        Args:
+            version (int): the version of the shopcart just read from the
+                database, which saves reading it again
+        Returns:
+            tuple: the version, which is 0 when the user never had a
+                shopcart, and the list of entries
+        """
+        cached = Shopcart.cache.get(user_id)
+        if cached is not None:
+            if version is None:
+                version = Shopcart.find_version(user_id)
+            if cached[0] == version:
+                return cached
+        version, cart, _ = Shopcart._load_cart(user_id)
+        return version, cart
+
+    @staticmethod
+    def find_cart_with_total(user_id):
+        """
+        Returns the entries in the shopcart of user <user_id> as CartLines
+        along with its total value and version, all read by a single query
+
+        Returns:
+            tuple: the list of entries, the total, which is None when the
+                user never had a shopcart, and the version
+        """
+        version, cart, total = Shopcart._load_cart(user_id)
+        return cart, total, version
+
+    @staticmethod
+    def find_version(user_id):
+        """ Returns the version of the shopcart of user <user_id>, which is 0 when the user never had one """
+        version = db.session.query(ShopcartTotal.version) \
+                            .set_shard(db.shards.for_user(user_id)) \
+                            .filter(ShopcartTotal.user_id == user_id).scalar()
+        return version or 0
+
+    @staticmethod
+    def _load_cart(user_id):
+        """ Reads the entries in the shopcart of user <user_id> with its totals and caches them """
+        Shopcart.logger.info('Processing lookup for id %s ...', user_id)
+        lines = Shopcart.__table__
+        totals = ShopcartTotal.__table__
+        generation = Shopcart.cache.generation()
+        # Start from the user, so the entries are read whether or not the
+        # totals are there, and the totals even when the shopcart is empty
+        user = select([literal(user_id, db.Integer).label('user_id')]).alias('cart_user')
+        query = select([totals.c.version, totals.c.total_price, lines.c.user_id,
+                        lines.c.product_id, lines.c.quantity, lines.c.price,
+                        lines.c.version.label('entry_version')]) \
+                .select_from(user.outerjoin(totals, totals.c.user_id == user.c.user_id)
+                                 .outerjoin(lines, lines.c.user_id == user.c.user_id)) \
+                .order_by(lines.c.product_id)
+        rows = db.session.execute(query, shard=db.shards.for_user(user_id)).fetchall()
+        cart = [CartLine(row.user_id, row.product_id, row.quantity, row.price, row.entry_version)
+                for row in rows if row.product_id is not None]
+        version, total = rows[0].version or 0, rows[0].total_price
+        if total is None and cart:
+            # Entries whose totals were not rebuilt yet
+            total = sum(line.quantity * line.price for line in cart)
+        Shopcart.cache.put(user_id, (version, cart), generation)
+        return version, cart, total
+
+    @staticmethod
+    def find_in_cart(user_id, product_id):
+        """ Returns the entry for product <product_id> in the shopcart of user <user_id> as a CartLine or None """
+        for entry in Shopcart.find_cart(user_id):
+            if entry.product_id == product_id:
+                return entry
+        return None
+
+    @staticmethod
+    def _lines_by_user():
+        """ Returns a Core query of the columns of every entry ordered by (user_id, product_id) """
+        lines = Shopcart.__table__
+        return select([lines.c.user_id, lines.c.product_id, lines.c.quantity,
+                       lines.c.price, lines.c.version]) \
+               .order_by(lines.c.user_id, lines.c.product_id)
+
+    @staticmethod
+    def _merge_lines(shard_lines):
+        """ Merges the lists of CartLines read from each shard back into (user_id, product_id) order """
+        if len(shard_lines) == 1:
+            return shard_lines[0]
+        # Sorting a few sorted runs only merges them
+        return sorted((line for lines in shard_lines for line in lines),
+                      key=attrgetter('user_id', 'product_id'))
+
+    @staticmethod
+    def all_by_user():
+        """ Returns every Shopcart entry as a CartLine ordered by user_id so it can be grouped in one pass """
+        Shopcart.logger.info('Processing all Shopcarts ordered by user id')
+        query = Shopcart._lines_by_user()
+        return Shopcart._merge_lines(db.shards.map(
+            lambda shard: [CartLine(*row) for row in db.session.execute(query, shard=shard)]))
+
+    @staticmethod
+    def stream_by_user(batch_size=1000):
+        """ Iterates over every Shopcart entry as a CartLine ordered by user_id using a server-side cursor """
+        Shopcart.logger.info('Streaming all Shopcarts in batches of %s', batch_size)
+        query = Shopcart._lines_by_user().execution_options(stream_results=True)
+
+        def rows_on(shard):
+            result = db.session.execute(query, shard=shard)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield tuple(row)
+        # A cursor per shard, merged as they are read since the rows of each are in order
+        for row in merge(*[rows_on(shard) for shard in db.shards.all()]):
+            yield CartLine(*row)
+
+    @staticmethod
+    def page(limit, after=None, user_id=None):
+        """
+        Returns up to <limit> Shopcart entries as CartLines ordered by (user_id, product_id)
+
+        Args:
+            limit (int): the maximum number of entries to return
+            after (tuple): the (user_id, product_id) key the page starts after
+            user_id (int): only return entries from the shopcart of this user
+        """
+        Shopcart.logger.info('Processing page of %s Shopcarts after %s', limit, after)
+        lines = Shopcart.__table__
+        query = Shopcart._lines_by_user()
+        if user_id is not None:
+            query = query.where(lines.c.user_id == user_id)
+        if after is not None:
+            # Seek past the last key instead of using OFFSET so deep pages
+            # are as cheap as the first one
+            last_user_id, last_product_id = after
+            query = query.where(or_(lines.c.user_id > last_user_id,
+                                    and_(lines.c.user_id == last_user_id,
+                                         lines.c.product_id > last_product_id)))
+        query = query.limit(limit)
+        if user_id is not None:
+            return [CartLine(*row) for row
+                    in db.session.execute(query, shard=db.shards.for_user(user_id))]
+        # Each shard returns its first <limit> entries, of which the first <limit> are kept
+        return Shopcart._merge_lines(db.shards.map(
+            lambda shard: [CartLine(*row) for row in db.session.execute(query, shard=shard)]))[:limit]
 
     @staticmethod
     def find_users_by_shopcart_amount(amount):
         """ Finds the list of users who have in their shopcarts good worth 'amount' or more """
-        results = db.session.query(Shopcart.user_id, label('total_amount', func.sum(Shopcart.price*Shopcart.quantity))).group_by(Shopcart.user_id).all();
-        users = []
-        for result in results:
-            #Shopcart.logger.info("Result "+ str(result.user_id) +"total_amount " + str(result.total_amount) + str(float(result.total_amount) >= float(amount)))
-            if float(result.total_amount) >= float(amount):
-                users.append(result.user_id)
+        return [total.user_id for total in Shopcart.find_totals_by_amount(amount)]
+
+    @staticmethod
+    def find_totals_by_amount(amount, sort=None, limit=None, after=None):
+        """
+        Finds the ShopcartTotals of the shopcarts worth 'amount' or more
+
+        Args:
+            amount (float): the smallest total value to return
+            sort (str): 'total_desc' for the most valuable shopcarts first,
+                otherwise the totals are ordered by user_id
+            limit (int): the maximum number of totals to return
+            after (tuple): the key the results start after, (user_id,) or
+                (total_price, user_id) when sorted by 'total_desc'
+        """
+        Shopcart.logger.info('Processing lookup for totals of %s or more', amount)
+        # A range scan of the maintained totals instead of aggregating every shopcart
+        query = ShopcartTotal.query.filter(ShopcartTotal.total_price >= float(amount),
+                                           ShopcartTotal.item_count > 0)
+        if sort == 'total_desc':
+            query = query.order_by(ShopcartTotal.total_price.desc(), ShopcartTotal.user_id)
+            if after is not None:
+                last_total, last_user_id = after
+                query = query.filter(or_(ShopcartTotal.total_price < last_total,
+                                         and_(ShopcartTotal.total_price == last_total,
+                                              ShopcartTotal.user_id > last_user_id)))
+        else:
+            query = query.order_by(ShopcartTotal.user_id)
+            if after is not None:
+                query = query.filter(ShopcartTotal.user_id > after[0])
+        if limit is not None:
+            query = query.limit(limit)
+        # Each shard is read by a thread of its own, with the session of that thread
+        shard_totals = db.shards.map(
+            lambda shard: query.with_session(db.session()).set_shard(shard).all())
+        if len(shard_totals) == 1:
+            return shard_totals[0]
+        if sort == 'total_desc':
+            key = lambda total: (-total.total_price, total.user_id)
+        else:
+            key = attrgetter('user_id')
+        return sorted((total for totals in shard_totals for total in totals), key=key)[:limit]
+
+    @staticmethod
+    def find_total(user_id):
+        """ Returns the ShopcartTotal of user <user_id> or None """
+        Shopcart.logger.info('Processing total lookup for id %s ...', user_id)
+        return ShopcartTotal.query.set_shard(db.shards.for_user(user_id)).get(user_id)
+
+    @staticmethod
+    def changes_since(after, limit):
+        """
+        Returns up to <limit> changes of the Shopcart entries, oldest first
+
+        The changes of a database are numbered as they are read, so a change
+        that commits after a reader went past it gets a later number and
+        can't be skipped. A reset stands for the delete of every entry, or
+        of the entries of the users up to its user_id, and the changes
+        before it can be dropped.
 
-        return users
+        Args:
+            after (tuple): the (seq, id) of the last change already read from
+                each shard, in the order of db.shards.all()
+            limit (int): the maximum number of changes to return
+        Returns:
+            tuple: the ShopcartChanges, and the positions to read the next ones after
+        """
+        Shopcart.logger.info('Processing changes after %s', after)
+        shards = db.shards.all()
+        positions = dict(zip(shards, after))
 
+        def changes_on(shard):
+            Shopcart._number_changes(shard)
+            last_seq, last_id = positions[shard]
+            return ShopcartChange.query.set_shard(shard) \
+                                 .filter(or_(ShopcartChange.seq > last_seq,
+                                             and_(ShopcartChange.seq == last_seq,
+                                                  ShopcartChange.id > last_id))) \
+                                 .order_by(ShopcartChange.seq, ShopcartChange.id).limit(limit).all()
+        shard_changes = db.shards.map(changes_on)
+        # Each shard keeps the order of its commits, and the shards are interleaved by time
+        merged = merge(*[[((change.changed_at, index, change.seq, change.id), shard, change)
+                          for change in changes]
+                         for index, (shard, changes) in enumerate(zip(shards, shard_changes))])
+        changes = []
+        for _, shard, change in merged:
+            if len(changes) == limit:
+                break
+            changes.append(change)
+            positions[shard] = (change.seq, change.id)
+        return changes, tuple(positions[shard] for shard in shards)
+
+
+######################################################################
+#  B U L K   W R I T E   M E T H O D S
+######################################################################
+    @staticmethod
+    def upsert_many(entries, chunk_size=500):
+        """
+        Adds many entries to the shopcarts, increasing the quantity of the
+        products that are already in a shopcart
+
+        Entries for the same product of the same user are merged, and the rest
+        are written as multi-row upserts with one transaction per chunk and
+        shard. Once a transaction fails, the later chunks of its shard are
+        left out, and those of the other shards are still written.
+
+        Args:
+            entries (list): dictionaries with the user_id, product_id, quantity and price of each entry
+            chunk_size (int): the number of entries written in each transaction
+        Returns:
+            int: the number of shopcart entries that were written
+        Raises:
+            PartialWriteError: some of the transactions failed after others
+                were committed, with the merged entries that were not written
+        """
+        merged = OrderedDict()
+        for entry in entries:
+            key = (entry['user_id'], entry['product_id'])
+            if key in merged:
+                merged[key]['quantity'] += entry['quantity']
+            else:
+                merged[key] = {'user_id': entry['user_id'],
+                               'product_id': entry['product_id'],
+                               'quantity': entry['quantity'],
+                               'price': entry['price']}
+        rows = list(merged.values())
+        Shopcart.logger.info('Processing upsert of %s Shopcart entries', len(rows))
+        Shopcart.sync_writes()
+        written = 0
+        unwritten = []
+        errors = OrderedDict()  # shard -> the error of its failed transaction
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            for shard, rows_of_shard in db.shards.split(chunk, itemgetter('user_id')).items():
+                if shard in errors:
+                    unwritten.extend(rows_of_shard)
+                    continue
+                try:
+                    Shopcart._upsert(rows_of_shard, shard=shard)
+                    Shopcart._log_changes([(row['user_id'], row['product_id']) for row in rows_of_shard],
+                                          shard)
+                    Shopcart._commit(set(row['user_id'] for row in rows_of_shard))
+                except Exception as error:
+                    db.session.rollback()
+                    Shopcart.logger.exception('Upsert of %s Shopcart entries failed', len(rows_of_shard))
+                    errors[shard] = error
+                    unwritten.extend(rows_of_shard)
+                    continue
+                written += len(rows_of_shard)
+        Shopcart._raise_partial_write(errors, written, unwritten,
+                                      'Upsert failed after {} Shopcart entries were written'.format(written))
+        return written
+
+    @staticmethod
+    def add(user_id, product_id, quantity, price):
+        """
+        Adds a quantity of a product to the shopcart of a user
+
+        The entry is created or its quantity increased by a single upsert
+        statement, so concurrent adds to the same entry are never lost
+
+        Returns:
+            Shopcart: the entry as it is after the add
+        """
+        Shopcart.logger.info('Processing add of %s of product id %s for user id %s',
+                             quantity, product_id, user_id)
+        row = {'user_id': user_id, 'product_id': product_id,
+               'quantity': quantity, 'price': price}
+        shard = db.shards.for_user(user_id)
+        Shopcart.sync_writes()
+        try:
+            entry = Shopcart._upsert([row], returning=True, shard=shard)[0]
+            Shopcart._log_changes([(user_id, product_id)], shard)
+            Shopcart._commit([user_id])
+        except Exception:
+            db.session.rollback()
+            raise
+        return Shopcart(user_id=entry.user_id, product_id=entry.product_id,
+                        quantity=entry.quantity, price=entry.price, version=entry.version)
+
+    @staticmethod
+    def _upsert(rows, returning=False, shard=None):
+        """
+        Inserts the rows, adding to the quantity of the ones that already exist
+
+        Args:
+            rows (list): dictionaries with the columns of the entries, all of users on <shard>
+        Returns:
+            list: the upserted rows as they are in the table when returning is True
+        """
+        table = Shopcart.__table__
+        dialect = db.session.get_bind(shard=shard).dialect.name
+        rows = [dict(row, version=1) for row in rows]
+        if dialect == 'postgresql':
+            statement = pg_insert(table).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.product_id],
+                set_={'quantity': table.c.quantity + statement.excluded.quantity,
+                      'version': table.c.version + 1})
+            if returning:
+                # Read the result back in the same round trip
+                return db.session.execute(statement.returning(*table.c), shard=shard).fetchall()
+            db.session.execute(statement, shard=shard)
+            return None
+        elif dialect in UPSERT_SQL:
+            db.session.execute(text(UPSERT_SQL[dialect].format(table=table.name)), rows, shard=shard)
+        else:
+            # No native upsert, so update the rows that exist and insert the rest
+            keys = set(db.session.query(Shopcart.user_id, Shopcart.product_id).set_shard(shard).filter(
+                or_(*[and_(Shopcart.user_id == row['user_id'],
+                           Shopcart.product_id == row['product_id']) for row in rows])))
+            updates = [{'b_user_id': row['user_id'], 'b_product_id': row['product_id'],
+                        'b_quantity': row['quantity']}
+                       for row in rows if (row['user_id'], row['product_id']) in keys]
+            inserts = [row for row in rows if (row['user_id'], row['product_id']) not in keys]
+            if updates:
+                db.session.execute(table.update()
+                                   .where(and_(table.c.user_id == bindparam('b_user_id'),
+                                               table.c.product_id == bindparam('b_product_id')))
+                                   .values(quantity=table.c.quantity + bindparam('b_quantity'),
+                                           version=table.c.version + 1),
+                                   updates, shard=shard)
+            if inserts:
+                db.session.execute(table.insert(), inserts, shard=shard)
+        if returning:
+            return db.session.execute(table.select().where(
+                or_(*[and_(table.c.user_id == row['user_id'],
+                           table.c.product_id == row['product_id']) for row in rows])),
+                                      shard=shard).fetchall()
+        return None
+
+    @staticmethod
+    def write_changes(changes):
+        """
+        Writes the saves and deletes of many entries in one transaction
+
+        Buffered changes are written whatever the version of the entry, so
+        the last change made wins. Each shard commits its own transaction.
+
+        Args:
+            changes (dict): the dictionary of the entry to save, or None to
+                delete it, for each (user_id, product_id)
+        Raises:
+            PartialWriteError: some of the shards failed after others were
+                committed, with the changes that were not written
+        """
+        Shopcart.logger.info('Processing group commit of %s Shopcart entries', len(changes))
+        written = 0
+        unwritten = OrderedDict()
+        errors = OrderedDict()
+        for shard, keys in db.shards.split(changes, itemgetter(0)).items():
+            try:
+                Shopcart._write_shard_changes(shard, keys, changes)
+            except Exception as error:
+                db.session.rollback()
+                Shopcart.logger.exception('Group commit of %s Shopcart entries failed', len(keys))
+                errors[shard] = error
+                unwritten.update((entry_key, changes[entry_key]) for entry_key in keys)
+                continue
+            written += len(keys)
+        Shopcart._raise_partial_write(errors, written, unwritten,
+                                      'Group commit failed after {} Shopcart entries were written'.format(written))
+
+    @staticmethod
+    def _write_shard_changes(shard, keys, changes):
+        """ Writes and commits the <changes> of the entries with <keys>, all of users on <shard> """
+        table = Shopcart.__table__
+        key = and_(table.c.user_id == bindparam('b_user_id'),
+                   table.c.product_id == bindparam('b_product_id'))
+        deletes = [{'b_user_id': user_id, 'b_product_id': product_id}
+                   for user_id, product_id in keys if changes[user_id, product_id] is None]
+        saves = [changes[entry_key] for entry_key in keys if changes[entry_key] is not None]
+        if deletes:
+            Shopcart._log_changes([(row['b_user_id'], row['b_product_id']) for row in deletes],
+                                  shard, deleted=True)
+            db.session.execute(table.delete().where(key), deletes, shard=shard)
+        if saves:
+            existing = set(db.session.query(Shopcart.user_id, Shopcart.product_id).set_shard(shard).filter(
+                or_(*[and_(Shopcart.user_id == row['user_id'],
+                           Shopcart.product_id == row['product_id']) for row in saves])))
+            updates = [{'b_user_id': row['user_id'], 'b_product_id': row['product_id'],
+                        'b_quantity': row['quantity'], 'b_price': row['price']}
+                       for row in saves if (row['user_id'], row['product_id']) in existing]
+            inserts = [dict(row, version=1) for row in saves
+                       if (row['user_id'], row['product_id']) not in existing]
+            if updates:
+                db.session.execute(table.update().where(key)
+                                   .values(quantity=bindparam('b_quantity'),
+                                           price=bindparam('b_price'),
+                                           version=table.c.version + 1),
+                                   updates, shard=shard)
+            if inserts:
+                db.session.execute(table.insert(), inserts, shard=shard)
+            Shopcart._log_changes([(row['user_id'], row['product_id']) for row in saves], shard)
+        Shopcart._commit(set(user_id for user_id, _ in keys))
+
+    @staticmethod
+    def _raise_partial_write(errors, written, unwritten, message):
+        """
+        Raises the error of the transaction that failed when none was
+        committed, or a PartialWriteError with <message> when some were
+
+        Args:
+            errors (dict): the error of each shard whose transaction failed
+        """
+        if not errors:
+            return
+        if not written:
+            raise errors.values()[0]
+        raise PartialWriteError('{}: {}'.format(message, errors.values()[0]), written, unwritten)
+
+    @staticmethod
+    def _commit(user_ids):
+        """ Brings the totals of the users up to date and commits the write """
+        db.session.flush()
+        Shopcart._refresh_totals(user_ids)
+        db.session.commit()
+        Shopcart.cache.invalidate(user_ids)
+        Shopcart.recent_writes.record(user_ids)
+
+    @staticmethod
+    def _refresh_totals(user_ids):
+        """ Recomputes the ShopcartTotal of the users from their shopcart entries """
+        now = datetime.utcnow()
+        for shard, shard_user_ids in db.shards.split(sorted(set(user_ids))).items():
+            Shopcart._refresh_shard_totals(shard, shard_user_ids, now)
+
+    @staticmethod
+    def _refresh_shard_totals(shard, user_ids, now):
+        """
+        Recomputes the ShopcartTotal of the users on <shard>
+
+        The totals rows are claimed and locked before the entries are
+        counted, so a concurrent write of the same user waits for this
+        transaction and then counts its entries along with its own
+        """
+        lines = Shopcart.__table__
+        totals = ShopcartTotal.__table__
+        dialect = db.session.get_bind(shard=shard).dialect.name
+        for start in range(0, len(user_ids), TOTALS_CHUNK_SIZE):
+            chunk = user_ids[start:start + TOTALS_CHUNK_SIZE]
+            Shopcart._claim_totals(chunk, now, shard, dialect)
+            if dialect != 'sqlite':
+                # SQLite has no row locks, its writes already wait for each other
+                db.session.execute(select([totals.c.user_id])
+                                   .where(totals.c.user_id.in_(chunk))
+                                   .order_by(totals.c.user_id)
+                                   .with_for_update(), shard=shard).fetchall()
+            # A statement of its own after the lock, so it counts the
+            # entries committed by the writes it waited for
+            item_count = select([func.count()]).where(lines.c.user_id == totals.c.user_id)
+            total_price = select([func.coalesce(func.sum(lines.c.price * lines.c.quantity), 0.0)]) \
+                          .where(lines.c.user_id == totals.c.user_id)
+            db.session.execute(totals.update()
+                               .where(totals.c.user_id.in_(chunk))
+                               .values(item_count=item_count.as_scalar(),
+                                       total_price=total_price.as_scalar(),
+                                       version=totals.c.version + 1,
+                                       last_modified=now),
+                               shard=shard)
+
+    @staticmethod
+    def _claim_totals(user_ids, now, shard, dialect):
+        """
+        Adds empty totals, at version 0, for the users with entries that
+        have none yet, leaving alone the ones another transaction is adding
+        """
+        lines = Shopcart.__table__
+        totals = ShopcartTotal.__table__
+        if dialect in CLAIM_TOTALS_SQL:
+            db.session.execute(text(CLAIM_TOTALS_SQL[dialect].format(totals=totals.name, lines=lines.name))
+                               .bindparams(bindparam('user_ids', expanding=True)),
+                               {'user_ids': user_ids, 'now': now}, shard=shard)
+            return
+        missing = select([lines.c.user_id,
+                          literal(0),
+                          literal(0.0),
+                          literal(0),
+                          literal(now, ShopcartTotal.last_modified.type)]) \
+                  .where(lines.c.user_id.in_(user_ids)) \
+                  .where(~exists().where(totals.c.user_id == lines.c.user_id)) \
+                  .group_by(lines.c.user_id)
+        columns = ['user_id', 'item_count', 'total_price', 'version', 'last_modified']
+        if dialect == 'postgresql':
+            statement = pg_insert(totals).from_select(columns, missing) \
+                                         .on_conflict_do_nothing(index_elements=[totals.c.user_id])
+        elif dialect == 'sqlite':
+            statement = totals.insert().prefix_with('OR IGNORE').from_select(columns, missing)
+        else:
+            # Without a way to skip the conflicts, two first writes of a user can still race
+            statement = totals.insert().from_select(columns, missing)
+        db.session.execute(statement, shard=shard)
+
+    @staticmethod
+    def _log_changes(keys, shard=None, deleted=False):
+        """
+        Appends the entries with the (user_id, product_id) <keys> to the change
+        log as they are after they were written, or before they are deleted
+        """
+        if not keys:
+            return
+        lines = Shopcart.__table__
+        # One statement run for every key, rather than an OR of them all
+        Shopcart._log_entries(and_(lines.c.user_id == bindparam('b_user_id'),
+                                   lines.c.product_id == bindparam('b_product_id')),
+                              shard, deleted,
+                              [{'b_user_id': user_id, 'b_product_id': product_id}
+                               for user_id, product_id in keys])
+
+    @staticmethod
+    def _log_entries(where=None, shard=None, deleted=False, params=None):
+        """ Appends the entries that match <where>, or every entry, to the change log with one statement """
+        lines = Shopcart.__table__
+        changes = ShopcartChange.__table__
+        if deleted:
+            operation = literal('delete', ShopcartChange.operation.type)
+        else:
+            # Written entries are new when they have their first version
+            operation = case([(lines.c.version == 1, 'add')], else_='update')
+        query = select([lines.c.user_id, lines.c.product_id, operation, lines.c.quantity,
+                        lines.c.price, lines.c.version, func.now()]) \
+                .order_by(lines.c.user_id, lines.c.product_id)
+        if where is not None:
+            query = query.where(where)
+        db.session.execute(changes.insert().from_select(
+            ['user_id', 'product_id', 'operation', 'quantity', 'price', 'version', 'changed_at'], query),
+                           params, shard=shard)
+
+    @staticmethod
+    def _log_reset(last_user_id=None, shard=None):
+        """
+        Appends a reset to the change log of <shard>, which stands for the
+        delete of every entry, or of the entries of the users up to <last_user_id>
+        """
+        db.session.execute(ShopcartChange.__table__.insert().values(changed_at=func.now()),
+                           {'user_id': last_user_id, 'operation': 'reset'}, shard=shard)
+
+    @staticmethod
+    def _number_changes(shard=None):
+        """
+        Gives the changes committed since the last read of the change log of
+        <shard> the next number of its ShopcartChangeSequence, and drops the
+        oldest changes beyond the last CHANGE_LOG_MAX_ROWS
+
+        Returns:
+            int: the number the changes were given
+        """
+        counter = ShopcartChangeSequence.__table__
+        changes = ShopcartChange.__table__
+        # A transaction of its own on the primary, so the numbers stay even
+        # when the changes are then read from the replica
+        with db.get_engine(app, shard).begin() as connection:
+            # Only the readers of the log lock the row of the counter, so they
+            # number the changes one after the other and the writers never wait
+            connection.execute(counter.update().values(last_seq=counter.c.last_seq + 1))
+            seq = connection.execute(select([counter.c.last_seq])).scalar()
+            # The changes of the transactions that have not committed are not
+            # visible yet, and get a later number from a later read
+            connection.execute(changes.update().where(changes.c.seq == None).values(seq=seq))
+            keep = app.config['CHANGE_LOG_MAX_ROWS']
+            if keep:
+                newest = select([func.max(changes.c.id)]).as_scalar()
+                connection.execute(changes.delete().where(and_(changes.c.seq < seq,
+                                                               changes.c.id <= newest - keep)))
+        return seq
+
+    @staticmethod
+    def _clear_totals(last_user_id=None, shard=None):
+        """ Empties the totals of every user on <shard>, or of the users up to <last_user_id> """
+        totals = ShopcartTotal.__table__
+        statement = totals.update().values(item_count=0, total_price=0.0,
+                                           version=totals.c.version + 1,
+                                           last_modified=datetime.utcnow())
+        if last_user_id is not None:
+            statement = statement.where(totals.c.user_id <= last_user_id)
+        db.session.execute(statement, shard=shard)
+
+    @staticmethod
+    def rebuild_totals():
+        """ Recomputes the ShopcartTotal of every user, e.g. after the table was first created """
+        Shopcart.logger.info('Rebuilding shopcart totals')
+        # Refresh rather than recreate the totals so their versions keep increasing
+        user_ids = set(Shopcart.list_users())
+        for shard in db.shards.all():
+            user_ids.update(total.user_id for total
+                            in db.session.query(ShopcartTotal.user_id).set_shard(shard))
+        Shopcart._refresh_totals(user_ids)
+        db.session.commit()
+        Shopcart.cache.clear()
 
 ######################################################################
 #  S T A T I C   D A T A B A S E   M E T H O D S
 ######################################################################
     @staticmethod
-    def remove_all():
-        """ Removes all entries in shopcarts for all users from the database """
-        db.session.query(Shopcart).delete()
+    def remove_by_user(user_id):
+        """
+        Removes every entry in the shopcart of user <user_id> with a single delete
+
+        Returns:
+            int: the number of entries that were removed
+        """
+        Shopcart.logger.info('Processing delete of shopcart of user id %s', user_id)
+        lines = Shopcart.__table__
+        shard = db.shards.for_user(user_id)
+        Shopcart.sync_writes()
+        try:
+            Shopcart._log_entries(lines.c.user_id == user_id, shard, deleted=True)
+            # A Core delete, since the bulk deletes of the ORM can't be sent to a shard
+            count = db.session.execute(lines.delete().where(lines.c.user_id == user_id),
+                                       shard=shard).rowcount
+            Shopcart._commit([user_id])
+        except Exception:
+            db.session.rollback()
+            raise
+        return count
+
+    @staticmethod
+    def remove_all(chunk_size=None):
+        """
+        Removes all entries in shopcarts for all users from the database
+
+        Args:
+            chunk_size (int): when given, delete about this many entries per
+                transaction instead of emptying the table in one go
+        Raises:
+            PartialWriteError: some of the shards failed after the others were
+                emptied, with the shards that were and the ones that weren't
+        """
+        Shopcart.sync_writes()
+
+        def remove_from(shard):
+            try:
+                Shopcart._remove_all_from(shard, chunk_size)
+            except Exception as error:
+                db.session.rollback()
+                Shopcart.logger.exception('Removal of the Shopcarts on shard %s failed', shard)
+                return error
+            return None
+        # Cleared even on failure since a chunked removal commits as it goes
+        try:
+            results = db.shards.map(remove_from)
+        finally:
+            Shopcart.cache.clear()
+            # Every shopcart changed, so only the client's cookie can tell
+            Shopcart.recent_writes.record([])
+        errors = OrderedDict((shard, error) for shard, error in zip(db.shards.all(), results)
+                             if error is not None)
+        emptied = [shard for shard in db.shards.all() if shard not in errors]
+        Shopcart._raise_partial_write(errors, emptied, list(errors),
+                                      'Removal failed on shards {}'.format(', '.join(str(shard) for shard in errors)))
+
+    @staticmethod
+    def _remove_all_from(shard, chunk_size=None):
+        """ Removes all entries on <shard> """
+        # Deleted with Core statements, since the bulk deletes of the ORM can't be sent to a shard
+        if chunk_size:
+            Shopcart._remove_all_in_chunks(chunk_size, shard)
+            return
+        lines = Shopcart.__table__
+        dialect = db.session.get_bind(shard=shard).dialect.name
+        Shopcart._log_reset(shard=shard)
+        if dialect in TRUNCATE_SQL:
+            # Empties the table without logging and locking every row
+            db.session.execute(text(TRUNCATE_SQL[dialect].format(table=lines.name)), shard=shard)
+        else:
+            db.session.execute(lines.delete(), shard=shard)
+        # The totals are kept so the versions of the shopcarts keep increasing,
+        # and cleared in the same transaction so they never outlive the entries
+        Shopcart._clear_totals(shard=shard)
         db.session.commit()
 
+    @staticmethod
+    def _remove_all_in_chunks(chunk_size, shard=None):
+        """ Removes all entries a range of users at a time, so no transaction grows too large """
+        lines = Shopcart.__table__
+        while True:
+            # The user_id that is chunk_size entries into the table
+            last_user_id = db.session.query(Shopcart.user_id).set_shard(shard) \
+                                     .order_by(Shopcart.user_id) \
+                                     .offset(chunk_size - 1).limit(1).scalar()
+            statement = lines.delete()
+            if last_user_id is not None:
+                statement = statement.where(lines.c.user_id <= last_user_id)
+            Shopcart._log_reset(last_user_id, shard)
+            db.session.execute(statement, shard=shard)
+            Shopcart._clear_totals(last_user_id, shard)
+            db.session.commit()
+            if last_user_id is None:
+                break
+
 
     @staticmethod
     def all():
         """ Returns all of the Shopcarts in the database """
         Shopcart.logger.info('Processing all Shopcarts')
-        return Shopcart.query.all()
+        return [shopcart for shopcarts in db.shards.map(lambda shard: Shopcart.query.set_shard(shard).all())
+                for shopcart in shopcarts]
 
 
 ######################################################################
@@ -164,3 +1096,114 @@ class Shopcart(db.Model):
         """ Initializes the database session """
         Shopcart.logger.info('Initializing database')
         db.create_all()  # make our sqlalchemy tables
+        for shard in db.shards.all():
+            Shopcart._upgrade_schema(shard)
+        # A database from before the totals were kept has shopcarts without them
+        if not all(db.shards.map(lambda shard: db.session.query(ShopcartTotal.user_id)
+                                               .set_shard(shard).first())):
+            Shopcart.rebuild_totals()
+
+    @staticmethod
+    def _upgrade_schema(shard=None):
+        """ Adds the columns that create_all() leaves out of a table made by an older release """
+        engine = db.get_engine(app, shard)
+        columns = [column['name'] for column in inspect(engine).get_columns(Shopcart.__tablename__)]
+        if 'version' not in columns:
+            Shopcart.logger.info('Adding the version column to %s', Shopcart.__tablename__)
+            engine.execute(text('ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1'
+                                .format(table=Shopcart.__tablename__)))
+
+class ShopcartChange(db.Model):
+    """
+    Class that represents a change of a Shopcart entry in the change log
+
+    A row is appended for every entry added, updated or deleted by the write
+    methods of Shopcart, in the same transaction as the write. remove_all()
+    appends a single reset instead, with the user_id of the last user whose
+    entries were removed, or None when every entry was. The changes get a
+    seq when the log is read, the same one for every change committed by
+    then, and the id orders the changes of a seq. A reader of the log keeps
+    the (seq, id) of the last change it read to carry on from there. The
+    changed_at time is from the clock of the database.
+
+    The log keeps the last CHANGE_LOG_MAX_ROWS changes of each database, so
+    a reader that falls further behind misses the changes that were dropped.
+    """
+
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer)           # None for a reset of every user
+    product_id = db.Column(db.Integer)        # None for a reset
+    operation = db.Column(db.String(6), nullable=False)    # add, update, delete or reset
+    quantity = db.Column(db.Integer)
+    price = db.Column(db.Float)
+    version = db.Column(db.Integer)
+    changed_at = db.Column(db.DateTime, nullable=False)
+    seq = db.Column(db.Integer, index=True)      # None until the change is read
+
+    # SQLite would reuse the ids of the last rows if they were deleted
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def serialize(self):
+        """ Serializes a change into a dictionary """
+        return {"user_id": self.user_id,
+                "product_id": self.product_id,
+                "operation": self.operation,
+                "quantity": self.quantity,
+                "price": self.price,
+                "version": self.version,
+                "changed_at": self.changed_at.isoformat()}
+
+def log_flushed_change(operation):
+    """ Returns the mapper event listener that logs the Shopcart entries flushed by the ORM """
+    def log(mapper, connection, shopcart):
+        # The connection of the flush, so the change is in the same transaction
+        connection.execute(ShopcartChange.__table__.insert().values(changed_at=func.now()),
+                           user_id=shopcart.user_id, product_id=shopcart.product_id,
+                           operation=operation, quantity=shopcart.quantity, price=shopcart.price,
+                           version=shopcart.version)
+    return log
+
+event.listen(Shopcart, 'after_insert', log_flushed_change('add'))
+event.listen(Shopcart, 'after_update', log_flushed_change('update'))
+event.listen(Shopcart, 'after_delete', log_flushed_change('delete'))
+
+
+class ShopcartChangeSequence(db.Model):
+    """
+    Class that represents the counter that numbers the reads of the change
+    log, a single row created along with the table
+    """
+
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    last_seq = db.Column(db.Integer, nullable=False)
+
+event.listen(ShopcartChangeSequence.__table__, 'after_create',
+             DDL('INSERT INTO %(table)s (id, last_seq) VALUES (1, 0)'))
+
+
+class ShopcartTotal(db.Model):
+    """
+    Class that represents the totals of the Shopcart of a User
+
+    A row is kept for every user that ever had a product in their shopcart,
+    with an item_count of 0 once the shopcart is emptied. It is only written
+    by the write methods of Shopcart, and every write increases the version
+    of the shopcart.
+    """
+
+    # Table Schema
+    user_id = db.Column(db.Integer, primary_key=True)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    total_price = db.Column(db.Float, nullable=False, default=0.0, index=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    last_modified = db.Column(db.DateTime)
+
+    def serialize(self):
+        """ Serializes the totals of a Shopcart into a dictionary """
+        return {"user_id": self.user_id,
+                "item_count": self.item_count,
+                "total_price": round(self.total_price, 2),
+                "version": self.version,
+                "last_modified": self.last_modified.isoformat() if self.last_modified else None}
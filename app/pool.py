@@ -0,0 +1,135 @@
+# Copyright 2016, 2017 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Connection Pool for Shopcart Service
+
+Sizes the database connection pool from the settings read by
+get_pool_options() and measures how long requests wait for a connection.
+The sessions route the reads to the replica, see app/replica.py, and the
+statements of each shard to its bind, see app/sharding.py.
+
+SQLite databases keep the pool chosen by Flask-SQLAlchemy, because they
+do not take the queue pool settings.
+"""
+import threading
+import time
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import exc, orm
+from sqlalchemy.pool import QueuePool
+from .replica import RoutingSession
+from .sharding import Shards, ShardQuery
+
+class PoolStats(object):
+    """ Counters of the connection checkouts of the pool """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Sets every counter back to zero """
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def record(self, wait_time, timed_out=False):
+        """ Counts a checkout that waited <wait_time> seconds for a connection """
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def stats(self):
+        """ Returns the counters as a dictionary with the wait times in milliseconds """
+        with self._lock:
+            waits = self.checkouts + self.timeouts
+            return {'checkouts': self.checkouts,
+                    'timeouts': self.timeouts,
+                    'wait_ms_total': round(self.wait_time * 1000, 3),
+                    'wait_ms_avg': round(self.wait_time * 1000 / waits, 3) if waits else 0.0,
+                    'wait_ms_max': round(self.max_wait_time * 1000, 3)}
+
+# Shared by every pool of the process, so the counters survive the pool
+# being recreated after the database drops its connections
+pool_stats = PoolStats()
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that records how long each checkout waited for a connection """
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            pool_stats.record(time.time() - start, timed_out=True)
+            raise
+        pool_stats.record(time.time() - start)
+        return connection
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy that creates its engines with the DATABASE_POOL_OPTIONS of
+    the app, and the tables on the SHARD_BINDS as well as the default bind
+    """
+
+    def __init__(self, app=None, **kwargs):
+        kwargs.setdefault('query_class', ShardQuery)
+        self.shards = Shards()
+        super(PooledSQLAlchemy, self).__init__(app, **kwargs)
+
+    def init_app(self, app):
+        self.shards = Shards(app.config.get('SHARD_BINDS'), self.session)
+        super(PooledSQLAlchemy, self).init_app(app)
+
+    def create_all(self, bind='__all__', app=None):
+        super(PooledSQLAlchemy, self).create_all(bind, app)
+        for shard in self._shard_binds(bind):
+            self.Model.metadata.create_all(self.get_engine(self.get_app(app), shard))
+
+    def drop_all(self, bind='__all__', app=None):
+        super(PooledSQLAlchemy, self).drop_all(bind, app)
+        for shard in self._shard_binds(bind):
+            self.Model.metadata.drop_all(self.get_engine(self.get_app(app), shard))
+
+    def _shard_binds(self, bind):
+        # The models have no bind of their own, so only the default bind gets their tables
+        if bind == '__all__':
+            return self.shards.binds
+        binds = bind if isinstance(bind, list) else [bind]
+        return [shard for shard in binds if shard in self.shards.binds]
+
+    def apply_driver_hacks(self, app, info, options):
+        pool_options = app.config.get('DATABASE_POOL_OPTIONS')
+        if pool_options and not info.drivername.startswith('sqlite'):
+            options.update(pool_options)
+            options.setdefault('poolclass', TimedQueuePool)
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+def pool_status(pool):
+    """ Returns the in use and idle connections of <pool> with the checkout counters """
+    status = {'pool': pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        status.update({'size': pool.size(),
+                       'in_use': pool.checkedout(),
+                       'idle': pool.checkedin(),
+                       'overflow': pool.overflow()})
+    status.update(pool_stats.stats())
+    return status
@@ -0,0 +1,151 @@
+# Copyright 2016, 2017 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+SQL Profiling for Shopcart Service
+
+Times every statement sent to the database through the SQLAlchemy cursor
+events, adds up the number of statements and the time spent on them in each
+request, and logs the statements slower than <slow_query_ms> together with
+the Shopcart finder that ran them
+
+The statements a request runs on other threads, like the queries of every
+shard, are counted when the function they run in is wrapped by propagate()
+"""
+import os
+import sys
+import time
+import threading
+import weakref
+from functools import wraps
+from flask import g, has_request_context
+from sqlalchemy import event
+
+# Longest parameter list written to the slow query log
+MAX_PARAMETERS_LENGTH = 500
+# Source of the Shopcart model, without the .py or .pyc extension
+MODEL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model')
+
+class RequestCounters(object):
+    """ The number of statements run by a request and the seconds spent on them """
+
+    def __init__(self):
+        self.queries = 0
+        self.time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, elapsed):
+        """ Counts a statement that took <elapsed> seconds, from any thread """
+        with self._lock:
+            self.queries += 1
+            self.time += elapsed
+
+class QueryProfiler(object):
+    """ Counts and times the SQL statements run by each request """
+
+    def __init__(self, logger, slow_query_ms=None):
+        self.logger = logger
+        self.slow_query_ms = slow_query_ms
+        self._engines = weakref.WeakSet()
+        # The counters of the request a worker thread is running statements for
+        self._local = threading.local()
+
+    def install(self, engine):
+        """ Starts timing the statements run on <engine> """
+        if engine in self._engines:
+            return
+        self._engines.add(engine)
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def uninstall(self, engine):
+        """ Stops timing the statements run on <engine> """
+        if engine not in self._engines:
+            return
+        self._engines.discard(engine)
+        event.remove(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.remove(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    @staticmethod
+    def start_request():
+        """ Sets the statement counters of the current request to zero """
+        g.db_counters = RequestCounters()
+
+    @staticmethod
+    def request_totals():
+        """ Returns the number of statements and the seconds spent on them in the current request """
+        counters = getattr(g, 'db_counters', None)
+        if counters is None:
+            return 0, 0.0
+        return counters.queries, counters.time
+
+    def propagate(self, func):
+        """
+        Returns <func> wrapped to count its statements in the current
+        request when it is called on another thread, or <func> itself
+        outside of a request
+        """
+        counters = self._counters()
+        if counters is None:
+            return func
+
+        @wraps(func)
+        def counted(*args, **kwargs):
+            self._local.counters = counters
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.counters = None
+        return counted
+
+    def _counters(self):
+        """ Returns the counters of the request the current thread runs statements for, or None """
+        counters = getattr(self._local, 'counters', None)
+        if counters is None and has_request_context():
+            counters = getattr(g, 'db_counters', None)
+        return counters
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.time() - conn.info['query_started'].pop()
+        counters = self._counters()
+        if counters is not None:
+            counters.add(elapsed)
+        if self.slow_query_ms is not None and elapsed * 1000 >= self.slow_query_ms:
+            params = repr(parameters)
+            if len(params) > MAX_PARAMETERS_LENGTH:
+                params = params[:MAX_PARAMETERS_LENGTH] + '...'
+            self.logger.warning('Slow query (%.1f ms) from %s: %s with %s',
+                                elapsed * 1000, calling_finder(), statement, params)
+
+def calling_finder():
+    """ Returns the Shopcart method that the running statement was issued from """
+    frame = sys._getframe(1)
+    finder = None
+    while frame is not None:
+        if os.path.splitext(os.path.abspath(frame.f_code.co_filename))[0] == MODEL_FILE:
+            frame_locals = frame.f_locals
+            if 'cls' in frame_locals:
+                owner = frame_locals['cls'].__name__
+            elif 'self' in frame_locals:
+                owner = type(frame_locals['self']).__name__
+            else:
+                owner = 'Shopcart'    # the static finders of the model are all on Shopcart
+            finder = '{}.{}'.format(owner, frame.f_code.co_name)
+        elif finder is not None:
+            # The outermost model frame is the finder called by the service
+            break
+        frame = frame.f_back
+    return finder or 'unknown'
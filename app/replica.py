@@ -0,0 +1,127 @@
+# Copyright 2016, 2017 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Read Replica Routing for Shopcart Service
+
+GET requests read from one of the replica binds when any are configured,
+unless they could miss a recent write of their own. Each request reads from
+a replica picked at random, so the reads are spread over all of them. A
+replica lags behind the primary database, so for <window> seconds after a
+write:
+  - the shopcart of the users that were written is read from the primary
+    by the worker that wrote it
+  - the client that made the write is read from the primary by every
+    worker, through the cookie set on the response of the write
+
+The replica is only read when the shopcarts are not sharded.
+"""
+import random
+import threading
+import time
+from flask import g, request, has_request_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy.orm.attributes import instance_state
+from .sharding import identity_user_id
+
+# Cookie holding the time of the last write made by a client
+LAST_WRITE_COOKIE = 'shopcart_last_write'
+# Number of users remembered before the expired writes are dropped
+PRUNE_SIZE = 10000
+
+class RecentWrites(object):
+    """ Remembers which users were written in the last <window> seconds """
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self._writes = {}    # user_id -> time of the last write
+        self._lock = threading.Lock()
+
+    def record(self, user_ids):
+        """ Notes a write to the shopcarts of <user_ids> """
+        now = time.time()
+        with self._lock:
+            for user_id in user_ids:
+                self._writes[user_id] = now
+            if len(self._writes) > PRUNE_SIZE:
+                expired = now - self.window
+                self._writes = dict((user_id, written) for user_id, written
+                                    in self._writes.items() if written > expired)
+        if has_request_context():
+            g.wrote_to_primary = True
+
+    def wrote_recently(self, user_id):
+        """ Returns True when the shopcart of <user_id> was written in the last <window> seconds """
+        written = self._writes.get(user_id)
+        return written is not None and written > time.time() - self.window
+
+    def clear(self):
+        """ Forgets every write """
+        with self._lock:
+            self._writes = {}
+
+def replica_binds(count):
+    """ Returns the names of the binds of <count> replicas """
+    return ['replica{}'.format(number) for number in range(count)]
+
+def pick_replica(app):
+    """ Returns the bind of the replica a request reads from """
+    return random.choice(app.config['REPLICA_BINDS'])
+
+def reads_from_replica(app, recent_writes):
+    """ Returns True when the current request can read from the replica """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if not app.config.get('REPLICA_BINDS'):
+        return False
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        last_write = 0
+    if last_write > time.time() - recent_writes.window:
+        return False
+    user_id = (request.view_args or {}).get('user_id')
+    return user_id is None or not recent_writes.wrote_recently(user_id)
+
+def mark_client_write(response, recent_writes):
+    """ Sets the cookie that sends the next reads of a client that just wrote to the primary """
+    if getattr(g, 'wrote_to_primary', False):
+        response.set_cookie(LAST_WRITE_COOKIE, repr(time.time()),
+                            max_age=int(recent_writes.window) + 1)
+    return response
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends the statements of a shard to its bind, and the
+    queries of replica reads to the replica bind
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+        if db.shards.binds:
+            # Used by the flush to pick the connection of each instance
+            self.connection_callable = self._shard_connection
+
+    def _shard_connection(self, mapper=None, instance=None):
+        user_id = identity_user_id(instance_state(instance))
+        return self.connection(mapper, shard=self.db.shards.for_user(user_id))
+
+    def get_bind(self, mapper=None, clause=None, shard=None):
+        if shard is not None:
+            return self.db.get_engine(self.app, bind=shard)
+        # Anything flushed is a write, which always goes to the primary
+        replica = getattr(g, 'replica_bind', None) if has_request_context() else None
+        if not self._flushing and replica is not None:
+            return self.db.get_engine(self.app, bind=replica)
+        return super(RoutingSession, self).get_bind(mapper, clause)
@@ -0,0 +1,138 @@
+# Copyright 2016, 2017 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+JSON Serializers for Shopcart Service
+
+ModelEncoder turns rows straight into JSON text with the fields of a
+flask_restplus model. The model is compiled once into a string template and
+one converter per field, instead of being walked field by field for every row
+as marshal() does.
+
+encode_with() replaces marshal_with() on a resource method. It documents the
+response in Swagger the same way, and falls back to marshal() when a request
+asks for a field mask in the X-Fields header.
+
+Setting JSON_BACKEND to 'ujson' encodes the fields that have no converter
+of their own, such as Raw and String fields, with ujson when it is installed.
+"""
+import json
+from functools import wraps
+from flask import Response, request
+from flask_restplus import fields, marshal
+from flask_restplus.utils import merge, unpack
+from werkzeug.wrappers import BaseResponse
+from . import app
+
+def select_json_backend(name):
+    """ Returns the dumps function of the JSON library called <name>, or of the json module """
+    if name == 'ujson':
+        try:
+            import ujson
+            return ujson.dumps
+        except ImportError:
+            app.logger.warning('ujson is not installed, using the json module')
+    return json.dumps
+
+dumps = select_json_backend(app.config['JSON_BACKEND'])
+
+def encode_integer(value):
+    return 'null' if value is None else str(int(value))
+
+def encode_float(value):
+    # Same text as json.dumps, which writes floats with repr()
+    return 'null' if value is None else repr(float(value))
+
+def encode_boolean(value):
+    return 'null' if value is None else ('true' if value else 'false')
+
+def encode_raw(value):
+    return dumps(value)
+
+class ModelEncoder(object):
+    """
+    Encodes rows as JSON objects holding the fields of <model>
+
+    <model> is a flask_restplus model or any mapping of names to fields.
+    Rows are mappings, and the fields they do not have are written as null.
+    """
+
+    def __init__(self, model):
+        self.keys = list(model.keys())
+        self._converters = [compile_field(field) for field in model.values()]
+        self._template = '{' + ', '.join('{}: %s'.format(json.dumps(key).replace('%', '%%'))
+                                         for key in self.keys) + '}'
+
+    def encode(self, row):
+        """ Returns the JSON text of one row """
+        get = row.get
+        return self._template % tuple([convert(get(key)) for key, convert
+                                       in zip(self.keys, self._converters)])
+
+    def encode_list(self, rows):
+        """ Returns the JSON text of a list of rows """
+        return '[' + ', '.join([self.encode(row) for row in rows]) + ']'
+
+def compile_field(field):
+    """ Returns the function that writes the values of <field> as JSON text """
+    if isinstance(field, type):
+        field = field()
+    # Float and Integer before Raw, as every field is a Raw
+    if isinstance(field, fields.Float):
+        return encode_float
+    if isinstance(field, fields.Integer):
+        return encode_integer
+    if isinstance(field, fields.Boolean):
+        return encode_boolean
+    if isinstance(field, fields.Nested):
+        nested = ModelEncoder(field.nested)
+        return lambda value: 'null' if value is None else nested.encode(value)
+    if isinstance(field, fields.List):
+        convert = compile_field(field.container)
+        return lambda values: 'null' if values is None else \
+            '[' + ', '.join([convert(value) for value in values]) + ']'
+    return encode_raw
+
+def json_response(body, code=200, headers=None):
+    """ Returns a response holding the JSON text <body> """
+    return Response(body, status=code, headers=headers, mimetype='application/json')
+
+def encode_with(model, as_list=False, code=200, description=None):
+    """
+    Decorates a resource method whose return value is encoded with <model>
+
+    The method returns its data, or a tuple with the data, status code and
+    headers, as with marshal_with(). Responses it builds itself are passed on.
+    """
+    encoder = ModelEncoder(model)
+
+    def wrapper(func):
+        # The same documentation as Namespace.marshal_with()
+        doc = {'responses': {code: (description, [model]) if as_list else (description, model)},
+               '__mask__': True}
+        func.__apidoc__ = merge(getattr(func, '__apidoc__', {}), doc)
+
+        @wraps(func)
+        def encoded(*args, **kwargs):
+            resp = func(*args, **kwargs)
+            if isinstance(resp, BaseResponse):
+                return resp
+            data, status_code, headers = unpack(resp)
+            mask = request.headers.get(app.config['RESTPLUS_MASK_HEADER'])
+            if mask:
+                # Field masks are rare, so they keep the slower marshal()
+                return marshal(data, model, mask=mask), status_code, headers
+            body = encoder.encode_list(data) if as_list else encoder.encode(data)
+            return json_response(body, status_code, headers)
+        return encoded
+    return wrapper
@@ -12,17 +12,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import sys
+import math
+import time
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, stream_with_context, g
 from flask_api import status    # HTTP Status Codes
 from flask_restplus import Api, Resource, fields
+from collections import OrderedDict
 import json
+import base64
+from itertools import groupby
+from operator import attrgetter
 from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag, unquote_etag
 
-from model import Shopcart, DataValidationError, DatabaseConnectionError
+from model import Shopcart, ShopcartTotal, DataValidationError, DatabaseConnectionError, ConcurrentUpdateError, \
+                  WriteBehindError, PartialWriteError
 
 # Import Flask application
-from . import app
+from . import app, db
+from .pool import pool_status
+from .metrics import RequestMetrics
+from .profiling import QueryProfiler
+from .logs import request_log_handlers
+from .serializers import ModelEncoder, encode_with, json_response
+from .replica import reads_from_replica, pick_replica, mark_client_write
+
+# Number of rows fetched per round trip when streaming the shopcart listing
+STREAM_BATCH_SIZE = 1000
+# Largest page that can be requested with the limit parameter
+MAX_PAGE_SIZE = 1000
+# Number of shopcart entries written per transaction by the batch endpoint
+BATCH_CHUNK_SIZE = 500
+# Number of changes returned by the change feed when no limit is asked for
+CHANGES_PAGE_SIZE = 100
+
+# Request counts and latencies reported by /metrics
+metrics = RequestMetrics(app.config['METRICS_DIR'])
+# Statement counts and times of each request, and the slow query log
+profiler = QueryProfiler(app.logger, app.config['SLOW_QUERY_MS'] or None)
 
 
 ######################################################################
@@ -68,6 +96,39 @@ shopcart_model = api.model('Shopcart', {
                                 description='Cost of one item of the product')
 }, mask='user_id, product_id, quantity, price')
 
+change_model = api.model('ShopcartChange', {
+    'user_id': fields.Integer(description='The unique id of the user, or of the last user removed by a reset'),
+    'product_id': fields.Integer(description='The unique id of the product'),
+    'operation': fields.String(description='add, update, delete, or reset for the removal of every entry '
+                                           'or of the entries of the users up to user_id'),
+    'quantity': fields.Integer(description='The quantity of the product after the change, or before a delete'),
+    'price': fields.Float(description='Cost of one item of the product'),
+    'version': fields.Integer(description='The version of the entry after the change, or before a delete'),
+    'changed_at': fields.String(description='When the change was made, in UTC')
+})
+
+change_feed_model = api.model('ShopcartChanges', {
+    'changes': fields.List(fields.Nested(change_model), description='The changes, oldest first'),
+    'cursor': fields.String(description='The since parameter to read the next changes with')
+})
+
+# Fields of the responses that are not documented as models, for their encoders
+product_fields = OrderedDict([('product_id', fields.Integer),
+                              ('price', fields.Float),
+                              ('quantity', fields.Integer)])
+shopcart_products_fields = OrderedDict([('user_id', fields.Integer),
+                                        ('products', fields.List(fields.Nested(product_fields)))])
+shopcart_total_fields = OrderedDict([('products', fields.List(fields.Nested(shopcart_model))),
+                                     ('total_price', fields.Float)])
+shopcart_summary_fields = OrderedDict([('user_id', fields.Integer),
+                                       ('item_count', fields.Integer),
+                                       ('total_price', fields.Float),
+                                       ('version', fields.Integer),
+                                       ('last_modified', fields.String)])
+shopcart_products_encoder = ModelEncoder(shopcart_products_fields)
+shopcart_total_encoder = ModelEncoder(shopcart_total_fields)
+shopcart_summary_encoder = ModelEncoder(shopcart_summary_fields)
+
 ######################################################################
 # Special Error Handlers
 ######################################################################
@@ -81,6 +142,33 @@ def database_connection_error(error):
 
 
 
+@api.errorhandler(ConcurrentUpdateError)
+def concurrent_update_error(error):
+    """ Handles updates of entries that were changed by another request """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return {'status':412, 'error': 'Precondition Failed', 'message': message}, 412
+
+
+
+@api.errorhandler(PartialWriteError)
+def partial_write_error(error):
+    """ Handles writes that were only committed on some of the shards """
+    message = error.message or str(error)
+    app.logger.error(message)
+    return {'status':500, 'error': 'Server Error', 'message': message}, 500
+
+
+
+@api.errorhandler(WriteBehindError)
+def write_behind_error(error):
+    """ Handles writes turned away while the buffered writes can't be committed """
+    message = error.message or str(error)
+    app.logger.error(message)
+    return {'status':503, 'error': 'Service Unavailable', 'message': message}, 503
+
+
+
 @api.errorhandler(DataValidationError)
 def request_validation_error(error):
     """ Handles Value Errors from bad data """
@@ -100,6 +188,29 @@ def healthcheck():
     return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
 
 ######################################################################
+# GET CART CACHE STATISTICS
+######################################################################
+@app.route('/healthcheck/cache')
+def cache_stats():
+    """ Reports the hit, miss and eviction counters of the cart cache """
+    return make_response(jsonify(Shopcart.cache.stats()), status.HTTP_200_OK)
+
+######################################################################
+# GET CONNECTION POOL STATISTICS
+######################################################################
+@app.route('/healthcheck/pool')
+def pool_stats():
+    """ Reports the in use and idle connections and the checkout wait times of the pool """
+    return make_response(jsonify(pool_status(db.engine.pool)), status.HTTP_200_OK)
+
+######################################################################
+# GET REQUEST METRICS
+######################################################################
+@app.route('/metrics')
+def request_metrics():
+    """ Reports the request counts and latencies in the Prometheus text format """
+    return Response(metrics.render(), status=status.HTTP_200_OK,
+                    mimetype='text/plain; version=0.0.4')
 
 ######################################################################
 #  PATH: /shopcarts/{user_id}
@@ -121,23 +232,34 @@ class ShopcartResource(Resource):
     #################################################################
     @ns.doc('get_shopcart_list')
     @ns.response(200, 'Success')
+    @ns.response(304, 'Shopcart not modified since the version in If-None-Match')
+    @ns.response(400, 'The paging parameters were not valid')
     @ns.response(404, 'Shopcart not found')
-    @ns.marshal_list_with(shopcart_model)
+    @ns.param('limit', 'Maximum number of products to return in one page')
+    @ns.param('cursor', 'Opaque cursor taken from the next link of the previous page')
+    @encode_with(shopcart_model, as_list=True)
     def get(self, user_id):
        """ Get the shopcart entry for user (user_id)
        This endpoint will show the list of products in user's shopcart from the database
        """
        app.logger.info("Request to get the list of the product in a user [%s]'s shopcart", user_id)
-       shopcarts = []
-       shopcarts = Shopcart.findByUserId(user_id)
-       print(shopcarts.count())
-       #if not shopcarts:
-           #api.abort(status.HTTP_404_NOT_FOUND, "Shopcart with user_id '{}' was not found.".format(user_id))
-       if shopcarts.count() == 0:
+       limit, after = get_page_args()
+       if limit is not None:
+           shopcarts, headers = fetch_page(ShopcartResource, limit, after, user_id=user_id)
+           if not shopcarts and after is None:
+               api.abort(status.HTTP_404_NOT_FOUND, "Shopcart with user_id '{}' was not found.".format(user_id))
+           return shopcarts, status.HTTP_200_OK, headers
+
+       version, etag = not_modified_etag(user_id)
+       if etag:
+           return [], status.HTTP_304_NOT_MODIFIED, {'ETag': etag}
+
+       # The version comes from the database, the entries from the cache
+       # only if they are still at that version
+       version, shopcarts = Shopcart.find_versioned_cart(user_id, version)
+       if not shopcarts:
            api.abort(status.HTTP_404_NOT_FOUND, "Shopcart with user_id '{}' was not found.".format(user_id))
-           #raise NotFound("Shopcart with user_id '{}' was not found.".format(user_id))
-       results = [shopcart.serialize() for shopcart in shopcarts]
-       return results, status.HTTP_200_OK
+       return shopcarts, status.HTTP_200_OK, {'ETag': make_etag(version)}
 
     ######################################################################
     # DELETE ALL PRODUCT OF USER
@@ -151,10 +273,8 @@ class ShopcartResource(Resource):
        """
 
        app.logger.info('Request to delete a shopcart of user id [%s]', user_id)
-       shopcarts = Shopcart.findByUserId(user_id)
-       if shopcarts:
-          for shopcart in shopcarts:
-              shopcart.delete()
+       count = Shopcart.remove_by_user(user_id)
+       app.logger.info('Deleted %s products from shopcart of user id [%s]', count, user_id)
        return '', status.HTTP_204_NO_CONTENT
 
 ##################################################################
@@ -177,25 +297,37 @@ class ShopcartAction(Resource):
     @ns.doc('get_shopcart_total')
     #@ns.response(404, 'Shopcart not found')
     @ns.response(200, 'Success')
+    @ns.response(304, 'Shopcart not modified since the version in If-None-Match')
+    @ns.param('summary_only', 'Only return the item count and total price, without the products (true/false)')
     def get(self, user_id):
        """ Get the shopcart entry for user (user_id)
        This endpoint will show the total amount of the all items in the shopcart along with the list of items in user's shopcart 
        """
 
        app.logger.info("Request to get the total amount of a user [%s]'s shopcart", user_id)
-       total_amount = 0.0
-       shopcarts = Shopcart.findByUserId(user_id)
-       for shopcart in shopcarts:
-           total_amount = total_amount + (shopcart.price * shopcart.quantity)
-       total_amount = round(total_amount, 2)
-
-       inlist = [shopcart.serialize() for shopcart in shopcarts]
-
-       dt = {'products':inlist,
-             'total_price':total_amount}
-
-       results = json.dumps(dt)
-       return make_response(results, status.HTTP_200_OK)
+       if request.args.get('summary_only', '').lower() == 'true':
+           # The maintained totals answer this without reading any entry
+           total = Shopcart.find_total(user_id)
+           if total is None:
+               total = ShopcartTotal(user_id=user_id, item_count=0, total_price=0.0, version=0)
+           etag = make_etag(total.version, 'summary')
+           if etag_matches(etag):
+               return make_response('', status.HTTP_304_NOT_MODIFIED, {'ETag': etag})
+           return json_response(shopcart_summary_encoder.encode(total.serialize()),
+                                status.HTTP_200_OK, {'ETag': etag})
+
+       _, etag = not_modified_etag(user_id, 'total')
+       if etag:
+           return make_response('', status.HTTP_304_NOT_MODIFIED, {'ETag': etag})
+
+       # The entries and their total come back from the same query
+       inlist, total_amount, version = Shopcart.find_cart_with_total(user_id)
+       total_amount = round(total_amount, 2) if total_amount else 0.0
+
+       dt = {'products': inlist,
+             'total_price': total_amount}
+       return json_response(shopcart_total_encoder.encode(dt), status.HTTP_200_OK,
+                            {'ETag': make_etag(version, 'total')})
 
 ######################################################################
 #  PATH: /shopcarts/<int:user_id>/product/<int:product_id>
@@ -209,6 +341,9 @@ class ProductResource(Resource):
     Allows the manipulation of products in user's a Shopcart
     GET /user{id}/product/product{id} - Retrieves given product from given user's shopcart
     DELETE /user{id}/product/product{id} -  Deletes given product from given user's shopcart
+
+    The ETag of a product is the version of its entry, and PUT and DELETE
+    only go ahead when it matches the If-Match header, if one is sent
     """
     #------------------------------------------------------------------
     # RETRIEVES A PRODUCT FROM USER'S SHOPCART
@@ -216,8 +351,7 @@ class ProductResource(Resource):
     @ns.doc('get_product')
     @ns.response(200, 'Success')
     @ns.response(404, 'Product not found')
-    @ns.marshal_with(shopcart_model)
-
+    @encode_with(shopcart_model)
     def get(self, user_id, product_id):
         """
         Retrieve a product from user's shopcart
@@ -225,16 +359,18 @@ class ProductResource(Resource):
         This endpoint will return a product having given product_id from user having given user_id
         """
         app.logger.info("Request to Retrieve a product with id [%s] from shopcart of user with id [%s]", product_id, user_id)
+        # Read like PUT and DELETE read it, so the ETag is the version they check
         result = Shopcart.find(user_id, product_id)
         if not result:
             raise NotFound("User with id '{uid}' doesn't have product with id '{pid}' was not found.' in the shopcart ".format(uid = user_id, pid = product_id))
-        return result.serialize(),status.HTTP_200_OK
+        return result.serialize(),status.HTTP_200_OK, {'ETag': make_etag(result.version)}
 
     #------------------------------------------------------------------
     # DELETES A PRODUCT FROM USER'S SHOPCART
     #------------------------------------------------------------------
     @ns.doc('delete_product')
     @ns.response(204, 'Product deleted')
+    @ns.response(412, 'Product was changed since the version in If-Match')
     def delete(self, user_id, product_id):
         """
         Delete a product from a user's shopcart
@@ -242,9 +378,11 @@ class ProductResource(Resource):
         This endpoint will delete a product based the id of product and user specified in the path
         """
         app.logger.info('Request to Delete a product with id [%s] from user with id [%s]', user_id, product_id)
+        buffered = use_write_behind()
         shopcart = Shopcart.find(user_id, product_id)
+        check_if_match(shopcart)
         if shopcart:
-            shopcart.delete()
+            shopcart.delete(buffered)
         return '', status.HTTP_204_NO_CONTENT
 
 
@@ -255,8 +393,9 @@ class ProductResource(Resource):
     @ns.response(200, 'Success')
     @ns.response(404, 'Product not found')
     @ns.response(400, 'The posted Product data was not valid')
+    @ns.response(412, 'Product was changed since the version in If-Match')
     @ns.expect(shopcart_model)
-    @ns.marshal_with(shopcart_model)
+    @encode_with(shopcart_model)
     def put(self, user_id, product_id):
         """
         Update a Shopcart entry specific to that user_id and product_id
@@ -264,28 +403,29 @@ class ProductResource(Resource):
         """
         app.logger.info('Request to Update a product with id [%s] from user with id [%s]', user_id, product_id)
         check_content_type('application/json')
+        buffered = use_write_behind()
         shopcart = Shopcart.find(user_id, product_id)
         if not shopcart:
             raise NotFound("User with id '{uid}' doesn't have product with id '{pid}' was not found.' in the shopcart ".format(uid = user_id, pid = product_id))
+        check_if_match(shopcart)
 
-        data = api.payload
-        app.logger.info(data)
-        shopcart.deserialize(data)
-        q = 0
+        app.logger.debug('Payload = %s', api.payload)
         try:
-           q = int(shopcart.quantity)
-        except ValueError:
-                app.logger.info("value error")
-                abort(status.HTTP_400_BAD_REQUEST, 'Quantity parameter is not valid: {}'.format(shopcart.quantity))
-
-        if q < 1:
-            app.logger.info("Added quantity is 0")
-            abort(status.HTTP_400_BAD_REQUEST, 'You should input number more than 0 for quantity to add a product')
+            entry = validate_shopcart_entry(api.payload)
+        except DataValidationError as error:
+            app.logger.info('%s', error)
+            abort(status.HTTP_400_BAD_REQUEST, str(error))
 
+        shopcart.quantity = entry['quantity']
+        shopcart.price = entry['price']
         shopcart.user_id = user_id
         shopcart.product_id = product_id
-        shopcart.save()
-        return shopcart.serialize(), status.HTTP_200_OK
+        # Only updates the version that was read, and raises ConcurrentUpdateError otherwise
+        shopcart.save(buffered)
+        if buffered:
+            # Buffered saves get their new version when they are written
+            return shopcart.serialize(), status.HTTP_200_OK
+        return shopcart.serialize(), status.HTTP_200_OK, {'ETag': make_etag(shopcart.version)}
 
 ######################################################################
 #  PATH: /shopcarts
@@ -299,7 +439,10 @@ class ShopcartCollection(Resource):
     #------------------------------------------------------------------
     @ns.doc('list_shopcarts')
     @ns.response(200, 'Success')
-    #@ns.param('category', 'List Shopcarts grouped by user_id')
+    @ns.response(400, 'The paging parameters were not valid')
+    @ns.param('stream', 'Stream the shopcarts as they are read from the database (true/false)')
+    @ns.param('limit', 'Maximum number of products to return in one page, a shopcart may continue on the next page')
+    @ns.param('cursor', 'Opaque cursor taken from the next link of the previous page')
     def get(self):
         """ 
         Returns all of the Shopcarts grouped by user_id 
@@ -308,26 +451,20 @@ class ShopcartCollection(Resource):
 
         app.logger.info('Request to list Shopcarts...')
 
-        users = Shopcart.list_users();
-        results = ''
-        #res = []
-        for user_id in users:
-            inlist = Shopcart.findByUserId(user_id)
-            dt = []
-            for item in inlist:
-                tmp2 = {"product_id":item.product_id,
-                        "price": item.price,
-                        "quantity": item.quantity}
-                dt.append(tmp2)
-            tmp = {"user_id":user_id,
-                   "products":dt}
-            if len(results)>1: 
-                results += ","
-            results += json.dumps(tmp)
-        #res.append()
-        #res.append(results)
-        res = "["+results+"]"
-        return make_response(res, status.HTTP_200_OK)
+        limit, after = get_page_args()
+        if limit is not None:
+            shopcarts, headers = fetch_page(ShopcartCollection, limit, after)
+            body = shopcart_products_encoder.encode_list(group_shopcarts(shopcarts))
+            return json_response(body, status.HTTP_200_OK, headers)
+
+        if request.args.get('stream', '').lower() == 'true':
+            shopcarts = group_shopcarts(Shopcart.stream_by_user(STREAM_BATCH_SIZE))
+            return Response(stream_with_context(generate_json_array(shopcarts, shopcart_products_encoder)),
+                            status=status.HTTP_200_OK,
+                            mimetype='application/json')
+
+        body = shopcart_products_encoder.encode_list(group_shopcarts(Shopcart.all_by_user()))
+        return json_response(body, status.HTTP_200_OK)
 
     #------------------------------------------------------------------
     # ADD A NEW PRODUCT
@@ -336,7 +473,7 @@ class ShopcartCollection(Resource):
     @ns.expect(shopcart_model)
     @ns.response(400, 'The posted data was not valid')
     @ns.response(201, 'Product added successfully')
-    @ns.marshal_with(shopcart_model, code=201)
+    @encode_with(shopcart_model, code=201)
     def post(self):
         """
         add a product to a shopcart
@@ -344,38 +481,90 @@ class ShopcartCollection(Resource):
         """
         app.logger.info('Request to Add an Item to Shopcart')
         check_content_type('application/json')
-        shopcart = Shopcart()
-        app.logger.info('Payload = %s', api.payload)
-        shopcart.deserialize(api.payload)
-
-        q = 0;
+        app.logger.debug('Payload = %s', api.payload)
         try:
-            q = int(shopcart.quantity)
-        except ValueError:
-                app.logger.info("value error")
-                #raise DataValidationError
-                abort(status.HTTP_400_BAD_REQUEST, 'Quantity parameter is not valid: {}'.format(shopcart.quantity))
-
-        if shopcart.user_id is None or shopcart.user_id == '' or shopcart.product_id is None or shopcart.product_id =='' \
-            or shopcart.price is None or shopcart.price == '' or shopcart.quantity is None or shopcart.quantity == '':
-            app.logger.info("some parameter is none")
-            abort(status.HTTP_400_BAD_REQUEST, 'Some data is missing in the request')
-        elif q < 1:
-            app.logger.info("Added quantity is 0")
-            abort(status.HTTP_400_BAD_REQUEST, 'You should input number more than 0 for quantity to add a product')
-        else:
-            #Check if the entry exists, if yes then increase quantity of product
-            exists = Shopcart.find(shopcart.user_id, shopcart.product_id)
-            if exists:
-                exists.quantity = exists.quantity + q
-                exists.save()
-                shopcart = exists
+            entry = validate_shopcart_entry(api.payload)
+        except DataValidationError as error:
+            app.logger.info('%s', error)
+            abort(status.HTTP_400_BAD_REQUEST, str(error))
 
-            shopcart.save()
+        # Creates the entry or increases the quantity of the product in one statement
+        shopcart = Shopcart.add(**entry)
 
-            app.logger.info('Item with new id [%s] saved to shopcart of user [%s]!', shopcart.user_id, shopcart.product_id)
-            location_url = api.url_for(ProductResource,  user_id=shopcart.user_id, product_id=shopcart.product_id, _external=True)
-            return shopcart.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+        app.logger.info('Item with new id [%s] saved to shopcart of user [%s]!', shopcart.product_id, shopcart.user_id)
+        location_url = api.url_for(ProductResource,  user_id=shopcart.user_id, product_id=shopcart.product_id, _external=True)
+        return shopcart.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+
+
+######################################################################
+#  PATH: /shopcarts/batch
+######################################################################
+@ns.route('/batch')
+class ShopcartBatchResource(Resource):
+    """
+    ShopcartBatchResource class
+
+    Allows adding products to the shopcarts of many users at once
+    POST /batch - Adds a JSON array or NDJSON stream of products to the shopcarts
+    """
+
+    #------------------------------------------------------------------
+    # ADD A BATCH OF PRODUCTS
+    #------------------------------------------------------------------
+    @ns.doc('add_products_batch')
+    @ns.expect([shopcart_model])
+    @ns.response(200, 'Batch processed, the report has the result of each line')
+    @ns.response(400, 'The posted data was not a list of products')
+    @ns.response(415, 'The posted data was not JSON or NDJSON')
+    @ns.response(500, 'Only part of the batch was written, the report has the lines that failed')
+    def post(self):
+        """
+        add products to many shopcarts
+        This endpoint will add every valid line of the batch to the shopcarts
+        and report the lines that were rejected, or that failed to be written
+        after the others were committed
+        """
+        app.logger.info('Request to Add a batch of Items to Shopcarts')
+        if request.mimetype == 'application/x-ndjson':
+            lines = read_ndjson(request.stream)
+        else:
+            check_content_type('application/json')
+            lines = request.get_json(silent=True)
+            if not isinstance(lines, list):
+                abort(status.HTTP_400_BAD_REQUEST, 'Batch must be a list of products')
+
+        entries = []
+        results = []
+        for line, data in enumerate(lines, 1):
+            try:
+                entry = validate_shopcart_entry(data)
+            except DataValidationError as error:
+                results.append({'line': line, 'status': 'rejected', 'message': str(error)})
+            else:
+                entries.append(entry)
+                results.append({'line': line, 'status': 'accepted',
+                                'user_id': entry['user_id'], 'product_id': entry['product_id']})
+
+        code = status.HTTP_200_OK
+        failed = 0
+        try:
+            Shopcart.upsert_many(entries, BATCH_CHUNK_SIZE)
+        except PartialWriteError as error:
+            # The chunks committed before the failure stay, so say which lines they were
+            app.logger.error('Batch only partly written: %s', error)
+            code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            unwritten = set((entry['user_id'], entry['product_id']) for entry in error.unwritten)
+            for result in results:
+                if result['status'] == 'accepted' and (result['user_id'], result['product_id']) in unwritten:
+                    result['status'] = 'failed'
+                    result['message'] = 'Not written: {}'.format(error)
+                    failed += 1
+        app.logger.info('Batch of %s lines processed, %s accepted', len(results), len(entries) - failed)
+        report = {'accepted': len(entries) - failed,
+                  'rejected': len(results) - len(entries),
+                  'failed': failed,
+                  'results': results}
+        return report, code
 
 
 ######################################################################
@@ -390,6 +579,9 @@ class ShopcartUsersResource(Resource):
     GET /users - Returns the list of the users whose shopcarts' total is more than a certain amount
     """
     @ns.param('amount', 'amount for searching')
+    @ns.param('sort', "'total_desc' to list the most valuable shopcarts first, by user_id otherwise")
+    @ns.param('limit', 'Maximum number of users to return in one page')
+    @ns.param('cursor', 'Opaque cursor taken from the next link of the previous page')
 
     ############################################################################
     # QUERY DATABASE FOR SHOPCARTS HAVING PRODUCTS WORTH MORE THAN GIVEN AMOUNT
@@ -404,22 +596,74 @@ class ShopcartUsersResource(Resource):
         with amount more than given amount
         """
         amount = request.args.get('amount');
-        app.logger.info("Request to get the list of the user shopcart having more than {}".format(amount))
+        app.logger.info('Request to get the list of the user shopcart having more than %s', amount)
 
         if amount is None:
             app.logger.info("amount is none")
             abort(status.HTTP_400_BAD_REQUEST, 'parameter amount not found')
         else:
             try:
-                app.logger.info("try start")
                 amount = float(amount)
-                app.logger.info("try end")
             except ValueError:
                 app.logger.info("value error")
                 abort(status.HTTP_400_BAD_REQUEST, 'parameter is not valid: {}'.format(amount))
-        users = Shopcart.find_users_by_shopcart_amount(amount)
-        app.logger.info("get data")
-        return users, status.HTTP_200_OK
+
+        sort = request.args.get('sort')
+        if sort not in (None, 'user_id', 'total_desc'):
+            abort(status.HTTP_400_BAD_REQUEST, 'sort parameter is not valid: {}'.format(sort))
+        key_types = (float, int) if sort == 'total_desc' else (int,)
+        limit, after = get_page_args(key_types)
+        if limit is None:
+            totals = Shopcart.find_totals_by_amount(amount, sort)
+            return [total.user_id for total in totals], status.HTTP_200_OK
+
+        # Ask for one extra user to find out if there is a next page
+        totals = Shopcart.find_totals_by_amount(amount, sort, limit + 1, after)
+        headers = {}
+        if len(totals) > limit:
+            totals = totals[:limit]
+            last = totals[-1]
+            key = (last.total_price, last.user_id) if sort == 'total_desc' else (last.user_id,)
+            values = {'amount': request.args.get('amount')}
+            if sort is not None:
+                values['sort'] = sort
+            headers = next_page_headers(ShopcartUsersResource, limit, key, **values)
+        return [total.user_id for total in totals], status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /shopcarts/changes
+######################################################################
+@ns.route('/changes')
+class ShopcartChangesResource(Resource):
+    """
+    ShopcartChangesResource class
+
+    Allows following the changes of the shopcarts
+    GET /changes - Returns the adds, updates and deletes of the Shopcart entries made since a cursor
+    """
+    @ns.doc('list_shopcart_changes')
+    @ns.param('since', 'Cursor taken from the previous response, leave it out to start from the first change')
+    @ns.param('limit', 'Maximum number of changes to return')
+    @ns.response(200, 'Success')
+    @ns.response(400, 'The since or limit parameter was not valid')
+    @encode_with(change_feed_model)
+    def get(self):
+        """
+        Get the changes of the shopcarts
+        This endpoint will return the oldest changes made after the since cursor,
+        with the cursor to read the next changes from
+        """
+        app.logger.info('Request to list the Shopcart changes since %s', request.args.get('since'))
+        limit = get_limit(CHANGES_PAGE_SIZE)
+        # The (seq, id) position in the change log of each shard
+        key_types = (int, int) * len(db.shards.all())
+        since = request.args.get('since')
+        keys = decode_cursor(since, key_types) if since is not None else (0,) * len(key_types)
+        after = zip(keys[::2], keys[1::2])
+        changes, after = Shopcart.changes_since(after, limit)
+        return {'changes': [change.serialize() for change in changes],
+                'cursor': encode_cursor(*[key for position in after for key in position])}, status.HTTP_200_OK
 
 
 #####################################################################
@@ -438,11 +682,222 @@ def shopcarts_reset():
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
+@app.before_request
+def start_request_timer():
+    """ Notes when the request started for the latency metrics """
+    g.request_started = time.time()
+
+@app.after_request
+def record_request_metrics(response):
+    """ Counts the request under the resource and method that handled it """
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        metrics.observe(resource_name(request.endpoint), request.method,
+                        response.status_code, time.time() - started)
+    return response
+
+@app.before_request
+def route_reads():
+    """ Sends the queries of the request to a replica when it can't miss a write of its own """
+    g.replica_bind = pick_replica(app) if reads_from_replica(app, Shopcart.recent_writes) else None
+
+@app.after_request
+def remember_client_write(response):
+    """ Keeps the next reads of a client that wrote on the primary for a while """
+    return mark_client_write(response, Shopcart.recent_writes)
+
+@app.before_request
+def start_sql_profiling():
+    """ Times the SQL statements of the request when profiling or the slow query log is on """
+    if app.config['SQL_PROFILING'] or app.config['SLOW_QUERY_MS']:
+        profiler.install(db.engine)
+        if g.replica_bind is not None:
+            profiler.install(db.get_engine(app, g.replica_bind))
+        for shard in db.shards.binds:
+            profiler.install(db.get_engine(app, shard))
+        if profiler.propagate not in db.shards.propagators:
+            # Count the statements the shards run on their own threads too
+            db.shards.propagators.append(profiler.propagate)
+        profiler.start_request()
+
+@app.after_request
+def add_sql_profile_headers(response):
+    """ Sends back the number of SQL statements of the request and the time spent on them """
+    if app.config['SQL_PROFILING']:
+        queries, elapsed = profiler.request_totals()
+        response.headers['X-DB-Queries'] = str(queries)
+        response.headers['X-DB-Time-ms'] = '{:.3f}'.format(elapsed * 1000)
+    return response
+
 @app.before_first_request
 def init_db():
     """ Initlaize the SQLAlchemy app"""
     Shopcart.init_db()
 
+def group_shopcarts(entries):
+    """ Groups user_id-ordered CartLines into one dictionary per user """
+    # A single pass over the ordered rows, so the number of queries
+    # doesn't grow with the number of users. The lines are encoded as
+    # they are, with only the product fields
+    for user_id, items in groupby(entries, key=attrgetter('user_id')):
+        yield {"user_id": user_id,
+               "products": list(items)}
+
+def resource_name(endpoint):
+    """ Returns the Resource class that serves <endpoint>, or the endpoint of a plain route """
+    if endpoint is None:
+        return 'unmatched'
+    view = app.view_functions.get(endpoint)
+    view_class = getattr(view, 'view_class', None)
+    return view_class.__name__ if view_class is not None else endpoint
+
+def generate_json_array(items, encoder):
+    """ Yields a JSON array one element at a time """
+    separator = '['
+    for item in items:
+        yield separator + encoder.encode(item)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+def encode_cursor(*key):
+    """ Encodes the key of the last entry of a page into an opaque cursor """
+    # repr keeps every digit of a float so the page can seek past it exactly
+    values = [repr(value) if isinstance(value, float) else str(value) for value in key]
+    return base64.urlsafe_b64encode(':'.join(values))
+
+def decode_cursor(cursor, key_types):
+    """ Decodes a cursor back into the key it was made from """
+    try:
+        values = base64.urlsafe_b64decode(str(cursor)).split(':')
+        if len(values) != len(key_types):
+            raise ValueError('cursor has {} values'.format(len(values)))
+        return tuple(key_type(value) for key_type, value in zip(key_types, values))
+    except (TypeError, ValueError):
+        abort(status.HTTP_400_BAD_REQUEST, 'cursor parameter is not valid: {}'.format(cursor))
+
+def get_limit(default=None):
+    """ Returns the limit parameter of the request, or <default> when there is none """
+    limit = request.args.get('limit')
+    if limit is None:
+        return default
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, 'limit parameter is not valid: {}'.format(limit))
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        abort(status.HTTP_400_BAD_REQUEST, 'limit parameter must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    return limit
+
+def get_page_args(key_types=(int, int)):
+    """ Returns the (limit, after) paging parameters of the request """
+    limit = get_limit()
+    cursor = request.args.get('cursor')
+    if limit is None:
+        if cursor is not None:
+            abort(status.HTTP_400_BAD_REQUEST, 'cursor parameter requires a limit')
+        return None, None
+    after = decode_cursor(cursor, key_types) if cursor is not None else None
+    return limit, after
+
+def next_page_headers(resource, limit, key, **values):
+    """ Returns the Link header of the page that starts after <key> """
+    next_url = api.url_for(resource, limit=limit, cursor=encode_cursor(*key),
+                           _external=True, **values)
+    return {'Link': '<{}>; rel="next"'.format(next_url)}
+
+def fetch_page(resource, limit, after, **values):
+    """ Fetches one page of Shopcart entries along with the Link header of the next page """
+    # Ask for one extra entry to find out if there is a next page
+    shopcarts = Shopcart.page(limit + 1, after, values.get('user_id'))
+    headers = {}
+    if len(shopcarts) > limit:
+        shopcarts = shopcarts[:limit]
+        last = shopcarts[-1]
+        headers = next_page_headers(resource, limit, (last.user_id, last.product_id), **values)
+    return shopcarts, headers
+
+def make_etag(version, representation=None):
+    """ Returns the quoted entity tag of a version of a shopcart """
+    if representation:
+        return quote_etag('{}-{}'.format(version, representation))
+    return quote_etag(str(version))
+
+def not_modified_etag(user_id, representation=None):
+    """
+    Returns the version of the shopcart of user <user_id> along with its
+    entity tag if it matches the If-None-Match header of the request
+
+    Only the version of the shopcart is looked up, none of its entries, and
+    only when the request has an If-None-Match header; otherwise both are None
+    """
+    if not request.if_none_match:
+        return None, None
+    version = Shopcart.find_version(user_id)
+    etag = make_etag(version, representation)
+    return version, (etag if etag_matches(etag) else None)
+
+def etag_matches(etag):
+    """ Checks if the quoted entity tag matches the If-None-Match header of the request """
+    return request.if_none_match.contains_weak(unquote_etag(etag)[0])
+
+def check_if_match(shopcart):
+    """ Aborts with 412 when the If-Match header doesn't match the version of the Shopcart entry """
+    if not request.if_match:
+        return
+    if shopcart is None or not request.if_match.contains(unquote_etag(make_etag(shopcart.version))[0]):
+        app.logger.info('If-Match %s does not match the shopcart entry', request.headers.get('If-Match'))
+        abort(status.HTTP_412_PRECONDITION_FAILED, 'Shopcart entry was changed since it was read')
+
+def use_write_behind():
+    """
+    Returns True when the change of the request can be left to the
+    write-behind buffer
+
+    A conditional request is written right away instead, after the
+    buffered changes, so its If-Match is checked against the entry as it is
+    """
+    if Shopcart.write_behind is None:
+        return False
+    if not request.if_match:
+        return True
+    Shopcart.sync_writes()
+    return False
+
+def read_ndjson(stream):
+    """ Parses a newline delimited JSON stream one line at a time """
+    for raw in stream:
+        if not raw.strip():
+            continue
+        try:
+            yield json.loads(raw)
+        except ValueError:
+            # Let the line be rejected along with the other invalid entries
+            yield raw
+
+def validate_shopcart_entry(data):
+    """ Checks a Shopcart entry that is to be added and returns it as a dictionary """
+    try:
+        entry = {'user_id': to_integer(data['user_id']),
+                 'product_id': to_integer(data['product_id']),
+                 'quantity': to_integer(data['quantity']),
+                 'price': float(data['price'])}
+    except KeyError as error:
+        raise DataValidationError('Invalid entry for Shopcart: missing ' + error.args[0])
+    except (TypeError, ValueError, OverflowError):
+        raise DataValidationError('Invalid entry for Shopcart: body of request contained ' \
+                                  'bad or no data')
+    if entry['quantity'] < 1:
+        raise DataValidationError('You should input number more than 0 for quantity to add a product')
+    if math.isnan(entry['price']) or math.isinf(entry['price']):
+        raise DataValidationError('Invalid entry for Shopcart: price must be a finite number')
+    return entry
+
+def to_integer(value):
+    """ Converts <value> to an int, raising ValueError rather than dropping a fraction """
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError('{} is not a whole number'.format(value))
+    return int(value)
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers['Content-Type'] == content_type:
@@ -451,8 +906,18 @@ def check_content_type(content_type):
     abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, 'Content-Type must be {}'.format(content_type))
 
 #@app.before_first_request
-def initialize_logging(log_level=logging.INFO):
-    """ Initialized the default logging to STDOUT """
+def initialize_logging(log_level=logging.INFO, queued=None, sample_rate=None):
+    """
+    Initialized the default logging to STDOUT
+
+    With <queued> the logs are written by a background thread, and with a
+    <sample_rate> below 1 only that fraction of the requests log at INFO.
+    Both default to the LOG_QUEUE and LOG_SAMPLE_RATE settings.
+    """
+    if queued is None:
+        queued = app.config['LOG_QUEUE']
+    if sample_rate is None:
+        sample_rate = app.config['LOG_SAMPLE_RATE']
     if not app.debug:
         print 'Setting up logging...'
         # Set up default logging for submodules to use STDOUT
@@ -467,6 +932,7 @@ def initialize_logging(log_level=logging.INFO):
         handler_list = list(app.logger.handlers)
         for log_handler in handler_list:
             app.logger.removeHandler(log_handler)
-        app.logger.addHandler(handler)
+        for log_handler in request_log_handlers([handler], queued, sample_rate):
+            app.logger.addHandler(log_handler)
         app.logger.setLevel(log_level)
         app.logger.info('Logging handler established')
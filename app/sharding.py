@@ -0,0 +1,149 @@
+# Copyright 2016, 2017 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Sharding for Shopcart Service
+
+The shopcarts can be split over several databases, the shards, one bind
+each in SQLALCHEMY_BINDS. Every user is placed on a shard by consistent
+hashing of its user_id, so the entries and the totals of a user are all on
+the same shard, and adding a shard only moves about 1/N of the users.
+
+The model picks the shard of each statement: ORM queries with
+ShardQuery.set_shard(), Core statements with the shard argument of
+session.execute(), and flushed instances go to the shard of their user.
+Shards.map() runs a query over every user on all of the shards in parallel,
+in functions wrapped by the <propagators>, which carry the context of the
+calling thread over to the threads that query the shards.
+"""
+import bisect
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from flask_sqlalchemy import BaseQuery
+
+# Points each shard gets on the ring, more points spread the users more evenly
+POINTS_PER_SHARD = 100
+
+def shard_binds(count):
+    """ Returns the names of the binds of <count> shards """
+    return ['shard{}'.format(number) for number in range(count)]
+
+def ring_hash(key):
+    """ Returns the position of <key> on the ring """
+    return int(hashlib.md5(str(key)).hexdigest()[:8], 16)
+
+class HashRing(object):
+    """ Consistent hashing of keys onto <nodes> """
+
+    def __init__(self, nodes, points=POINTS_PER_SHARD):
+        ring = sorted((ring_hash('{}#{}'.format(node, point)), node)
+                      for node in nodes for point in range(points))
+        self._hashes = [position for position, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def node_for(self, key):
+        """ Returns the node of <key>, the first one at or after its position on the ring """
+        index = bisect.bisect_left(self._hashes, ring_hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+class Shards(object):
+    """
+    The shard binds of the app and the ring that places the users on them
+
+    Without any binds the service is not sharded: every user is on the shard
+    None, which is the default bind of the session.
+    """
+
+    def __init__(self, binds=None, session=None):
+        self.binds = list(binds or [])
+        self.session = session
+        self._ring = HashRing(self.binds) if self.binds else None
+        # Called with the function of map() in the calling thread, each returns it wrapped
+        self.propagators = []
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def for_user(self, user_id):
+        """ Returns the bind of the shard holding the shopcart of <user_id> """
+        return self._ring.node_for(user_id) if self._ring else None
+
+    def all(self):
+        """ Returns the binds of every shard """
+        return self.binds or [None]
+
+    def split(self, items, user_id=lambda item: item):
+        """ Returns <items> grouped by the shard of their <user_id>, in the order they came in """
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(self.for_user(user_id(item)), []).append(item)
+        return groups
+
+    def map(self, func):
+        """
+        Returns the results of <func>(shard) for every shard, in the order of the binds
+
+        The shards are queried in parallel, each on a thread of its own with
+        a session of its own, so the ORM instances that are returned are
+        detached. A single shard is queried in the calling thread.
+        """
+        shards = self.all()
+        if len(shards) == 1:
+            return [func(shards[0])]
+        for propagate in self.propagators:
+            func = propagate(func)
+        return self._thread_pool().map(lambda shard: self._call(func, shard), shards)
+
+    def _call(self, func, shard):
+        try:
+            return func(shard)
+        finally:
+            # Give the connections of the worker thread back to the pools
+            self.session.remove()
+
+    def _thread_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(len(self.binds))
+            return self._pool
+
+def identity_user_id(state):
+    """ Returns the user_id of the instance with <state>, which leads the primary key of every model """
+    if state.key is not None:
+        return state.key[1][0]
+    return state.obj().user_id
+
+class ShardQuery(BaseQuery):
+    """ Query that runs on the shard given to set_shard() """
+
+    _shard = None
+
+    def set_shard(self, shard):
+        """ Returns a copy of the query that runs on the bind <shard>, or the default bind for None """
+        query = self._clone()
+        query._shard = shard
+        return query
+
+    def _connection_from_session(self, **kwargs):
+        if self._shard is not None:
+            kwargs['shard'] = self._shard
+        return super(ShardQuery, self)._connection_from_session(**kwargs)
+
+    def _execute_and_instances(self, context):
+        # Expired attributes are loaded from the shard of their instance
+        if self._shard is None and context.refresh_state is not None:
+            shard = self.session.db.shards.for_user(identity_user_id(context.refresh_state))
+            if shard is not None:
+                return self.set_shard(shard)._execute_and_instances(context)
+        return super(ShardQuery, self)._execute_and_instances(context)
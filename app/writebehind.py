@@ -0,0 +1,187 @@
+# Copyright 2016, 2017 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Write-Behind Buffer for Shopcart Service
+
+Holds the saves and deletes of shopcart entries in memory and writes them
+in group commits, one transaction for every change made in the last
+<interval> seconds, or sooner once <max_size> entries are waiting.
+
+Repeated changes to the same entry are merged, the last one wins. The
+changes are written in the order they were first made, one group commit at
+a time, so a change is never overwritten by an older one. A group commit
+that fails is put back in the buffer, ahead of the newer changes, and tried
+again with the next one. A writer that commits part of the changes raises an
+error with the others in its unwritten attribute, and only those are put back.
+
+At most <max_pending> entries wait in the buffer. A change of another entry
+then waits for the next group commit to make room, and is rejected with a
+WriteBehindError if that commit fails, so a database that is down fills the
+buffer once and then turns the writes away instead of growing it. Writes
+that skip the buffer call sync() first, so they come after the changes that
+were buffered before them.
+
+A buffer made with start_thread=False never starts the background thread,
+so its changes are only written by flush(), by sync() and by a change that
+waits for room.
+
+The changes still waiting are written when the process exits normally. A
+change is only in memory until its group commit, so one that was already
+answered is lost if the process is killed (SIGKILL, out of memory, a crash
+of the host) within <interval> seconds of it.
+"""
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+class WriteBehindError(Exception):
+    """ Raised when a change can't be buffered or waited for because the group commits are failing """
+
+class WriteBehindBuffer(object):
+    """ Buffers the changes of shopcart entries and writes them in batches with <writer> """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, writer, interval=0.1, max_size=500, max_pending=None, start_thread=True):
+        self.writer = writer
+        self.interval = interval
+        self.max_size = max_size
+        self.max_pending = max_pending or max_size * 10
+        self._pending = OrderedDict()   # (user_id, product_id) -> entry, or None to delete it
+        self._lock = threading.Lock()
+        # Notified after every group commit, whether it worked or not
+        self._committed = threading.Condition(self._lock)
+        self._buffered = 0      # changes buffered so far
+        self._written = 0       # of them, the ones written by a group commit
+        self._failures = 0
+        # Held for the whole of a group commit, so they are written one after the other
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopping = not start_thread
+
+    def save(self, user_id, product_id, quantity, price):
+        """ Buffers the save of an entry with <quantity> and <price> """
+        self._put((user_id, product_id), {'user_id': user_id,
+                                          'product_id': product_id,
+                                          'quantity': quantity,
+                                          'price': price})
+
+    def delete(self, user_id, product_id):
+        """ Buffers the delete of an entry """
+        self._put((user_id, product_id), None)
+
+    def _put(self, key, entry):
+        with self._lock:
+            while len(self._pending) >= self.max_pending and key not in self._pending:
+                self._wait_for_commit()
+            # A change replaces the one still waiting for the entry, in its place
+            self._pending[key] = entry
+            self._buffered += 1
+            full = len(self._pending) >= self.max_size
+            if self._thread is None and not self._stopping:
+                # Started by the first change, so each worker of a preloaded app starts its own
+                self._start()
+        if full:
+            self._wake.set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending(self):
+        """ Returns a copy of the changes waiting to be written, in the order they are written """
+        with self._lock:
+            return OrderedDict(self._pending)
+
+    def sync(self):
+        """
+        Waits until every change buffered so far is written
+
+        Raises:
+            WriteBehindError: a group commit failed before they were written
+        """
+        with self._lock:
+            buffered = self._buffered
+            while self._written < buffered:
+                self._wait_for_commit()
+
+    def _wait_for_commit(self):
+        """ Waits for the next group commit, with self._lock held """
+        if self._thread is None:
+            # No background thread to write them, so write them here
+            self._lock.release()
+            try:
+                self.flush()
+            finally:
+                self._lock.acquire()
+            return
+        failures = self._failures
+        self._wake.set()
+        self._committed.wait(self.interval)
+        if self._failures != failures:
+            raise WriteBehindError('Group commit of the buffered shopcart entries failed')
+
+    def flush(self):
+        """
+        Writes every change waiting in the buffer in one group commit
+
+        Returns:
+            int: the number of entries that were written
+        """
+        with self._flush_lock:
+            with self._lock:
+                changes, self._pending = self._pending, OrderedDict()
+                buffered = self._buffered
+            try:
+                if changes:
+                    self.writer(changes)
+            except Exception as error:
+                with self._lock:
+                    changes = getattr(error, 'unwritten', changes)
+                    # The newer changes of an entry still win over the ones put back
+                    changes.update(self._pending)
+                    self._pending = changes
+                    self._failures += 1
+                    self._committed.notify_all()
+                raise
+            with self._lock:
+                self._written = buffered
+                self._committed.notify_all()
+            return len(changes)
+
+    def stop(self):
+        """ Stops the background thread and writes the changes still waiting """
+        self._stopping = True
+        thread = self._thread
+        if thread is not None:
+            self._wake.set()
+            thread.join()
+            self._thread = None
+        self.flush()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('Group commit of %s shopcart entries failed, will retry', len(self))
@@ -0,0 +1,6 @@
+"""
+Package: benchmarks
+Performance benchmarks of the Shopcart service, run as scripts:
+  python -m benchmarks.endpoints --lines 100000
+They are not part of the test suite.
+"""
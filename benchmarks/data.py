@@ -0,0 +1,92 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Synthetic Shopcart Data
+
+Generates shopcart lines for the benchmarks. Cart sizes follow a Zipf
+distribution, so a few users have very large shopcarts and most of them
+have one or two products, as in a real store.
+
+The lines can also be written as NDJSON to load another database:
+  python -m benchmarks.data --lines 100000 > shopcarts.ndjson
+"""
+import sys
+import json
+import heapq
+import random
+import argparse
+
+class CartData(object):
+    """
+    The shopcarts of <users> users holding <lines> lines in total
+
+    Users are numbered from 1 and user 1 has the largest shopcart. The same
+    seed always generates the same shopcarts.
+    """
+
+    def __init__(self, lines, users=None, skew=1.1, seed=2018):
+        self.lines = lines
+        self.users = min(users or max(1, lines // 10), lines)
+        self.skew = skew
+        self.seed = seed
+        weights = [1.0 / rank ** skew for rank in range(1, self.users + 1)]
+        scale = float(lines) / sum(weights)
+        self.cart_sizes = [max(1, int(weight * scale)) for weight in weights]
+        # Give the lines lost to rounding to the largest shopcart, or take the
+        # lines added by raising the small ones to 1 from the largest ones
+        self.cart_sizes[0] += max(0, lines - sum(self.cart_sizes))
+        largest = [(-size, -index) for index, size in enumerate(self.cart_sizes)]
+        heapq.heapify(largest)
+        for _ in range(sum(self.cart_sizes) - lines):
+            size, index = heapq.heappop(largest)
+            self.cart_sizes[-index] -= 1
+            heapq.heappush(largest, (size + 1, index))
+        self.products = max(1000, max(self.cart_sizes) * 2)
+
+    def entries(self):
+        """ Yields the user_id, product_id, quantity and price of every line """
+        rng = random.Random(self.seed)
+        for user_id, size in enumerate(self.cart_sizes, 1):
+            for product_id in rng.sample(xrange(1, self.products + 1), size):
+                yield {'user_id': user_id,
+                       'product_id': product_id,
+                       'quantity': rng.randint(1, 5),
+                       'price': round(rng.uniform(1, 200), 2)}
+
+    def sample(self, count, seed=None):
+        """ Returns <count> (user_id, product_id) pairs of existing lines, picked uniformly """
+        rng = random.Random(self.seed if seed is None else seed)
+        picks = set(rng.sample(xrange(self.lines), min(count, self.lines)))
+        return [(entry['user_id'], entry['product_id'])
+                for position, entry in enumerate(self.entries()) if position in picks]
+
+    def pick_user(self, rng):
+        """ Returns a user picked with the same skew as the cart sizes, so large shopcarts are read more """
+        return min(self.users, int(rng.paretovariate(self.skew)))
+
+def main(argv=None):
+    """ Writes the synthetic shopcart lines as NDJSON, ready for POST /shopcarts/batch """
+    parser = argparse.ArgumentParser(description='Generates synthetic shopcart lines as NDJSON')
+    parser.add_argument('--lines', type=int, default=1000, help='shopcart lines to generate')
+    parser.add_argument('--users', type=int, help='users holding the lines (lines / 10 by default)')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the cart sizes')
+    parser.add_argument('--seed', type=int, default=2018, help='seed of the random generator')
+    args = parser.parse_args(argv)
+    data = CartData(args.lines, args.users, args.skew, args.seed)
+    for entry in data.entries():
+        sys.stdout.write(json.dumps(entry, sort_keys=True) + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Shopcart API Endpoint Benchmarks
+
+Seeds a database with synthetic shopcarts and drives every endpoint of the
+service through the Flask test client
+
+Run them with:
+  python -m benchmarks.endpoints --lines 100000
+  python -m benchmarks.endpoints --lines 1000 --save-baseline
+  DATABASE_URI=postgres://... python -m benchmarks.endpoints --database-uri postgres://...
+
+The exit status is 1 when a case regressed past the stored baseline.
+/shopcarts/reset is left out because it would empty the seeded shopcarts.
+"""
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+from flask_api import status
+from app import service
+from app.model import Shopcart, db
+from benchmarks.data import CartData
+from benchmarks.runner import Case, run_cases, save_baseline, check_baseline, BASELINE_FILE
+
+BENCHMARK = 'endpoints'
+# Lines written per call of upsert_many while seeding
+SEED_BLOCK_SIZE = 50000
+# Users added by the write cases, numbered after the seeded users
+NEW_USER_OFFSET = 10000000
+
+def seed_database(data, quiet=False):
+    """ Replaces the shopcarts in the database with the synthetic ones """
+    db.drop_all()
+    db.create_all()
+    Shopcart.cache.clear()
+    start = time.time()
+    block = []
+    for entry in data.entries():
+        block.append(entry)
+        if len(block) == SEED_BLOCK_SIZE:
+            Shopcart.upsert_many(block, SEED_BLOCK_SIZE)
+            block = []
+    Shopcart.upsert_many(block, SEED_BLOCK_SIZE)
+    if not quiet:
+        print('Seeded {} lines in {} shopcarts in {:.1f} s'.format(data.lines, data.users, time.time() - start))
+
+def expect(response, code):
+    """ Fails the benchmark when an endpoint does not answer <code> """
+    if response.status_code != code:
+        raise RuntimeError('Expected {} but got {}: {}'.format(code, response.status_code, response.data[:200]))
+
+def endpoint_cases(client, data, rng):
+    """ Returns a case for every endpoint of the service """
+    lines = data.sample(1000)
+    new_users = iter(xrange(NEW_USER_OFFSET, sys.maxint))
+    amount = 100
+
+    def existing_line():
+        return rng.choice(lines)
+
+    def new_line():
+        return {'user_id': next(new_users), 'product_id': rng.randint(1, data.products),
+                'quantity': rng.randint(1, 5), 'price': round(rng.uniform(1, 200), 2)}
+
+    def added_line():
+        # Written outside of the timing for the delete cases
+        line = new_line()
+        Shopcart.add(**line)
+        return line['user_id'], line['product_id']
+
+    def get(url, code=status.HTTP_200_OK):
+        expect(client.get(url), code)
+
+    def send(method, url, body, code):
+        expect(client.open(url, method=method, data=json.dumps(body),
+                           content_type='application/json'), code)
+
+    return [
+        Case('get_shopcart', lambda user_id: get('/shopcarts/{}'.format(user_id)),
+             lambda: (data.pick_user(rng),)),
+        Case('get_shopcart_page', lambda user_id: get('/shopcarts/{}?limit=20'.format(user_id)),
+             lambda: (data.pick_user(rng),)),
+        Case('get_total', lambda user_id: get('/shopcarts/{}/total'.format(user_id)),
+             lambda: (data.pick_user(rng),)),
+        Case('get_total_summary', lambda user_id: get('/shopcarts/{}/total?summary_only=true'.format(user_id)),
+             lambda: (data.pick_user(rng),)),
+        Case('get_product', lambda user_id, product_id: get('/shopcarts/{}/product/{}'.format(user_id, product_id)),
+             existing_line),
+        Case('list_shopcarts_page', lambda: get('/shopcarts?limit=100')),
+        Case('list_shopcarts', lambda: get('/shopcarts'), repeat=0.25),
+        Case('list_shopcarts_stream', lambda: get('/shopcarts?stream=true'), repeat=0.25),
+        Case('users_by_amount', lambda: get('/shopcarts/users?amount={}'.format(amount)), repeat=0.2),
+        Case('users_by_amount_top', lambda: get('/shopcarts/users?amount={}&sort=total_desc&limit=50'.format(amount))),
+        Case('list_changes', lambda: get('/shopcarts/changes?limit=100')),
+        Case('add_product', lambda line: send('POST', '/shopcarts', line, status.HTTP_201_CREATED),
+             lambda: (new_line(),)),
+        Case('add_batch', lambda batch: send('POST', '/shopcarts/batch', batch, status.HTTP_200_OK),
+             lambda: ([new_line() for _ in range(100)],), repeat=0.2),
+        Case('update_product',
+             lambda user_id, product_id: send('PUT', '/shopcarts/{}/product/{}'.format(user_id, product_id),
+                                              {'user_id': user_id, 'product_id': product_id,
+                                               'quantity': rng.randint(1, 5), 'price': 10.0},
+                                              status.HTTP_200_OK),
+             existing_line),
+        Case('delete_product',
+             lambda user_id, product_id: expect(client.delete('/shopcarts/{}/product/{}'.format(user_id, product_id)),
+                                                status.HTTP_204_NO_CONTENT),
+             added_line),
+        Case('delete_shopcart',
+             lambda user_id, product_id: expect(client.delete('/shopcarts/{}'.format(user_id)),
+                                                status.HTTP_204_NO_CONTENT),
+             added_line),
+    ]
+
+def main(argv=None):
+    """ Seeds the database, runs the endpoint cases and checks them against the baseline """
+    parser = argparse.ArgumentParser(description='Benchmarks the endpoints of the Shopcart service')
+    parser.add_argument('--lines', type=int, default=1000, help='shopcart lines to seed (1000 to 1000000)')
+    parser.add_argument('--users', type=int, help='users holding the lines (lines / 10 by default)')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the cart sizes')
+    parser.add_argument('--iterations', type=int, default=200, help='runs of each case')
+    parser.add_argument('--database-uri', default='sqlite:///../db/bench.db',
+                        help='database to seed, its content is replaced')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='file holding the baseline results')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='fraction by which a case may be slower than the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the service while running')
+    args = parser.parse_args(argv)
+
+    service.app.debug = False
+    service.initialize_logging(getattr(logging, args.log_level.upper()))
+    service.app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    client = service.app.test_client()
+    client.get('/healthcheck')    # let the before_first_request hooks run
+
+    data = CartData(args.lines, args.users, args.skew)
+    seed_database(data)
+    results = run_cases(endpoint_cases(client, data, random.Random(data.seed)), args.iterations)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, BENCHMARK, args.lines, results)
+        print('Saved the baseline of {} lines in {}'.format(args.lines, args.baseline))
+        return 0
+    return check_baseline(args.baseline, BENCHMARK, args.lines, results, args.tolerance)
+
+if __name__ == '__main__':
+    sys.exit(main())
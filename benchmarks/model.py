@@ -0,0 +1,167 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Shopcart Model Microbenchmarks
+
+Times the Shopcart finders and writes without the HTTP layer, next to the
+same queries written with SQLAlchemy Core, at several table sizes
+
+Run them with:
+  python -m benchmarks.model --sizes 1000,10000,100000
+
+Each session is discarded before a timed call, as at the end of a request,
+so the ORM cases pay for loading their instances. The exit status is 1 when
+a case regressed past the stored baseline, or when its median time grows
+faster than <max-exponent> powers of the table size.
+"""
+import sys
+import math
+import random
+import logging
+import argparse
+from sqlalchemy import select, distinct, and_
+from app import service
+from app.model import Shopcart, ShopcartTotal, db
+from benchmarks.data import CartData
+from benchmarks.endpoints import seed_database, NEW_USER_OFFSET
+from benchmarks.runner import Case, run_cases, save_baseline, check_baseline, BASELINE_FILE
+
+BENCHMARK = 'model'
+# Total value of the shopcarts looked up by the amount finders
+AMOUNT = 100
+
+def model_cases(data, rng):
+    """ Returns the ORM cases with their Core counterparts """
+    shopcarts = Shopcart.__table__
+    totals = ShopcartTotal.__table__
+    lines = data.sample(1000)
+    new_users = iter(xrange(NEW_USER_OFFSET, sys.maxint))
+    entry = {'user_id': 1, 'product_id': 1, 'quantity': 2, 'price': 10.0}
+    loaded = []
+
+    def fresh_session(*args):
+        # Outside of the timing, as a request would start with an empty session
+        db.session.remove()
+        return args
+
+    def existing_line():
+        return fresh_session(*rng.choice(lines))
+
+    def skewed_user():
+        return fresh_session(data.pick_user(rng))
+
+    def loaded_entry():
+        if not loaded:
+            loaded.append(Shopcart.find(*lines[0]))
+        return (loaded[0],)
+
+    def changed_entry():
+        shopcart = Shopcart.find(*existing_line())
+        shopcart.quantity = rng.randint(1, 5)
+        return (shopcart,)
+
+    def new_entry():
+        return (Shopcart(user_id=next(new_users), product_id=rng.randint(1, data.products),
+                         quantity=1, price=10.0),)
+
+    def reseeded():
+        seed_database(data, quiet=True)
+        return fresh_session()
+
+    def execute(statement):
+        return db.session.execute(statement).fetchall()
+
+    return [
+        Case('find', Shopcart.find, existing_line),
+        Case('find_core', lambda user_id, product_id: execute(
+            select([shopcarts]).where(and_(shopcarts.c.user_id == user_id,
+                                           shopcarts.c.product_id == product_id))), existing_line),
+        Case('findByUserId', lambda user_id: Shopcart.findByUserId(user_id).all(), skewed_user),
+        Case('findByUserId_core', lambda user_id: execute(
+            select([shopcarts]).where(shopcarts.c.user_id == user_id)), skewed_user),
+        Case('all', Shopcart.all, fresh_session, repeat=0.1),
+        Case('all_by_user_core', Shopcart.all_by_user, fresh_session, repeat=0.1),
+        Case('list_users', Shopcart.list_users, fresh_session, repeat=0.25),
+        Case('list_users_core', lambda: execute(select([distinct(shopcarts.c.user_id)])),
+             fresh_session, repeat=0.25),
+        Case('find_users_by_shopcart_amount', lambda: Shopcart.find_users_by_shopcart_amount(AMOUNT),
+             fresh_session, repeat=0.25),
+        Case('find_users_by_shopcart_amount_core', lambda: execute(
+            select([totals]).where(and_(totals.c.total_price >= AMOUNT, totals.c.item_count > 0))
+            .order_by(totals.c.user_id)), fresh_session, repeat=0.25),
+        Case('serialize', lambda shopcart: shopcart.serialize(), loaded_entry, repeat=10),
+        Case('deserialize', lambda: Shopcart().deserialize(entry), repeat=10),
+        Case('save_new', lambda shopcart: shopcart.save(), new_entry),
+        Case('save_update', lambda shopcart: shopcart.save(), changed_entry),
+        # Last, as it empties the tables, which every run seeds again
+        Case('remove_all', Shopcart.remove_all, reseeded, repeat=0.02, warmup=0),
+    ]
+
+def scaling_exponents(results_by_size):
+    """
+    Returns how fast the median time of each case grows with the table size,
+    as the largest exponent k with time ~ size ** k between two sizes in a row
+    """
+    sizes = sorted(results_by_size)
+    exponents = {}
+    for smaller, larger in zip(sizes, sizes[1:]):
+        for name, result in results_by_size[larger].items():
+            before = results_by_size[smaller].get(name)
+            if not before or not before['p50_ms'] or not result['p50_ms']:
+                continue
+            exponent = math.log(result['p50_ms'] / before['p50_ms']) / math.log(float(larger) / smaller)
+            exponents[name] = max(exponents.get(name, exponent), exponent)
+    return exponents
+
+def main(argv=None):
+    """ Runs the model cases at every size and checks them against the baseline and their scaling """
+    parser = argparse.ArgumentParser(description='Benchmarks the Shopcart model methods')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated shopcart lines to seed')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the cart sizes')
+    parser.add_argument('--iterations', type=int, default=200, help='runs of each case')
+    parser.add_argument('--database-uri', default='sqlite:///../db/bench.db',
+                        help='database to seed, its content is replaced')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='file holding the baseline results')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='fraction by which a case may be slower than the baseline')
+    parser.add_argument('--max-exponent', type=float, default=1.3,
+                        help='fastest growth of a median time allowed, as a power of the table size')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    service.app.debug = False
+    service.initialize_logging(logging.WARNING)
+    service.app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    Shopcart.init_db()
+
+    failed = 0
+    results_by_size = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        data = CartData(size, skew=args.skew)
+        seed_database(data)
+        results = run_cases(model_cases(data, random.Random(data.seed)), args.iterations)
+        results_by_size[size] = results
+        if args.save_baseline:
+            save_baseline(args.baseline, BENCHMARK, size, results)
+        else:
+            failed |= check_baseline(args.baseline, BENCHMARK, size, results, args.tolerance)
+
+    for name, exponent in sorted(scaling_exponents(results_by_size).items()):
+        over = exponent > args.max_exponent
+        print('{} {:<36} grows as size ** {:.2f}'.format('SUPER-LINEAR' if over else 'scaling', name, exponent))
+        failed |= over
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
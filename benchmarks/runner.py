@@ -0,0 +1,133 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark Runner
+
+Times the cases of a benchmark, reports their throughput and latency
+percentiles, and compares them with a stored baseline
+
+A baseline is a JSON file keyed by benchmark and data size, so the results
+of one size are only compared with the baseline taken at the same size.
+"""
+import os
+import json
+import time
+
+# Baselines stored with the benchmarks
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+class Case(object):
+    """
+    One operation to time
+
+    <prepare> is called before each run, outside of the timing, and returns the
+    arguments given to <run>. <repeat> scales the number of iterations of the
+    case, so slow cases can run fewer times, and <warmup> untimed runs come
+    first.
+    """
+
+    def __init__(self, name, run, prepare=None, repeat=1.0, warmup=5):
+        self.name = name
+        self.run = run
+        self.prepare = prepare or (lambda: ())
+        self.repeat = repeat
+        self.warmup = warmup
+
+def percentile(durations, fraction):
+    """ Returns the nearest rank percentile of the sorted <durations> """
+    index = max(0, int(round(fraction * len(durations))) - 1)
+    return durations[min(index, len(durations) - 1)]
+
+def measure(case, iterations):
+    """ Runs <case> and returns its ops/sec and p50, p95 and p99 latencies in milliseconds """
+    iterations = max(3, int(iterations * case.repeat))
+    for _ in range(min(case.warmup, iterations)):
+        case.run(*case.prepare())
+    durations = []
+    for _ in range(iterations):
+        args = case.prepare()
+        start = time.time()
+        case.run(*args)
+        durations.append(time.time() - start)
+    durations.sort()
+    return {'iterations': iterations,
+            'ops_per_sec': round(len(durations) / sum(durations), 1) if sum(durations) else 0.0,
+            'p50_ms': round(percentile(durations, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(durations, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(durations, 0.99) * 1000, 3)}
+
+def run_cases(cases, iterations):
+    """ Measures every case and returns the results keyed by case name """
+    results = {}
+    for case in cases:
+        results[case.name] = measure(case, iterations)
+        print_result(case.name, results[case.name])
+    return results
+
+def print_result(name, result):
+    """ Prints the measurements of one case on a line """
+    print('{:<36} {:>6} runs {:>10.1f} ops/s  p50 {:>9.3f} ms  p95 {:>9.3f} ms  p99 {:>9.3f} ms'
+          .format(name, result['iterations'], result['ops_per_sec'],
+                  result['p50_ms'], result['p95_ms'], result['p99_ms']))
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Returns a message for every case that got slower than the baseline
+
+    A case regresses when its ops/sec drops, or its p95 grows, by more
+    than <tolerance> (a fraction) of the baseline value
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        if result['ops_per_sec'] < expected['ops_per_sec'] * (1 - tolerance):
+            regressions.append('{}: {} ops/s is below the baseline of {} ops/s'
+                               .format(name, result['ops_per_sec'], expected['ops_per_sec']))
+        if result['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 of {} ms is above the baseline of {} ms'
+                               .format(name, result['p95_ms'], expected['p95_ms']))
+    return regressions
+
+def load_baseline(filename, benchmark, size):
+    """ Returns the baseline results of <benchmark> at <size>, or an empty dictionary """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as data:
+        return json.load(data).get(benchmark, {}).get(str(size), {})
+
+def save_baseline(filename, benchmark, size, results):
+    """ Stores <results> as the baseline of <benchmark> at <size>, keeping the other baselines """
+    baselines = {}
+    if os.path.exists(filename):
+        with open(filename) as data:
+            baselines = json.load(data)
+    baselines.setdefault(benchmark, {})[str(size)] = results
+    with open(filename, 'w') as out:
+        json.dump(baselines, out, indent=2, sort_keys=True, separators=(',', ': '))
+        out.write('\n')
+
+def check_baseline(filename, benchmark, size, results, tolerance):
+    """ Prints the regressions against the baseline and returns the exit status of the benchmark """
+    baseline = load_baseline(filename, benchmark, size)
+    if not baseline:
+        print('No baseline for {} at size {} in {}'.format(benchmark, size, filename))
+        return 0
+    regressions = find_regressions(results, baseline, tolerance)
+    for message in regressions:
+        print('REGRESSION ' + message)
+    if not regressions:
+        print('No regression past {:.0%} of the baseline'.format(tolerance))
+    return 1 if regressions else 0
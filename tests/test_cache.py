@@ -0,0 +1,95 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Cart Cache
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from mock import patch
+from app.cache import CartCache
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestCartCache(unittest.TestCase):
+
+    """ Test Cases for the Cart Cache """
+
+    def setUp(self):
+        self.cache = CartCache(size=2, ttl=10)
+
+    def test_get_and_put(self):
+        """ Cache a shopcart and read it back """
+        self.assertIsNone(self.cache.get(1))
+        self.cache.put(1, [{'product_id': 1}], self.cache.generation())
+        self.assertEqual(self.cache.get(1), [{'product_id': 1}])
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+    def test_evict_least_recently_used(self):
+        """ Evict the least recently used shopcart when the cache is full """
+        self.cache.put(1, [], self.cache.generation())
+        self.cache.put(2, [], self.cache.generation())
+        self.cache.get(1)
+        self.cache.put(3, [], self.cache.generation())
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), [])
+        self.assertEqual(self.cache.get(3), [])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_expire(self):
+        """ Expire a shopcart after its time to live """
+        with patch('app.cache.time.time', return_value=100.0):
+            self.cache.put(1, [], self.cache.generation())
+        with patch('app.cache.time.time', return_value=110.0):
+            self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_invalidate(self):
+        """ Invalidate the shopcarts of some users """
+        self.cache.put(1, [], self.cache.generation())
+        self.cache.put(2, [], self.cache.generation())
+        self.cache.invalidate([1])
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.get(2), [])
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.stats()['invalidations'], 2)
+
+    def test_drop_put_after_invalidate(self):
+        """ Don't cache a shopcart that was loaded before a write """
+        generation = self.cache.generation()
+        self.cache.invalidate([1])
+        self.cache.put(1, [{'product_id': 1}], generation)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_disabled(self):
+        """ Cache nothing when the size is 0 """
+        self.cache.configure(0, 10)
+        self.cache.put(1, [], self.cache.generation())
+        self.assertIsNone(self.cache.get(1))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
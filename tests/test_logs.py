@@ -0,0 +1,138 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Log Handlers
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import logging
+import Queue
+from mock import patch
+from app import app
+from app.logs import QueueHandler, QueueListener, RequestSampler, request_log_handlers, \
+    start_queued_logging
+
+class ListHandler(logging.Handler):
+    """ Keeps the formatted records in a list """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestLogHandlers(unittest.TestCase):
+
+    """ Test Cases for the Log Handlers """
+
+    def setUp(self):
+        self.output = ListHandler()
+        self.logger = logging.getLogger('tests.logs')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        del self.logger.handlers[:]
+
+    def test_queued_records_are_written(self):
+        """ Write the queued records on the listener thread """
+        queue = Queue.Queue()
+        listener = QueueListener(queue, self.output)
+        listener.start()
+        self.logger.addHandler(QueueHandler(queue))
+        self.logger.info('Shopcart of user %s', 1)
+        try:
+            raise ValueError('bad quantity')
+        except ValueError:
+            self.logger.exception('Update failed')
+        listener.stop()
+        self.assertEqual(self.output.messages[0], 'Shopcart of user 1')
+        self.assertTrue(self.output.messages[1].startswith('Update failed\nTraceback'))
+        self.assertIn('ValueError: bad quantity', self.output.messages[1])
+
+    def test_prepare_drops_the_arguments(self):
+        """ Merge the arguments into the message before queuing the record """
+        queue = Queue.Queue()
+        self.logger.addHandler(QueueHandler(queue))
+        self.logger.info('Payload = %s', {'user_id': 1})
+        record = queue.get_nowait()
+        self.assertEqual(record.msg, "Payload = {'user_id': 1}")
+        self.assertIsNone(record.args)
+
+    def test_listener_skips_lower_levels(self):
+        """ Only give the handlers the records at their level """
+        self.output.setLevel(logging.WARNING)
+        listener = QueueListener(Queue.Queue(), self.output)
+        listener.handle(self.logger.makeRecord('tests.logs', logging.INFO, __file__, 1, 'info', None, None))
+        listener.handle(self.logger.makeRecord('tests.logs', logging.ERROR, __file__, 1, 'error', None, None))
+        self.assertEqual(self.output.messages, ['error'])
+
+    def test_request_sampling(self):
+        """ Drop the INFO records of the requests that were not sampled """
+        self.output.addFilter(RequestSampler(0.0))
+        self.logger.addHandler(self.output)
+        self.logger.info('outside of a request')
+        with app.test_request_context('/shopcarts/1'):
+            self.logger.info('not sampled')
+            self.logger.warning('always kept')
+        self.assertEqual(self.output.messages, ['outside of a request', 'always kept'])
+
+    def test_sampled_request_is_logged_whole(self):
+        """ Keep every record of a sampled request """
+        self.output.addFilter(RequestSampler(1.0))
+        self.logger.addHandler(self.output)
+        with app.test_request_context('/shopcarts/1'):
+            self.logger.info('first')
+            self.logger.debug('second')
+        self.assertEqual(self.output.messages, ['first', 'second'])
+
+    def test_listener_starts_in_each_process(self):
+        """ Start the listener with the first record, again in a forked worker """
+        handler = start_queued_logging([self.output])
+        self.logger.addHandler(handler)
+        listener = handler.listener
+        self.assertFalse(listener.running())
+        with patch('atexit.register') as register:
+            self.logger.info('in the master')
+            self.assertTrue(listener.running())
+            master_queue, master_thread = listener.queue, listener._thread
+            # A worker forked from the master, without the thread of the listener
+            with patch('os.getpid', return_value=os.getpid() + 1):
+                self.assertFalse(listener.running())
+                self.logger.info('in the worker')
+                self.assertTrue(listener.running())
+                self.assertIsNot(handler.queue, master_queue)
+                listener.stop()
+            self.assertEqual(register.call_count, 2)
+        master_queue.put(None)
+        master_thread.join()
+        self.assertEqual(sorted(self.output.messages), ['in the master', 'in the worker'])
+
+    def test_request_log_handlers(self):
+        """ Queue and sample the handlers of the app logger as configured """
+        self.assertEqual(request_log_handlers([self.output]), [self.output])
+        handlers = request_log_handlers([self.output], queued=True, sample_rate=0.5)
+        self.assertEqual(len(handlers), 1)
+        self.assertIsInstance(handlers[0], QueueHandler)
+        self.assertIsInstance(handlers[0].filters[0], RequestSampler)
@@ -0,0 +1,87 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Request Metrics
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from app.metrics import RequestMetrics
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestRequestMetrics(unittest.TestCase):
+
+    """ Test Cases for the Request Metrics """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_render(self):
+        """ Render the counters and histograms in the Prometheus text format """
+        metrics = RequestMetrics(buckets=(0.01, 0.1))
+        metrics.observe('ShopcartResource', 'GET', 200, 0.005)
+        metrics.observe('ShopcartResource', 'GET', 404, 0.05)
+        metrics.observe('ShopcartResource', 'GET', 200, 0.5)
+        text = metrics.render()
+        self.assertIn('shopcart_http_requests_total{resource="ShopcartResource",method="GET",status="200"} 2', text)
+        self.assertIn('shopcart_http_requests_total{resource="ShopcartResource",method="GET",status="404"} 1', text)
+        self.assertIn('shopcart_http_request_duration_seconds_bucket{resource="ShopcartResource",method="GET",le="0.01"} 1', text)
+        self.assertIn('shopcart_http_request_duration_seconds_bucket{resource="ShopcartResource",method="GET",le="0.1"} 2', text)
+        self.assertIn('shopcart_http_request_duration_seconds_bucket{resource="ShopcartResource",method="GET",le="+Inf"} 3', text)
+        self.assertIn('shopcart_http_request_duration_seconds_count{resource="ShopcartResource",method="GET"} 3', text)
+        self.assertIn('# TYPE shopcart_http_request_duration_seconds histogram', text)
+
+    def test_reset(self):
+        """ Set the counters back to zero """
+        metrics = RequestMetrics()
+        metrics.observe('ProductResource', 'PUT', 200, 0.01)
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {'requests': [], 'latency': []})
+
+    def test_workers_are_added_up(self):
+        """ Add up the counters written by every worker """
+        other = RequestMetrics(self.directory, buckets=(0.01,))
+        other.observe('ShopcartCollection', 'POST', 201, 0.001)
+        other.flush()
+        # Rename the file as if another process had written it
+        os.rename(os.path.join(self.directory, 'metrics_{}.json'.format(os.getpid())),
+                  os.path.join(self.directory, 'metrics_1.json'))
+        metrics = RequestMetrics(self.directory, buckets=(0.01,))
+        metrics.observe('ShopcartCollection', 'POST', 201, 0.02)
+        text = metrics.render()
+        self.assertIn('shopcart_http_requests_total{resource="ShopcartCollection",method="POST",status="201"} 2', text)
+        self.assertIn('shopcart_http_request_duration_seconds_bucket{resource="ShopcartCollection",method="POST",le="0.01"} 1', text)
+        self.assertIn('shopcart_http_request_duration_seconds_count{resource="ShopcartCollection",method="POST"} 2', text)
+
+    def test_flush_interval(self):
+        """ Write the counters of a worker at most once per flush interval """
+        metrics = RequestMetrics(self.directory, flush_interval=60)
+        metrics.observe('ShopcartAction', 'GET', 200, 0.01)
+        metrics.observe('ShopcartAction', 'GET', 200, 0.01)
+        with open(os.path.join(self.directory, 'metrics_{}.json'.format(os.getpid()))) as data:
+            snapshot = json.load(data)
+        self.assertEqual(snapshot['requests'], [['ShopcartAction', 'GET', '200', 1]])
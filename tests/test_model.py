@@ -21,7 +21,10 @@ Test cases can be run with:
 
 import unittest
 import os
-from app.model import Shopcart, DataValidationError, db
+import threading
+from datetime import datetime
+from mock import patch
+from app.model import Shopcart, ShopcartTotal, ShopcartChange, CartLine, DataValidationError, ConcurrentUpdateError, db
 from app.service import app
 
 DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
@@ -49,6 +52,7 @@ class TestShopcarts(unittest.TestCase):
         Shopcart.init_db()
         db.drop_all()    # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
+        Shopcart.cache.clear()
 
     def tearDown(self):
         db.session.remove()
@@ -121,6 +125,112 @@ class TestShopcarts(unittest.TestCase):
         result = Shopcart.find_users_by_shopcart_amount(13)
         self.assertEqual(result, [1])
 
+    def test_totals_are_maintained(self):
+        """ Keep the shopcart totals up to date on every write """
+        shopcart = Shopcart(user_id=1, product_id=1, quantity=2, price=10.00)
+        shopcart.save()
+        total = Shopcart.find_total(1)
+        self.assertEqual((total.item_count, total.total_price), (1, 20.00))
+        self.assertIsNotNone(total.last_modified)
+        Shopcart.add(user_id=1, product_id=2, quantity=1, price=5.00)
+        Shopcart.upsert_many([{'user_id': 1, 'product_id': 2, 'quantity': 1, 'price': 5.00},
+                              {'user_id': 2, 'product_id': 1, 'quantity': 1, 'price': 1.00}])
+        self.assertEqual(Shopcart.find_total(1).serialize()['total_price'], 30.00)
+        self.assertEqual(Shopcart.find_total(1).item_count, 2)
+        self.assertEqual(Shopcart.find_total(2).total_price, 1.00)
+        shopcart.delete()
+        self.assertEqual(Shopcart.find_total(1).total_price, 10.00)
+        Shopcart.remove_by_user(1)
+        self.assertEqual(Shopcart.find_total(1).item_count, 0)
+        self.assertEqual(Shopcart.find_users_by_shopcart_amount(0), [2])
+        Shopcart.remove_all()
+        self.assertEqual(Shopcart.find_total(2).item_count, 0)
+        self.assertEqual(Shopcart.find_users_by_shopcart_amount(0), [])
+
+    @unittest.skipIf(DATABASE_URI.startswith('sqlite'), 'SQLite runs one write at a time')
+    def test_totals_of_concurrent_writes(self):
+        """ Count every entry when two requests write the same shopcart at once """
+        def add_products(user_id, first):
+            try:
+                for product_id in range(first, 40, 2):
+                    Shopcart.add(user_id, product_id, 1, 1.00)
+            finally:
+                db.session.remove()
+        for user_id in range(1, 6):
+            threads = [threading.Thread(target=add_products, args=(user_id, first)) for first in (0, 1)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        for user_id in range(1, 6):
+            total = Shopcart.find_total(user_id)
+            self.assertEqual((total.item_count, total.total_price), (40, 40.00))
+
+    def test_versions_increase_on_every_write(self):
+        """ Increase the version of a shopcart on every write """
+        self.assertEqual(Shopcart.find_version(1), 0)
+        shopcart = Shopcart(user_id=1, product_id=1, quantity=2, price=10.00)
+        shopcart.save()
+        self.assertEqual(Shopcart.find_version(1), 1)
+        shopcart.quantity = 3
+        shopcart.save()
+        Shopcart.add(user_id=1, product_id=2, quantity=1, price=5.00)
+        self.assertEqual(Shopcart.find_version(1), 3)
+        self.assertEqual(Shopcart.find_versioned_cart(1)[0], 3)
+        Shopcart.remove_by_user(1)
+        self.assertEqual(Shopcart.find_version(1), 4)
+        Shopcart.remove_all()
+        self.assertEqual(Shopcart.find_version(1), 5)
+        Shopcart.rebuild_totals()
+        self.assertEqual(Shopcart.find_version(1), 6)
+        self.assertEqual(Shopcart.find_versioned_cart(1), (6, []))
+
+    def test_rebuild_totals(self):
+        """ Rebuild the shopcart totals from the shopcart entries """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=10.00).save()
+        Shopcart(user_id=2, product_id=1, quantity=1, price=3.00).save()
+        ShopcartTotal.query.delete()
+        db.session.commit()
+        Shopcart.rebuild_totals()
+        self.assertEqual(Shopcart.find_total(1).total_price, 20.00)
+        self.assertEqual(Shopcart.find_total(2).item_count, 1)
+
+    def test_init_db_fills_in_missing_totals(self):
+        """ Add the totals of the shopcarts of a database from before they were kept """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=10.00).save()
+        ShopcartTotal.query.delete()
+        db.session.commit()
+        Shopcart.init_db()
+        self.assertEqual(Shopcart.find_total(1).total_price, 20.00)
+        # The totals that are there are left alone
+        Shopcart.init_db()
+        self.assertEqual(Shopcart.find_version(1), 1)
+
+    def test_init_db_adds_the_version_column(self):
+        """ Add the version of the entries to a shopcart table from before it was kept """
+        db.drop_all()
+        db.engine.execute('CREATE TABLE shopcart (user_id INTEGER NOT NULL, product_id INTEGER NOT NULL, '
+                          'quantity INTEGER, price FLOAT, PRIMARY KEY (user_id, product_id))')
+        db.engine.execute('INSERT INTO shopcart VALUES (1, 1, 2, 10.0)')
+        Shopcart.init_db()
+        shopcart = Shopcart.find(1, 1)
+        self.assertEqual(shopcart.version, 1)
+        shopcart.quantity = 3
+        shopcart.save()
+        self.assertEqual(Shopcart.find(1, 1).version, 2)
+        self.assertEqual(Shopcart.find_total(1).total_price, 30.00)
+
+    def test_find_totals_by_amount(self):
+        """ Find the most valuable shopcarts a page at a time """
+        for user_id, price in [(1, 10.00), (2, 30.00), (3, 20.00), (4, 20.00), (5, 1.00)]:
+            Shopcart(user_id=user_id, product_id=1, quantity=1, price=price).save()
+        totals = Shopcart.find_totals_by_amount(5, sort='total_desc', limit=2)
+        self.assertEqual([t.user_id for t in totals], [2, 3])
+        totals = Shopcart.find_totals_by_amount(5, sort='total_desc', after=(20.00, 3))
+        self.assertEqual([t.user_id for t in totals], [4, 1])
+        totals = Shopcart.find_totals_by_amount(5, limit=2, after=(2,))
+        self.assertEqual([t.user_id for t in totals], [3, 4])
+
     def test_create_a_shopcart_entry(self):
         """ Create a shopcart entry and assert that it exists """
         shopcart = Shopcart(user_id=999, product_id=999, quantity=999, price=999.99)
@@ -160,6 +270,26 @@ class TestShopcarts(unittest.TestCase):
         self.assertEqual(item.quantity, 888)
 
 
+    def test_update_a_changed_shopcart_entry(self):
+        """ Reject an update of a shopcart entry that was changed after it was read """
+        Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
+        shopcart = Shopcart.find(1, 1)
+        self.assertEqual(shopcart.version, 1)
+        db.session.expunge(shopcart)
+        # another request changes the entry after it was read
+        self.assertEqual(Shopcart.add(user_id=1, product_id=1, quantity=1, price=12.00).version, 2)
+        db.session.add(shopcart)
+        shopcart.quantity = 5
+        self.assertRaises(ConcurrentUpdateError, shopcart.save)
+        self.assertEqual(Shopcart.find(1, 1).quantity, 2)
+
+        shopcart = Shopcart.find(1, 1)
+        db.session.expunge(shopcart)
+        Shopcart.add(user_id=1, product_id=1, quantity=1, price=12.00)
+        db.session.add(shopcart)
+        self.assertRaises(ConcurrentUpdateError, shopcart.delete)
+        self.assertEqual(Shopcart.find(1, 1).quantity, 3)
+
     def test_delete_a_shopcart_entry(self):
         """ Delete a shopcart entry """
         shopcart = Shopcart(user_id=999, product_id=999, quantity=999, price=999.99)
@@ -182,6 +312,171 @@ class TestShopcarts(unittest.TestCase):
 
 
 
+    def test_page(self):
+        """ Find a page of shopcart entries after a key """
+        for user_id, product_id in [(2, 1), (1, 2), (1, 1), (3, 1)]:
+            Shopcart(user_id=user_id, product_id=product_id, quantity=1, price=1.00).save()
+        page = Shopcart.page(2)
+        self.assertEqual([(s.user_id, s.product_id) for s in page], [(1, 1), (1, 2)])
+        page = Shopcart.page(2, after=(1, 2))
+        self.assertEqual([(s.user_id, s.product_id) for s in page], [(2, 1), (3, 1)])
+        page = Shopcart.page(5, after=(1, 1), user_id=1)
+        self.assertEqual([(s.user_id, s.product_id) for s in page], [(1, 2)])
+
+    def test_upsert_many(self):
+        """ Add many shopcart entries at once """
+        Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
+        count = Shopcart.upsert_many([
+            {'user_id': 1, 'product_id': 1, 'quantity': 2, 'price': 10.00},
+            {'user_id': 2, 'product_id': 1, 'quantity': 1, 'price': 5.00},
+            {'user_id': 2, 'product_id': 1, 'quantity': 3, 'price': 5.00},
+            {'user_id': 3, 'product_id': 4, 'quantity': 1, 'price': 7.00}], chunk_size=2)
+        self.assertEqual(count, 3)
+        self.assertEqual(len(Shopcart.all()), 3)
+        self.assertEqual(Shopcart.find(1, 1).quantity, 3)
+        self.assertEqual(Shopcart.find(1, 1).price, 12.00)
+        self.assertEqual(Shopcart.find(2, 1).quantity, 4)
+        self.assertEqual(Shopcart.find(3, 4).price, 7.00)
+
+    def test_add(self):
+        """ Add a product to a shopcart and add more of it """
+        shopcart = Shopcart.add(user_id=1, product_id=1, quantity=2, price=12.00)
+        self.assertEqual(shopcart.serialize(), {'user_id': 1, 'product_id': 1,
+                                                'quantity': 2, 'price': 12.00})
+        existing = Shopcart.find(1, 1)
+        shopcart = Shopcart.add(user_id=1, product_id=1, quantity=3, price=10.00)
+        self.assertEqual(shopcart.quantity, 5)
+        self.assertEqual(shopcart.price, 12.00)
+        self.assertEqual(Shopcart.find(1, 1).quantity, 5)
+        self.assertEqual(existing.quantity, 5)
+
+    def test_upsert_many_without_native_upsert(self):
+        """ Add many shopcart entries on a database without an upsert statement """
+        Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
+        with patch.dict('app.model.UPSERT_SQL', clear=True):
+            Shopcart.upsert_many([
+                {'user_id': 1, 'product_id': 1, 'quantity': 2, 'price': 10.00},
+                {'user_id': 2, 'product_id': 1, 'quantity': 1, 'price': 5.00}])
+        self.assertEqual(Shopcart.find(1, 1).quantity, 3)
+        self.assertEqual(Shopcart.find(2, 1).quantity, 1)
+
+    def test_find_cart(self):
+        """ Find the shopcart of a user through the cache """
+        Shopcart(user_id=1, product_id=2, quantity=1, price=12.00).save()
+        Shopcart(user_id=1, product_id=1, quantity=3, price=10.00).save()
+        cart = Shopcart.find_cart(1)
+        self.assertEqual([entry['product_id'] for entry in cart], [1, 2])
+        self.assertIs(Shopcart.find_cart(1), cart)
+        self.assertEqual(Shopcart.find_in_cart(1, 1)['quantity'], 3)
+        self.assertIsNone(Shopcart.find_in_cart(1, 3))
+        self.assertEqual(Shopcart.find_cart(2), [])
+
+    def test_cart_line(self):
+        """ Read a CartLine like a serialized Shopcart """
+        line = CartLine(1, 2, 3, 4.5, 1)
+        self.assertEqual(line['quantity'], 3)
+        self.assertEqual(line.get('price'), 4.5)
+        self.assertIsNone(line.get('serialize'))
+        self.assertRaises(KeyError, lambda: line['total'])
+        self.assertEqual(line.serialize(), {'user_id': 1, 'product_id': 2, 'quantity': 3, 'price': 4.5})
+        self.assertEqual(line, CartLine(1, 2, 3, 4.5, 1))
+        self.assertNotEqual(line, CartLine(1, 2, 3, 4.5, 2))
+        self.assertFalse(hasattr(line, '__dict__'))
+
+    def test_read_finders_skip_the_orm(self):
+        """ Read every entry without loading Shopcart instances """
+        Shopcart(user_id=2, product_id=1, quantity=1, price=5.00).save()
+        Shopcart(user_id=1, product_id=2, quantity=2, price=6.00).save()
+        db.session.remove()
+        lines = Shopcart.all_by_user()
+        self.assertEqual([(line.user_id, line.product_id) for line in lines], [(1, 2), (2, 1)])
+        self.assertTrue(all(isinstance(line, CartLine) for line in lines))
+        self.assertEqual(list(Shopcart.stream_by_user(batch_size=1)), lines)
+        self.assertEqual(Shopcart.find_cart(1), [CartLine(1, 2, 2, 6.00, 1)])
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_change_log(self):
+        """ Log every write of the shopcarts in the change log """
+        Shopcart.upsert_many([{'user_id': 1, 'product_id': 1, 'quantity': 1, 'price': 2.0},
+                              {'user_id': 2, 'product_id': 1, 'quantity': 1, 'price': 3.0}])
+        Shopcart.upsert_many([{'user_id': 1, 'product_id': 1, 'quantity': 2, 'price': 2.0}])
+        Shopcart.remove_by_user(2)
+        changes, after = Shopcart.changes_since([(0, 0)], 10)
+        self.assertEqual([(change.operation, change.user_id, change.quantity, change.version)
+                          for change in changes],
+                         [('add', 1, 1, 1), ('add', 2, 1, 1), ('update', 1, 3, 2), ('delete', 2, 1, 1)])
+        # Every change committed by the read gets the number of the read
+        self.assertEqual([change.seq for change in changes], [1, 1, 1, 1])
+        self.assertEqual(after, ((1, changes[-1].id),))
+        changes, after = Shopcart.changes_since([(1, changes[0].id)], 2)
+        self.assertEqual([change.operation for change in changes], ['add', 'update'])
+        self.assertEqual(after, ((1, changes[-1].id),))
+        Shopcart.add(user_id=1, product_id=2, quantity=1, price=1.0)
+        changes, after = Shopcart.changes_since(after, 10)
+        self.assertEqual([(change.operation, change.product_id, change.seq) for change in changes],
+                         [('delete', 1, 1), ('add', 2, 3)])
+
+    def test_change_log_follows_commit_order(self):
+        """ Read a change that commits after a reader went past it, even with a lower id """
+        Shopcart.add(user_id=1, product_id=1, quantity=1, price=1.0)
+        changes, after = Shopcart.changes_since([(0, 0)], 10)
+        self.assertEqual(len(changes), 1)
+        # Logged before the first change, by a transaction that committed after the read
+        db.session.add(ShopcartChange(id=changes[0].id - 1, user_id=2, product_id=1, operation='add',
+                                      quantity=1, price=1.0, version=1, changed_at=datetime.utcnow()))
+        db.session.commit()
+        changes, after = Shopcart.changes_since(after, 10)
+        self.assertEqual([change.user_id for change in changes], [2])
+        self.assertEqual(Shopcart.changes_since(after, 10), ([], after))
+
+    def test_remove_all_logs_a_reset(self):
+        """ Log one reset for the removal of every entry instead of a delete each """
+        for user_id in range(1, 4):
+            Shopcart(user_id=user_id, product_id=1, quantity=1, price=1.0).save()
+        changes, after = Shopcart.changes_since([(0, 0)], 10)
+        Shopcart.remove_all()
+        for user_id in range(1, 4):
+            Shopcart(user_id=user_id, product_id=1, quantity=1, price=1.0).save()
+        Shopcart.remove_all(chunk_size=2)
+        changes, after = Shopcart.changes_since(after, 10)
+        self.assertEqual([(change.operation, change.user_id, change.product_id) for change in changes],
+                         [('reset', None, None), ('add', 1, 1), ('add', 2, 1), ('add', 3, 1),
+                          ('reset', 2, None), ('reset', None, None)])
+        self.assertEqual(changes[0].serialize()['operation'], 'reset')
+
+    def test_change_log_keeps_the_last_changes(self):
+        """ Drop the oldest changes beyond CHANGE_LOG_MAX_ROWS as the log is read """
+        with patch.dict(app.config, {'CHANGE_LOG_MAX_ROWS': 2}):
+            for product_id in range(1, 5):
+                Shopcart.add(user_id=1, product_id=product_id, quantity=1, price=1.0)
+            changes, after = Shopcart.changes_since([(0, 0)], 10)
+            self.assertEqual(len(changes), 4)
+            # The changes that were just numbered are kept until the next read
+            changes, after = Shopcart.changes_since([(0, 0)], 10)
+            self.assertEqual([change.product_id for change in changes], [3, 4])
+            self.assertEqual(ShopcartChange.query.count(), 2)
+
+    def test_writes_invalidate_cart_cache(self):
+        """ Every write refreshes the cached shopcart """
+        shopcart = Shopcart(user_id=1, product_id=1, quantity=1, price=12.00)
+        shopcart.save()
+        self.assertEqual(Shopcart.find_in_cart(1, 1)['quantity'], 1)
+        shopcart.quantity = 2
+        shopcart.save()
+        self.assertEqual(Shopcart.find_in_cart(1, 1)['quantity'], 2)
+        Shopcart.add(user_id=1, product_id=1, quantity=3, price=12.00)
+        self.assertEqual(Shopcart.find_in_cart(1, 1)['quantity'], 5)
+        Shopcart.upsert_many([{'user_id': 1, 'product_id': 2, 'quantity': 1, 'price': 1.00}])
+        self.assertEqual(len(Shopcart.find_cart(1)), 2)
+        Shopcart.find(1, 2).delete()
+        self.assertEqual(len(Shopcart.find_cart(1)), 1)
+        Shopcart.remove_by_user(1)
+        self.assertEqual(Shopcart.find_cart(1), [])
+        Shopcart.add(user_id=1, product_id=1, quantity=3, price=12.00)
+        self.assertEqual(len(Shopcart.find_cart(1)), 1)
+        Shopcart.remove_all()
+        self.assertEqual(Shopcart.find_cart(1), [])
+
     def test_delete_user_product(self):
         """ Delete User Products """
         shopcart = Shopcart(user_id=1, product_id=1, quantity=1, price=12.00)
@@ -208,6 +503,33 @@ class TestShopcarts(unittest.TestCase):
         shopcarts = Shopcart.all()
         self.assertEqual(len(shopcarts), 0)
 
+    def test_remove_all_is_one_transaction(self):
+        """ Keep the entries with their totals when clearing the totals fails """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=12.00).save()
+        with patch.object(Shopcart, '_clear_totals', side_effect=IOError('database went away')):
+            self.assertRaises(IOError, Shopcart.remove_all)
+        self.assertEqual(len(Shopcart.all()), 1)
+        self.assertEqual(Shopcart.find_total(1).total_price, 24.00)
+        self.assertEqual(Shopcart.find_users_by_shopcart_amount(24), [1])
+
+    def test_remove_all_in_chunks(self):
+        """ Remove all the shopcart data a chunk at a time """
+        for user_id in range(1, 8):
+            Shopcart(user_id=user_id, product_id=1, quantity=1, price=12.00).save()
+            Shopcart(user_id=user_id, product_id=2, quantity=1, price=12.00).save()
+        Shopcart.remove_all(chunk_size=3)
+        self.assertEqual(len(Shopcart.all()), 0)
+
+    def test_remove_by_user(self):
+        """ Remove all the entries in the shopcart of a user """
+        Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
+        Shopcart(user_id=1, product_id=2, quantity=1, price=12.00).save()
+        Shopcart(user_id=2, product_id=1, quantity=1, price=12.00).save()
+        self.assertEqual(Shopcart.remove_by_user(1), 2)
+        self.assertEqual(Shopcart.findByUserId(1).count(), 0)
+        self.assertEqual(Shopcart.findByUserId(2).count(), 1)
+        self.assertEqual(Shopcart.remove_by_user(1), 0)
+
 
 
 ######################################################################
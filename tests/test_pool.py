@@ -0,0 +1,78 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Connection Pool
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from mock import patch
+from sqlalchemy import create_engine, exc
+from app.pool import TimedQueuePool, pool_stats, pool_status
+from app.vcap_services import get_pool_options
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestConnectionPool(unittest.TestCase):
+
+    """ Test Cases for the Connection Pool """
+
+    def setUp(self):
+        pool_stats.reset()
+        self.engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                                    pool_size=1, max_overflow=0, pool_timeout=0.01)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_pool_options(self):
+        """ Read the pool settings from the environment """
+        options = get_pool_options()
+        self.assertEqual(options['pool_size'], 5)
+        self.assertTrue(options['pool_pre_ping'])
+        env = {'DB_POOL_SIZE': '20', 'DB_MAX_OVERFLOW': '0', 'DB_POOL_TIMEOUT': '2.5',
+               'DB_POOL_RECYCLE': '600', 'DB_POOL_PRE_PING': 'false'}
+        with patch.dict('os.environ', env):
+            options = get_pool_options()
+        self.assertEqual(options, {'pool_size': 20, 'max_overflow': 0, 'pool_timeout': 2.5,
+                                   'pool_recycle': 600, 'pool_pre_ping': False})
+
+    def test_checkouts_are_counted(self):
+        """ Count the checkouts and report the in use and idle connections """
+        connection = self.engine.connect()
+        status = pool_status(self.engine.pool)
+        self.assertEqual(status['pool'], 'TimedQueuePool')
+        self.assertEqual(status['in_use'], 1)
+        self.assertEqual(status['idle'], 0)
+        self.assertEqual(status['checkouts'], 1)
+        connection.close()
+        status = pool_status(self.engine.pool)
+        self.assertEqual(status['in_use'], 0)
+        self.assertEqual(status['idle'], 1)
+        self.assertGreaterEqual(status['wait_ms_max'], 0.0)
+
+    def test_checkout_timeout(self):
+        """ Count the checkouts that ran out of time waiting for a connection """
+        connection = self.engine.connect()
+        self.assertRaises(exc.TimeoutError, self.engine.connect)
+        connection.close()
+        status = pool_status(self.engine.pool)
+        self.assertEqual(status['checkouts'], 1)
+        self.assertEqual(status['timeouts'], 1)
+        self.assertGreaterEqual(status['wait_ms_max'], 10.0)
@@ -0,0 +1,79 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the JSON Serializers
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import json
+import unittest
+from collections import OrderedDict
+from flask_restplus import fields, marshal
+from app.serializers import ModelEncoder, select_json_backend
+from app.service import shopcart_model, shopcart_total_fields
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestSerializers(unittest.TestCase):
+
+    """ Test Cases for the JSON Serializers """
+
+    def test_same_as_marshal(self):
+        """ Encode a row as marshal() and json.dumps() would """
+        row = {'user_id': 1, 'product_id': 2, 'quantity': 3, 'price': 12.5, 'version': 4}
+        text = ModelEncoder(shopcart_model).encode(row)
+        self.assertEqual(text, json.dumps(marshal(row, shopcart_model)))
+
+    def test_missing_fields_are_null(self):
+        """ Write the fields missing from a row as null """
+        text = ModelEncoder(shopcart_model).encode({'user_id': 1})
+        self.assertEqual(json.loads(text), {'user_id': 1, 'product_id': None, 'quantity': None, 'price': None})
+
+    def test_encode_list(self):
+        """ Encode a list of rows """
+        encoder = ModelEncoder(shopcart_model)
+        self.assertEqual(encoder.encode_list([]), '[]')
+        rows = [{'user_id': 1, 'product_id': 1, 'quantity': 1, 'price': 0.1},
+                {'user_id': 1, 'product_id': 2, 'quantity': 2, 'price': 1.0 / 3}]
+        self.assertEqual(json.loads(encoder.encode_list(rows)), rows)
+
+    def test_nested_fields(self):
+        """ Encode lists of nested models """
+        row = {'products': [{'user_id': 1, 'product_id': 1, 'quantity': 1, 'price': 2.0}],
+               'total_price': 2.0}
+        text = ModelEncoder(shopcart_total_fields).encode(row)
+        self.assertEqual(text, json.dumps(marshal(row, shopcart_total_fields)))
+        self.assertEqual(json.loads(ModelEncoder(shopcart_total_fields).encode({})),
+                         {'products': None, 'total_price': None})
+
+    def test_raw_fields(self):
+        """ Encode the fields without a converter with the JSON backend """
+        model = OrderedDict([('name', fields.String), ('active', fields.Boolean), ('tags', fields.Raw)])
+        text = ModelEncoder(model).encode({'name': 'cart "%s"', 'active': True, 'tags': ['a']})
+        self.assertEqual(json.loads(text), {'name': 'cart "%s"', 'active': True, 'tags': ['a']})
+
+    def test_json_backend(self):
+        """ Fall back to the json module when the backend is not installed """
+        self.assertIs(select_json_backend('json'), json.dumps)
+        try:
+            import ujson
+        except ImportError:
+            self.assertIs(select_json_backend('ujson'), json.dumps)
+        else:
+            self.assertIs(select_json_backend('ujson'), ujson.dumps)
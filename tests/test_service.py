@@ -22,15 +22,19 @@ Test cases can be run with the following:
 """
 import unittest
 import os
+import re
 import json
 import logging
+from contextlib import contextmanager
+from sqlalchemy import event
 from flask_api import status    # HTTP Status Codes
 from mock import MagicMock, patch
 from werkzeug.exceptions import NotFound,BadRequest
-from app.model import Shopcart, DataValidationError, db
+from app.model import Shopcart, ShopcartTotal, DataValidationError, PartialWriteError, db
 import app.vcap_services as vcap
 import app.service as service
 from app.service import app
+from app.replica import replica_binds
 
 # Status Codes
 HTTP_200_OK = 200
@@ -68,6 +72,7 @@ class TestShopcartServer(unittest.TestCase):
         service.init_db()
         db.drop_all()    # clean up the last tests
         db.create_all()  # create new tables
+        Shopcart.cache.clear()
         Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
         Shopcart(user_id=1, product_id=2, quantity=1, price=15.00).save()
         self.app = service.app.test_client()
@@ -148,6 +153,30 @@ class TestShopcartServer(unittest.TestCase):
         self.assertIn(new_json, data)
         self.assertEqual(len(data), product_count + 1)
 
+    def test_create_shopcart_entry_existing_product(self):
+        """ Create a Shopcart entry for a product that is already in the shopcart """
+        new_product = dict(user_id=1, product_id=2, quantity=3, price=15.00)
+        with self.count_queries() as statements:
+            resp = self.app.post('/shopcarts',
+                                 data=json.dumps(new_product),
+                                 content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        new_json = json.loads(resp.data)
+        self.assertEqual(new_json['quantity'], 4)
+        self.assertEqual(Shopcart.find(1, 2).quantity, 4)
+        # the upsert, reading back the entry, the change log and the shopcart
+        # totals reach the entries, and a larger shopcart takes no more of them
+        self.fill_shopcart(7, 20)
+        new_product['user_id'] = 7
+        with self.count_queries() as larger:
+            resp = self.app.post('/shopcarts',
+                                 data=json.dumps(new_product),
+                                 content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertLessEqual(len(self.cart_statements(statements)), 5)
+        self.assertEqual(len(self.cart_statements(larger)), len(self.cart_statements(statements)))
+        self.assertEqual(len(larger), len(statements))
+
     def test_list_shop_cart_entry_by_user_id(self):
         """ Query shopcart by user_id """
         shopcart = Shopcart.findByUserId(1)
@@ -172,6 +201,98 @@ class TestShopcartServer(unittest.TestCase):
 
 
          
+    def test_list_shop_cart_entry_query_count(self):
+        """ Query shopcart by user_id with a single statement """
+        Shopcart.cache.clear()
+        with self.count_queries() as statements:
+            resp = self.app.get('/shopcarts/1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('count(', statements[0].lower())
+
+        # served from the cart cache the second time, once its version is checked
+        with self.count_queries() as statements:
+            resp = self.app.get('/shopcarts/1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('FROM shopcart ', statements[0])
+
+        with self.count_queries() as statements:
+            resp = self.app.get('/shopcarts/999')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(statements), 1)
+
+        with self.count_queries() as statements:
+            resp = self.app.get('/shopcarts/1?limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('count(', statements[0].lower())
+
+    def test_conditional_get_shopcart(self):
+        """ Answer a conditional GET of a shopcart from its version """
+        resp = self.app.get('/shopcarts/1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers['ETag']
+
+        with self.count_queries() as statements:
+            resp = self.app.get('/shopcarts/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(resp.data, '')
+        # only the version is looked up
+        self.assertEqual(len(statements), 1)
+        self.assertIn('shopcart_total', statements[0])
+        self.assertNotIn('FROM shopcart ', statements[0])
+
+        Shopcart(user_id=1, product_id=3, quantity=1, price=1.00).save()
+        resp = self.app.get('/shopcarts/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(resp.data)), 3)
+
+    def test_get_shopcart_written_by_another_worker(self):
+        """ Reload a cached shopcart once another worker changed it """
+        resp = self.app.get('/shopcarts/1')
+        etag = resp.headers['ETag']
+        # The write of another worker leaves the cache of this one alone
+        with patch.object(Shopcart.cache, 'invalidate'):
+            Shopcart.add(user_id=1, product_id=9, quantity=1, price=1.00)
+        resp = self.app.get('/shopcarts/1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 3)
+        self.assertEqual(resp.headers['ETag'], service.make_etag(Shopcart.find_version(1)))
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        resp = self.app.get('/shopcarts/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 3)
+
+    def test_conditional_get_shopcart_total(self):
+        """ Answer a conditional GET of a shopcart total from its version """
+        for url in ['/shopcarts/1/total', '/shopcarts/1/total?summary_only=true']:
+            resp = self.app.get(url)
+            etag = resp.headers['ETag']
+            resp = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            Shopcart.add(user_id=1, product_id=1, quantity=1, price=12.00)
+            resp = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/shopcarts/1/total')
+        self.assertNotEqual(resp.headers['ETag'], self.app.get('/shopcarts/1').headers['ETag'])
+
+    def test_get_shopcart_without_totals(self):
+        """ Read the entries of a shopcart whose totals were not built yet """
+        ShopcartTotal.query.delete()
+        db.session.commit()
+        resp = self.app.get('/shopcarts/1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+        resp = self.app.get('/shopcarts/1/total')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['products']), 2)
+        self.assertEqual(data['total_price'], 27.00)
+
     def test_list_all_shopcarts(self):
         """ Query all the shopcart in the system """
         shopcart = Shopcart.list_users()
@@ -195,8 +316,89 @@ class TestShopcartServer(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(cnt, len(data))
 
+    def test_list_all_shopcarts_query_count(self):
+        """ Listing all shopcarts uses the same number of queries for any number of users """
+        with self.count_queries() as few_users:
+            resp = self.app.get('/shopcarts')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        for user_id in range(100, 120):
+            Shopcart(user_id=user_id, product_id=1, quantity=1, price=1.00).save()
+            Shopcart(user_id=user_id, product_id=2, quantity=2, price=2.00).save()
+        with self.count_queries() as many_users:
+            resp = self.app.get('/shopcarts')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(few_users), len(many_users))
+
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 21)
+        self.assertEqual(data[0]['user_id'], 1)
+        self.assertEqual([p['product_id'] for p in data[0]['products']], [1, 2])
+        self.assertEqual(data[-1]['user_id'], 119)
+        self.assertEqual(data[-1]['products'][1]['quantity'], 2)
+
 
 
+    def test_stream_all_shopcarts(self):
+        """ Stream all the shopcarts in the system """
+        Shopcart(user_id=30, product_id=1, quantity=5, price=12.00).save()
+        resp = self.app.get('/shopcarts')
+        expected = json.loads(resp.data)
+
+        resp = self.app.get('/shopcarts?stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(json.loads(resp.data), expected)
+
+        Shopcart.remove_all()
+        resp = self.app.get('/shopcarts?stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_page_all_shopcarts(self):
+        """ Page through all the shopcarts with a cursor """
+        Shopcart(user_id=2, product_id=1, quantity=1, price=10.00).save()
+        Shopcart(user_id=3, product_id=5, quantity=1, price=10.00).save()
+        keys = []
+        resp = self.app.get('/shopcarts?limit=2')
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            for shopcart in json.loads(resp.data):
+                keys.extend((shopcart['user_id'], p['product_id']) for p in shopcart['products'])
+            if 'Link' not in resp.headers:
+                break
+            self.assertIn('rel="next"', resp.headers['Link'])
+            next_url = resp.headers['Link'].split('>')[0].lstrip('<')
+            resp = self.app.get(next_url)
+        self.assertEqual(keys, [(1, 1), (1, 2), (2, 1), (3, 5)])
+
+    def test_page_shopcart_of_user(self):
+        """ Page through the products in the shopcart of a user """
+        Shopcart(user_id=1, product_id=3, quantity=1, price=10.00).save()
+        resp = self.app.get('/shopcarts/1?limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['product_id'] for p in data], [1, 2])
+        next_url = resp.headers['Link'].split('>')[0].lstrip('<')
+        self.assertIn('/shopcarts/1?', next_url)
+
+        resp = self.app.get(next_url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['product_id'] for p in data], [3])
+        self.assertNotIn('Link', resp.headers)
+
+        resp = self.app.get('/shopcarts/999?limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_page_bad_parameters(self):
+        """ Reject invalid paging parameters """
+        for query in ['limit=0', 'limit=abc', 'limit=1000000', 'cursor=MTox', 'limit=1&cursor=bad']:
+            resp = self.app.get('/shopcarts?' + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.get('/shopcarts/1?' + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_shop_cart_amount_by_user_id(self):
         """ Query the total amount of products in shopcart by user_id"""
         shopcarts = Shopcart.findByUserId(1)
@@ -212,6 +414,37 @@ class TestShopcartServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual(total, new_json['total_price'])
 
+    def test_shop_cart_amount_uses_totals(self):
+        """ Query the total amount with a lookup of the maintained totals """
+        with self.count_queries() as statements:
+            resp = self.app.get('/shopcarts/1/total')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['total_price'], 27.00)
+        self.assertEqual([p['product_id'] for p in data['products']], [1, 2])
+        # the entries and the total are read by one query
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('GROUP BY', statements[0])
+
+        resp = self.app.get('/shopcarts/999/total')
+        self.assertEqual(json.loads(resp.data), {'products': [], 'total_price': 0.0})
+
+    def test_shop_cart_amount_summary_only(self):
+        """ Query the total amount without the products """
+        with self.count_queries() as statements:
+            resp = self.app.get('/shopcarts/1/total?summary_only=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['total_price'], 27.00)
+        self.assertEqual(data['item_count'], 2)
+        self.assertNotIn('products', data)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('FROM shopcart ', statements[0])
+
+        resp = self.app.get('/shopcarts/999/total?summary_only=true')
+        data = json.loads(resp.data)
+        self.assertEqual((data['item_count'], data['total_price']), (0, 0.0))
+
     def test_update_shopcart_quantity(self):
 
         """ Update a Shopcart quantity """
@@ -263,6 +496,48 @@ class TestShopcartServer(unittest.TestCase):
                             content_type='application/json')
         self.assertRaises(NotFound)
 
+    def test_update_shopcart_quantity_if_match(self):
+        """ Update a Shopcart quantity only if it wasn't changed since it was read """
+        resp = self.app.get('/shopcarts/1/product/1')
+        etag = resp.headers['ETag']
+        data = json.dumps(dict(user_id=1, product_id=1, quantity=7, price=12.00))
+        resp = self.app.put('/shopcarts/1/product/1', data=data,
+                            content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['quantity'], 7)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        # the entry has changed since etag was read
+        resp = self.app.put('/shopcarts/1/product/1', data=data,
+                            content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete('/shopcarts/1/product/1', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertIsNotNone(Shopcart.find(1, 1))
+
+        etag = self.app.get('/shopcarts/1/product/1').headers['ETag']
+        resp = self.app.delete('/shopcarts/1/product/1', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertIsNone(Shopcart.find(1, 1))
+        resp = self.app.delete('/shopcarts/1/product/1', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_product_etag_after_write_of_another_worker(self):
+        """ Give the version of the entry as it is in the database as the ETag of a product """
+        self.app.get('/shopcarts/1/product/1')
+        # The write of another worker leaves the cache of this one alone
+        with patch.object(Shopcart.cache, 'invalidate'):
+            Shopcart.add(user_id=1, product_id=1, quantity=1, price=12.00)
+        resp = self.app.get('/shopcarts/1/product/1')
+        self.assertEqual(resp.headers['ETag'], service.make_etag(Shopcart.find(1, 1).version))
+        data = json.dumps(dict(user_id=1, product_id=1, quantity=7, price=12.00))
+        resp = self.app.put('/shopcarts/1/product/1', data=data,
+                            content_type='application/json',
+                            headers={'If-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
     def test_get_shopcart_product_info(self):
         """ Query quantity and price of a product shopcart by user_id and product_id """
         # Add test product in database
@@ -302,6 +577,108 @@ class TestShopcartServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
 
 
+    def test_add_batch_of_products(self):
+        """ Add a JSON batch of products to many shopcarts """
+        batch = [dict(user_id=1, product_id=1, quantity=2, price=12.00),
+                 dict(user_id=5, product_id=1, quantity=1, price=3.00),
+                 dict(user_id=5, product_id=1, quantity=4, price=3.00),
+                 dict(user_id=5, product_id=2, quantity=0, price=3.00),
+                 dict(user_id=6, product_id=2, price=3.00)]
+        resp = self.app.post('/shopcarts/batch',
+                             data=json.dumps(batch),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        report = json.loads(resp.data)
+        self.assertEqual(report['accepted'], 3)
+        self.assertEqual(report['rejected'], 2)
+        self.assertEqual([r['status'] for r in report['results']],
+                         ['accepted', 'accepted', 'accepted', 'rejected', 'rejected'])
+        self.assertIn('missing quantity', report['results'][4]['message'])
+        self.assertEqual(Shopcart.find(1, 1).quantity, 3)
+        self.assertEqual(Shopcart.find(5, 1).quantity, 5)
+        self.assertIsNone(Shopcart.find(5, 2))
+
+    def test_add_ndjson_batch_of_products(self):
+        """ Add an NDJSON stream of products to many shopcarts """
+        lines = [json.dumps(dict(user_id=7, product_id=1, quantity=1, price=1.50)),
+                 '',
+                 'not json',
+                 json.dumps(dict(user_id=8, product_id=1, quantity=2, price=2.50))]
+        resp = self.app.post('/shopcarts/batch',
+                             data='\n'.join(lines),
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        report = json.loads(resp.data)
+        self.assertEqual(report['accepted'], 2)
+        self.assertEqual(report['rejected'], 1)
+        self.assertEqual(report['results'][1]['line'], 2)
+        self.assertEqual(Shopcart.find(8, 1).quantity, 2)
+
+    def test_add_batch_bad_request(self):
+        """ Reject a batch that isn't a list of products """
+        resp = self.app.post('/shopcarts/batch',
+                             data=json.dumps(dict(user_id=1)),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/shopcarts/batch',
+                             data='user_id=1',
+                             content_type='text/plain')
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_add_product_with_bad_numbers(self):
+        """ Reject a fractional quantity and a price that isn't a finite number """
+        for data in ['{"user_id": 1, "product_id": 1, "quantity": 3.7, "price": 12.0}',
+                     '{"user_id": 1.5, "product_id": 1, "quantity": 3, "price": 12.0}',
+                     '{"user_id": 1, "product_id": 1, "quantity": Infinity, "price": 12.0}',
+                     '{"user_id": 1, "product_id": 1, "quantity": 3, "price": "nan"}',
+                     '{"user_id": 1, "product_id": 1, "quantity": 3, "price": NaN}',
+                     '{"user_id": 1, "product_id": 1, "quantity": 3, "price": "-inf"}']:
+            resp = self.app.post('/shopcarts', data=data, content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, data)
+        self.assertEqual(Shopcart.find(1, 1).quantity, 1)
+        self.assertEqual(Shopcart.find_total(1).total_price, 27.00)
+        # A whole number is still taken as a float
+        resp = self.app.post('/shopcarts', data='{"user_id": 1, "product_id": 1, "quantity": 2.0, "price": 12.0}',
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Shopcart.find(1, 1).quantity, 3)
+
+    def test_update_product_with_bad_numbers(self):
+        """ Reject an update with a fractional quantity or a price that isn't a finite number """
+        for data in ['{"user_id": 1, "product_id": 1, "quantity": 3.7, "price": 12.0}',
+                     '{"user_id": 1, "product_id": 1, "quantity": 3, "price": NaN}',
+                     '{"user_id": 1, "product_id": 1, "quantity": 3, "price": "inf"}',
+                     '{"user_id": 1, "product_id": 1, "price": 12.0}']:
+            resp = self.app.put('/shopcarts/1/product/1', data=data, content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, data)
+        shopcart = Shopcart.find(1, 1)
+        self.assertEqual((shopcart.quantity, shopcart.price), (1, 12.00))
+        resp = self.app.put('/shopcarts/1/product/1', data='{"user_id": 1, "product_id": 1, "quantity": 3.0, "price": 12}',
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['quantity'], 3)
+
+    def test_add_batch_partly_written(self):
+        """ Report the lines of a batch that failed after other chunks were committed """
+        batch = [dict(user_id=1, product_id=1, quantity=2, price=12.00),
+                 dict(user_id=5, product_id=1, quantity=1, price=3.00),
+                 dict(user_id=5, product_id=1, quantity=4, price=3.00),
+                 dict(user_id=6, product_id=2, quantity=1, price=float('inf'))]
+        error = PartialWriteError('Upsert failed after 1 Shopcart entries were written', 1,
+                                  [dict(user_id=5, product_id=1, quantity=5, price=3.00)])
+        with patch.object(Shopcart, 'upsert_many', side_effect=error):
+            resp = self.app.post('/shopcarts/batch',
+                                 data=json.dumps(batch),
+                                 content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        report = json.loads(resp.data)
+        self.assertEqual(report['accepted'], 1)
+        self.assertEqual(report['rejected'], 1)
+        self.assertEqual(report['failed'], 2)
+        self.assertEqual([r['status'] for r in report['results']],
+                         ['accepted', 'failed', 'failed', 'rejected'])
+        self.assertIn('Upsert failed', report['results'][1]['message'])
+
     def test_get_users_by_total_cost_of_shopcart(self):
         Shopcart(user_id=3, product_id=1, quantity=5, price=12.00).save()
         resp = self.app.get('/shopcarts/users?amount=60',
@@ -309,6 +686,31 @@ class TestShopcartServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEqual(len(json.loads(resp.data)), 1)
 
+    def test_get_top_users_by_total_cost_of_shopcart(self):
+        """ Page through the most valuable shopcarts first """
+        Shopcart(user_id=2, product_id=1, quantity=1, price=50.00).save()
+        Shopcart(user_id=3, product_id=1, quantity=1, price=27.00).save()
+        Shopcart(user_id=4, product_id=1, quantity=1, price=5.00).save()
+        resp = self.app.get('/shopcarts/users?amount=10&sort=total_desc')
+        self.assertEqual(json.loads(resp.data), [2, 1, 3])
+
+        resp = self.app.get('/shopcarts/users?amount=10&sort=total_desc&limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), [2, 1])
+        next_url = resp.headers['Link'].split('>')[0].lstrip('<')
+        resp = self.app.get(next_url)
+        self.assertEqual(json.loads(resp.data), [3])
+        self.assertNotIn('Link', resp.headers)
+
+        resp = self.app.get('/shopcarts/users?amount=10&limit=1')
+        self.assertEqual(json.loads(resp.data), [1])
+        next_url = resp.headers['Link'].split('>')[0].lstrip('<')
+        resp = self.app.get(next_url)
+        self.assertEqual(json.loads(resp.data), [2])
+
+        resp = self.app.get('/shopcarts/users?amount=10&sort=price')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_users_by_total_cost_of_shopcart_bad_request(self):
         resp = self.app.get('/shopcarts/users?amount="hello"',
                             content_type='application/json')
@@ -332,8 +734,21 @@ class TestShopcartServer(unittest.TestCase):
                              content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
         # Delet the test products of same user
-        resp = self.app.delete('/shopcarts/{uid}'.format(uid = 1))
+        with self.count_queries() as statements:
+            resp = self.app.delete('/shopcarts/{uid}'.format(uid = 1))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Shopcart.findByUserId(1).count(), 0)
+        # the entries go in a single delete, however many there are, next to
+        # the change log and the shopcart totals
+        self.fill_shopcart(7, 20)
+        with self.count_queries() as larger:
+            resp = self.app.delete('/shopcarts/7')
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Shopcart.findByUserId(7).count(), 0)
+        self.assertEqual(len([s for s in statements if s.startswith('DELETE FROM shopcart ')]), 1)
+        self.assertLessEqual(len(self.cart_statements(statements)), 4)
+        self.assertEqual(len(self.cart_statements(larger)), len(self.cart_statements(statements)))
+        self.assertEqual(len(larger), len(statements))
 
     def test_reset(self):
         # Add test products in database
@@ -352,10 +767,156 @@ class TestShopcartServer(unittest.TestCase):
         resp = self.app.delete('/shopcarts/reset')
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
 
+    def test_cache_stats(self):
+        """ Report the cart cache counters """
+        before = json.loads(self.app.get('/healthcheck/cache').data)
+        self.app.get('/shopcarts/1')
+        self.app.get('/shopcarts/1')
+        resp = self.app.get('/healthcheck/cache')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['misses'], before['misses'] + 1)
+        self.assertEqual(data['hits'], before['hits'] + 1)
+        self.assertIn('evictions', data)
+
+    def test_pool_stats(self):
+        """ Report the connection pool counters """
+        resp = self.app.get('/healthcheck/pool')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertIn('pool', data)
+        self.assertIn('checkouts', data)
+        self.assertIn('wait_ms_max', data)
+
+    def test_request_metrics(self):
+        """ Report the requests by resource and method """
+        service.metrics.reset()
+        self.app.get('/shopcarts/1')
+        self.app.get('/shopcarts/99')
+        self.app.get('/shopcarts/1/total')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('text/plain', resp.headers['Content-Type'])
+        self.assertIn('shopcart_http_requests_total{resource="ShopcartResource",method="GET",status="200"} 1', resp.data)
+        self.assertIn('shopcart_http_requests_total{resource="ShopcartResource",method="GET",status="404"} 1', resp.data)
+        self.assertIn('shopcart_http_request_duration_seconds_count{resource="ShopcartAction",method="GET"} 1', resp.data)
+
+    def test_sql_profile_headers(self):
+        """ Send back the statement count and time of a request when profiling is on """
+        resp = self.app.get('/shopcarts/1')
+        self.assertNotIn('X-DB-Queries', resp.headers)
+        with patch.dict(service.app.config, {'SQL_PROFILING': True}):
+            resp = self.app.get('/shopcarts/1/total')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['X-DB-Queries'], '1')
+        self.assertGreaterEqual(float(resp.headers['X-DB-Time-ms']), 0.0)
+
+    def test_slow_query_log(self):
+        """ Log the slow statements with the finder that ran them """
+        with patch.object(service.profiler, 'slow_query_ms', 0), \
+             patch.object(service.profiler, 'logger') as logger:
+            self.app.get('/shopcarts/1/total')
+        self.assertTrue(logger.warning.called)
+        args = logger.warning.call_args[0]
+        self.assertEqual(args[2], 'Shopcart.find_cart_with_total')
+        self.assertIn('shopcart_total', args[3])
+
+    def test_field_mask(self):
+        """ Return only the fields asked for in the X-Fields header """
+        resp = self.app.get('/shopcarts/1/product/1', headers={'X-Fields': 'product_id,quantity'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {'product_id': 1, 'quantity': 1})
+        self.assertIn('ETag', resp.headers)
+
+    def test_read_replica(self):
+        """ Read from one of the replicas unless the shopcart was just written """
+        uris = ['sqlite:///../db/test_replica0.db', 'sqlite:///../db/test_replica1.db']
+        config = {'SQLALCHEMY_BINDS': dict(zip(replica_binds(2), uris)), 'REPLICA_BINDS': replica_binds(2)}
+        with patch.dict(service.app.config, config):
+            replicas = [db.get_engine(service.app, bind) for bind in replica_binds(2)]
+            try:
+                # The replicas lag behind with shopcarts the primary never had
+                for product_id, replica in zip([8, 9], replicas):
+                    db.Model.metadata.create_all(replica)
+                    replica.execute(Shopcart.__table__.insert(),
+                                    user_id=5, product_id=product_id, quantity=1, price=1.0, version=1)
+                    replica.execute(ShopcartTotal.__table__.insert(),
+                                    user_id=5, item_count=1, total_price=1.0, version=1)
+                Shopcart.recent_writes.clear()
+                read = set()
+                for bind in replica_binds(2):
+                    Shopcart.cache.clear()
+                    with patch('app.replica.random.choice', return_value=bind):
+                        resp = self.app.get('/shopcarts/5')
+                    read.update(p['product_id'] for p in json.loads(resp.data))
+                self.assertEqual(read, set([8, 9]))
+
+                resp = self.app.post('/shopcarts', data=json.dumps(dict(user_id=5, product_id=10, quantity=1, price=2.0)),
+                                     content_type='application/json')
+                self.assertIn('shopcart_last_write=', resp.headers['Set-Cookie'])
+                # Read back from the primary by the client that wrote...
+                resp = self.app.get('/shopcarts/5')
+                self.assertEqual([p['product_id'] for p in json.loads(resp.data)], [10])
+                # ...and by any client of this worker
+                Shopcart.cache.clear()
+                resp = service.app.test_client().get('/shopcarts/5')
+                self.assertEqual([p['product_id'] for p in json.loads(resp.data)], [10])
+                # Writes are never sent to the replicas
+                self.assertEqual(self.app.delete('/shopcarts/5/product/10').status_code, HTTP_204_NO_CONTENT)
+                for replica in replicas:
+                    self.assertEqual(replica.execute('SELECT count(*) FROM shopcart').scalar(), 1)
+            finally:
+                connectors = db.get_app().extensions['sqlalchemy'].connectors
+                for bind, replica in zip(replica_binds(2), replicas):
+                    db.Model.metadata.drop_all(replica)
+                    replica.dispose()
+                    connectors.pop(bind, None)
+                    os.remove(replica.url.database)
+
+    def test_change_feed(self):
+        """ Follow the adds, updates and deletes of the shopcarts since a cursor """
+        resp = self.app.get('/shopcarts/changes?limit=1')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([(c['operation'], c['product_id']) for c in data['changes']], [('add', 1)])
+        resp = self.app.get('/shopcarts/changes', query_string={'since': data['cursor']})
+        data = json.loads(resp.data)
+        self.assertEqual([(c['operation'], c['product_id']) for c in data['changes']], [('add', 2)])
+
+        self.app.post('/shopcarts', data=json.dumps(dict(user_id=1, product_id=2, quantity=1, price=15.0)),
+                      content_type='application/json')
+        self.app.put('/shopcarts/1/product/1', data=json.dumps(dict(user_id=1, product_id=1, quantity=5, price=12.0)),
+                     content_type='application/json')
+        self.app.delete('/shopcarts/1/product/2')
+        self.app.post('/shopcarts', data=json.dumps(dict(user_id=2, product_id=3, quantity=1, price=4.0)),
+                      content_type='application/json')
+        self.app.delete('/shopcarts/2')
+        resp = self.app.get('/shopcarts/changes', query_string={'since': data['cursor']})
+        data = json.loads(resp.data)
+        self.assertEqual([(c['operation'], c['user_id'], c['product_id'], c['quantity'], c['version'])
+                          for c in data['changes']],
+                         [('update', 1, 2, 2, 2), ('update', 1, 1, 5, 2), ('delete', 1, 2, 2, 2),
+                          ('add', 2, 3, 1, 1), ('delete', 2, 3, 1, 1)])
+        # Nothing changed since the last cursor
+        resp = self.app.get('/shopcarts/changes', query_string={'since': data['cursor']})
+        self.assertEqual(json.loads(resp.data), {'changes': [], 'cursor': data['cursor']})
+        resp = self.app.get('/shopcarts/changes?since=bad')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/shopcarts/changes?limit=0')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
     def test_vcap_services(self):
         db_url = vcap.get_database_uri()
         self.assertNotEqual(db_url, "")
 
+    def test_replica_database_uris(self):
+        """ Read the URIs of the replicas from the environment """
+        self.assertEqual(vcap.get_replica_database_uris(), [])
+        with patch.dict('os.environ', {'REPLICA_DATABASE_URI': 'sqlite:///a.db'}):
+            self.assertEqual(vcap.get_replica_database_uris(), ['sqlite:///a.db'])
+        with patch.dict('os.environ', {'REPLICA_DATABASE_URIS': 'sqlite:///a.db, sqlite:///b.db'}):
+            self.assertEqual(vcap.get_replica_database_uris(), ['sqlite:///a.db', 'sqlite:///b.db'])
+
     def test_invalid_content_type(self):       
         data = dict(user_id=10, product_id=10, quantity=5, price=12.00)
         resp = self.app.post('/shopcarts',
@@ -368,6 +929,31 @@ class TestShopcartServer(unittest.TestCase):
 # Utility functions
 ######################################################################
 
+    @contextmanager
+    def count_queries(self):
+        """ collects the SQL statements executed inside the block """
+        statements = []
+        self.app.get('/healthcheck')    # let the before_first_request hooks run
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = db.get_engine(service.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    @staticmethod
+    def cart_statements(statements):
+        """ the statements that reach the shopcart entries themselves """
+        return [s for s in statements if re.search(r'\bshopcart\b(?!_)', s)]
+
+    @staticmethod
+    def fill_shopcart(user_id, count):
+        """ put count products in user's shopcart """
+        for product_id in range(1, count + 1):
+            Shopcart(user_id=user_id, product_id=product_id, quantity=1, price=1.00).save()
+
     def get_product_count(self, user_id):
         """ save the current number of products in user's shopcart """
         resp = self.app.get('/shopcarts/'+str(user_id))
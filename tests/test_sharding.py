@@ -0,0 +1,229 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for Sharding
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+from mock import patch
+from app.model import Shopcart, PartialWriteError, db
+from app.service import app
+from app.writebehind import WriteBehindBuffer
+from app.sharding import HashRing, Shards, shard_binds
+from app.vcap_services import get_shard_database_uris
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+SHARD_URIS = ['sqlite:///../db/test_shard0.db', 'sqlite:///../db/test_shard1.db']
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestHashRing(unittest.TestCase):
+
+    """ Test Cases for the Consistent Hashing of users """
+
+    def test_shard_binds(self):
+        """ Name a bind for each shard URI """
+        self.assertEqual(get_shard_database_uris(), [])
+        with patch.dict('os.environ', {'SHARD_DATABASE_URIS': 'sqlite:///a.db, sqlite:///b.db'}):
+            uris = get_shard_database_uris()
+        self.assertEqual(uris, ['sqlite:///a.db', 'sqlite:///b.db'])
+        self.assertEqual(shard_binds(len(uris)), ['shard0', 'shard1'])
+
+    def test_users_are_spread_over_the_shards(self):
+        """ Place about the same number of users on each shard """
+        ring = HashRing(shard_binds(4))
+        counts = {}
+        for user_id in range(10000):
+            shard = ring.node_for(user_id)
+            counts[shard] = counts.get(shard, 0) + 1
+        self.assertEqual(sorted(counts), shard_binds(4))
+        for count in counts.values():
+            self.assertTrue(1500 < count < 3500, counts)
+
+    def test_adding_a_shard_moves_few_users(self):
+        """ Only move users to the new shard when one is added """
+        before = HashRing(shard_binds(4))
+        after = HashRing(shard_binds(5))
+        moved = [user_id for user_id in range(10000)
+                 if before.node_for(user_id) != after.node_for(user_id)]
+        self.assertLess(len(moved), 3500)
+        self.assertEqual(set(after.node_for(user_id) for user_id in moved), set(['shard4']))
+
+    def test_unsharded(self):
+        """ Keep every user on the default bind without shards """
+        shards = Shards()
+        self.assertIsNone(shards.for_user(1))
+        self.assertEqual(shards.all(), [None])
+        self.assertEqual(shards.split([3, 1, 2]), {None: [3, 1, 2]})
+        self.assertEqual(shards.map(lambda shard: shard), [None])
+
+
+class TestShardedShopcarts(unittest.TestCase):
+
+    """ Test Cases for Shopcarts split over two shards """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        self.binds = patch.dict(app.config, {'SQLALCHEMY_BINDS': dict(zip(shard_binds(2), SHARD_URIS))})
+        self.binds.start()
+        self.unsharded = db.shards
+        db.shards = Shards(shard_binds(2), db.session)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        Shopcart.cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        connectors = db.get_app().extensions['sqlalchemy'].connectors
+        for shard in db.shards.binds:
+            engine = self.shard_engine(shard)
+            engine.dispose()
+            connectors.pop(shard, None)
+            os.remove(engine.url.database)
+        db.shards = self.unsharded
+        self.binds.stop()
+
+    def shard_engine(self, shard):
+        return db.get_engine(app, shard)
+
+    def count_on(self, shard, user_id):
+        return self.shard_engine(shard).execute(
+            'SELECT count(*) FROM shopcart WHERE user_id = ?', user_id).scalar()
+
+    def add_shopcarts(self):
+        for user_id in range(1, 21):
+            for product_id in range(1, user_id % 3 + 2):
+                Shopcart(user_id=user_id, product_id=product_id, quantity=1, price=user_id).save()
+
+    def test_single_user_operations_touch_one_shard(self):
+        """ Keep the entries and totals of each user on the shard of the user """
+        self.add_shopcarts()
+        shards = set(db.shards.for_user(user_id) for user_id in range(1, 21))
+        self.assertEqual(shards, set(shard_binds(2)))
+        for user_id in range(1, 21):
+            shard = db.shards.for_user(user_id)
+            other = [bind for bind in shard_binds(2) if bind != shard][0]
+            self.assertEqual(self.count_on(shard, user_id), user_id % 3 + 1)
+            self.assertEqual(self.count_on(other, user_id), 0)
+            self.assertEqual(Shopcart.findByUserId(user_id).count(), user_id % 3 + 1)
+            self.assertEqual(Shopcart.find_total(user_id).item_count, user_id % 3 + 1)
+        shopcart = Shopcart.find(7, 2)
+        shopcart.quantity = 5
+        shopcart.save()
+        # The expired attributes are read back from the shard
+        self.assertEqual(shopcart.serialize()['quantity'], 5)
+        shopcart.delete()
+        self.assertIsNone(Shopcart.find(7, 2))
+        self.assertEqual(Shopcart.remove_by_user(8), 3)
+        self.assertEqual(self.count_on(db.shards.for_user(8), 8), 0)
+        Shopcart.add(8, 1, 2, 3.0)
+        Shopcart.upsert_many([{'user_id': user_id, 'product_id': 1, 'quantity': 1, 'price': 1.0}
+                              for user_id in (8, 9, 10)])
+        self.assertEqual([line.quantity for line in Shopcart.find_cart(8)], [3])
+        self.assertEqual(Shopcart.find_total(10).item_count, 2)
+
+    def test_cross_user_operations_fan_out(self):
+        """ Merge the results of every shard for the queries over all users """
+        self.add_shopcarts()
+        self.assertEqual(sorted(Shopcart.list_users()), range(1, 21))
+        self.assertEqual(len(Shopcart.all()), 41)
+        lines = Shopcart.all_by_user()
+        keys = [(line.user_id, line.product_id) for line in lines]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), 41)
+        self.assertEqual(list(Shopcart.stream_by_user(batch_size=3)), lines)
+        self.assertEqual(Shopcart.page(5, after=(4, 1)), lines[7:12])
+        self.assertEqual(sorted(Shopcart.find_users_by_shopcart_amount(50)),
+                         [user_id for user_id in range(1, 21) if user_id * (user_id % 3 + 1) >= 50])
+        top = Shopcart.find_totals_by_amount(0, sort='total_desc', limit=3)
+        self.assertEqual([total.user_id for total in top], [20, 17, 14])
+        changes, after = Shopcart.changes_since([(0, 0), (0, 0)], 100)
+        self.assertEqual(len(changes), 41)
+        self.assertEqual(Shopcart.changes_since(after, 100), ([], after))
+        Shopcart.remove_all()
+        self.assertEqual(Shopcart.all(), [])
+        self.assertEqual(Shopcart.find_total(20).item_count, 0)
+        self.add_shopcarts()
+        Shopcart.remove_all(chunk_size=7)
+        self.assertEqual(Shopcart.list_users(), [])
+
+    def fail_on(self, shard, method):
+        """ Returns a patch of the Shopcart <method> that fails on <shard> """
+        original = getattr(Shopcart, method)
+        def fail(*args, **kwargs):
+            if shard in args or kwargs.get('shard') == shard:
+                raise IOError('shard went away')
+            return original(*args, **kwargs)
+        return patch.object(Shopcart, method, staticmethod(fail))
+
+    def test_writes_commit_each_shard(self):
+        """ Keep what the other shards committed when one of them fails """
+        users = range(1, 21)
+        on_shard1 = [user_id for user_id in users if db.shards.for_user(user_id) == 'shard1']
+        entries = [{'user_id': user_id, 'product_id': 1, 'quantity': 1, 'price': 1.0} for user_id in users]
+        with self.fail_on('shard1', '_log_changes'):
+            with self.assertRaises(PartialWriteError) as raised:
+                Shopcart.upsert_many(entries, chunk_size=7)
+        self.assertEqual(raised.exception.written, len(users) - len(on_shard1))
+        self.assertEqual([entry['user_id'] for entry in raised.exception.unwritten], on_shard1)
+        self.assertEqual(sorted(Shopcart.list_users()), [user_id for user_id in users if user_id not in on_shard1])
+
+        changes = dict(((user_id, 2), {'user_id': user_id, 'product_id': 2, 'quantity': 1, 'price': 1.0})
+                       for user_id in users)
+        buffer = WriteBehindBuffer(Shopcart.write_changes, start_thread=False)
+        for change in changes.values():
+            buffer.save(**change)
+        with self.fail_on('shard1', '_log_changes'):
+            self.assertRaises(PartialWriteError, buffer.flush)
+        # Only the changes of the failed shard are put back
+        self.assertEqual(sorted(buffer.pending()), [(user_id, 2) for user_id in on_shard1])
+        self.assertEqual(buffer.flush(), len(on_shard1))
+        self.assertEqual(len(Shopcart.all()), len(users) * 2 - len(on_shard1))
+
+        with self.fail_on('shard1', '_log_reset'):
+            with self.assertRaises(PartialWriteError) as raised:
+                Shopcart.remove_all()
+        self.assertEqual(raised.exception.written, ['shard0'])
+        self.assertEqual(raised.exception.unwritten, ['shard1'])
+        self.assertEqual(sorted(Shopcart.list_users()), on_shard1)
+
+    def test_profile_counts_statements_of_every_shard(self):
+        """ Count the statements run on the threads of the shards in the request """
+        with patch.dict(app.config, {'SQL_PROFILING': True}):
+            resp = app.test_client().get('/shopcarts/changes')
+        self.assertEqual(resp.status_code, 200)
+        # Numbering the new changes and reading them, on each shard
+        self.assertEqual(resp.headers['X-DB-Queries'], '10')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Write-Behind Buffer
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import threading
+from mock import patch
+from app.model import Shopcart, db
+from app.service import app
+from app.writebehind import WriteBehindBuffer, WriteBehindError
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestWriteBehindBuffer(unittest.TestCase):
+
+    """ Test Cases for the Write-Behind Buffer """
+
+    def setUp(self):
+        self.batches = []
+        # No background thread, the tests flush themselves
+        self.buffer = WriteBehindBuffer(self.batches.append, interval=60, max_size=3, start_thread=False)
+
+    def test_changes_are_merged(self):
+        """ Keep the last change of each entry in the place of its first one """
+        self.buffer.save(1, 1, 1, 2.0)
+        self.buffer.save(1, 2, 1, 3.0)
+        self.buffer.save(1, 1, 5, 2.0)
+        self.buffer.delete(1, 2)
+        self.assertEqual(len(self.buffer), 2)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.batches, [{(1, 1): {'user_id': 1, 'product_id': 1, 'quantity': 5, 'price': 2.0},
+                                         (1, 2): None}])
+        self.assertEqual(list(self.batches[0]), [(1, 1), (1, 2)])
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(len(self.batches), 1)
+
+    def test_failed_commit_is_retried(self):
+        """ Put a failed group commit back behind the newer changes """
+        def fail(changes):
+            self.buffer.save(1, 1, 7, 2.0)
+            raise IOError('database went away')
+        self.buffer.writer = fail
+        self.buffer.save(1, 1, 1, 2.0)
+        self.buffer.save(2, 1, 1, 2.0)
+        self.assertRaises(IOError, self.buffer.flush)
+        self.buffer.writer = self.batches.append
+        self.buffer.flush()
+        self.assertEqual(list(self.batches[0]), [(1, 1), (2, 1)])
+        self.assertEqual(self.batches[0][1, 1]['quantity'], 7)
+
+    def test_full_buffer_is_written(self):
+        """ Write the changes on the background thread once max_size are waiting """
+        written = threading.Event()
+        def writer(changes):
+            self.batches.append(changes)
+            written.set()
+        buffer = WriteBehindBuffer(writer, interval=60, max_size=3)
+        with patch('atexit.register') as register:
+            for product_id in range(3):
+                buffer.save(1, product_id, 1, 1.0)
+            register.assert_called_once_with(buffer.stop)
+        written.wait(5)
+        self.assertEqual(len(self.batches[0]), 3)
+        buffer.save(1, 9, 1, 1.0)
+        # Stopping writes what is left
+        buffer.stop()
+        self.assertEqual(list(self.batches[1]), [(1, 9)])
+
+    def test_sync(self):
+        """ Wait for the background thread to write the changes buffered so far """
+        buffer = WriteBehindBuffer(self.batches.append, interval=60)
+        buffer.sync()
+        with patch('atexit.register'):
+            buffer.save(1, 1, 1, 1.0)
+            buffer.delete(1, 2)
+            buffer.sync()
+        self.assertEqual(list(self.batches[0]), [(1, 1), (1, 2)])
+        self.assertEqual(len(buffer), 0)
+        buffer.stop()
+
+    def test_full_buffer_holds_back_new_entries(self):
+        """ Make a change of a new entry wait for room once max_pending entries are waiting """
+        buffer = WriteBehindBuffer(self.batches.append, interval=60, max_size=10, max_pending=2,
+                                   start_thread=False)
+        buffer.save(1, 1, 1, 1.0)
+        buffer.save(1, 2, 1, 1.0)
+        # The entries that are waiting can still change
+        buffer.save(1, 2, 3, 1.0)
+        self.assertEqual(self.batches, [])
+        buffer.save(1, 3, 1, 1.0)
+        self.assertEqual(list(self.batches[0]), [(1, 1), (1, 2)])
+        self.assertEqual(list(buffer.pending()), [(1, 3)])
+
+    def test_full_buffer_rejects_changes_while_commits_fail(self):
+        """ Turn new entries away instead of growing the buffer while the database is down """
+        def fail(changes):
+            raise IOError('database went away')
+        buffer = WriteBehindBuffer(fail, interval=60, max_size=10, max_pending=2)
+        with patch('atexit.register'):
+            buffer.save(1, 1, 1, 1.0)
+            buffer.save(1, 2, 1, 1.0)
+            self.assertRaises(WriteBehindError, buffer.save, 1, 3, 1, 1.0)
+            self.assertRaises(WriteBehindError, buffer.sync)
+        self.assertEqual(list(buffer.pending()), [(1, 1), (1, 2)])
+        buffer.writer = self.batches.append
+        buffer.stop()
+        self.assertEqual(len(self.batches[0]), 2)
+
+
+class TestWriteBehindShopcarts(unittest.TestCase):
+
+    """ Test Cases for Shopcarts written through the Write-Behind Buffer """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        Shopcart.cache.clear()
+        buffer = WriteBehindBuffer(Shopcart.write_changes, start_thread=False)
+        self.write_behind = patch.object(Shopcart, 'write_behind', buffer)
+        self.buffer = self.write_behind.start()
+
+    def tearDown(self):
+        self.write_behind.stop()
+        db.session.remove()
+        db.drop_all()
+
+    def test_group_commit(self):
+        """ Write the buffered saves and deletes in one group commit """
+        Shopcart.add(1, 1, 1, 10.0)
+        Shopcart.add(1, 2, 1, 5.0)
+        shopcart = Shopcart.find(1, 1)
+        shopcart.quantity = 3
+        shopcart.save()
+        Shopcart.find(1, 2).delete()
+        Shopcart(user_id=2, product_id=4, quantity=2, price=1.5).save()
+        Shopcart(user_id=2, product_id=4, quantity=6, price=1.5).save()
+        # Nothing is written before the group commit
+        self.assertEqual(len(Shopcart.find_cart(1)), 2)
+        self.assertIsNone(Shopcart.find_total(2))
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual([(line.product_id, line.quantity, line.version) for line in Shopcart.find_cart(1)],
+                         [(1, 3, 2)])
+        self.assertEqual(Shopcart.find_total(1).total_price, 30.0)
+        self.assertEqual(Shopcart.find(2, 4).quantity, 6)
+        self.assertEqual(Shopcart.find_total(2).item_count, 1)
+
+    def test_direct_writes_come_after_buffered_ones(self):
+        """ Write the buffered changes before a write that skips the buffer """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=1.0).save()
+        Shopcart.add(1, 1, 3, 1.0)
+        self.assertEqual(Shopcart.find(1, 1).quantity, 5)
+        Shopcart(user_id=1, product_id=2, quantity=2, price=1.0).save()
+        Shopcart.upsert_many([{'user_id': 1, 'product_id': 2, 'quantity': 1, 'price': 1.0}])
+        self.assertEqual(Shopcart.find(1, 2).quantity, 3)
+        Shopcart(user_id=1, product_id=3, quantity=2, price=1.0).save()
+        self.assertEqual(Shopcart.remove_by_user(1), 3)
+        Shopcart(user_id=1, product_id=4, quantity=2, price=1.0).save()
+        Shopcart.remove_all()
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(Shopcart.all(), [])
+
+    def test_conditional_writes_skip_the_buffer(self):
+        """ Write a PUT or DELETE with If-Match right away, after the buffered changes """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=1.0).save()
+        Shopcart.sync_writes()
+        client = app.test_client()
+        data = '{"user_id": 1, "product_id": 1, "quantity": %s, "price": 1.0}'
+        resp = client.put('/shopcarts/1/product/1', data=data % 3, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertEqual(len(self.buffer), 1)
+        # Checked against the entry as the buffered PUT left it
+        resp = client.put('/shopcarts/1/product/1', data=data % 4, content_type='application/json',
+                          headers={'If-Match': '"1"'})
+        self.assertEqual(resp.status_code, 412)
+        self.assertEqual(len(self.buffer), 0)
+        resp = client.put('/shopcarts/1/product/1', data=data % 4, content_type='application/json',
+                          headers={'If-Match': '"2"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['ETag'], '"3"')
+        self.assertEqual(Shopcart.find(1, 1).quantity, 4)
+        resp = client.delete('/shopcarts/1/product/1', headers={'If-Match': '"3"'})
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertIsNone(Shopcart.find(1, 1))
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()